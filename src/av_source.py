@@ -1,15 +1,44 @@
 import typing
 import ffmpeg
 import asyncio
-from aiohttp import ClientSession, ClientTimeout, TCPConnector
+from aiohttp import ClientTimeout
 import cut_time
 import av_utils
+import http_pool
+import buffered_reader
+import upload_journal
+import range_downloader
+import hls_fetcher
+import dash_fetcher
 from datetime import datetime
 import time
 import os
 import signal
 
 
+# options of ffmpeg http protocol, they are not allowed for pipe inputs
+HTTP_INPUT_OPTIONS = ('-headers', '-icy', '-reconnect', '-reconnect_streamed', '-reconnect_delay_max')
+
+
+# drops http options of inputs which are read from pipes
+def _pipe_inputs(args):
+    result = []
+    group = []
+    i = 0
+    while i < len(args):
+        if args[i] == '-i' and i + 1 < len(args):
+            if args[i + 1].startswith('pipe:'):
+                group = [a for j, a in enumerate(group)
+                         if a not in HTTP_INPUT_OPTIONS and (j == 0 or group[j - 1] not in HTTP_INPUT_OPTIONS)]
+            result += group + args[i:i + 2]
+            group = []
+            i += 2
+            continue
+        group.append(args[i])
+        i += 1
+    return result + group
+
+
 class DumbReader(typing.BinaryIO):
     def write(self, s: typing.Union[bytes, bytearray]) -> int:
         pass
@@ -72,11 +101,27 @@ class DumbReader(typing.BinaryIO):
         pass
 
 
+# path of local file which ffmpeg writes for requested file name
+def output_file_name(file_name):
+    return "'" + file_name.replace('/', '').replace('\'', '') + "'"
+
+
+# stands for ffmpeg process whose output file is already complete
+class FinishedProcess:
+    pid = None
+    returncode = 0
+
+    async def wait(self):
+        return self.returncode
+
+
 class FFMpegAV(DumbReader):
 
     def __init__(self):
-        self._buf = b''
+        self.reader = None
         self.file_name = None
+        # tasks which download segments for ffmpeg inputs
+        self.feeders = []
 
     @staticmethod
     async def create(vformat,
@@ -88,6 +133,19 @@ class FFMpegAV(DumbReader):
                      format_name='',
                      file_name=None,
                      restrict_size=True):
+        # hls segments are downloaded by bot several at once and piped to ffmpeg
+        hls = None
+        if aformat is None and cut_time_range is None and 'm3u8' in vformat.get('protocol', ''):
+            hls = await hls_fetcher.HlsFetcher.create(vformat['url'], headers if headers != '' else None)
+        # dash fragments are downloaded by bot too, each format goes to ffmpeg through own pipe.
+        # Its url is replaced by placeholder which becomes pipe name when pipe is made
+        dash = {}
+        if dash_fetcher.is_dash(vformat):
+            dash['dash:video'] = dash_fetcher.create(vformat, headers if headers != '' else None)
+            vformat = dict(vformat, url='dash:video')
+        if dash_fetcher.is_dash(aformat):
+            dash['dash:audio'] = dash_fetcher.create(aformat, headers if headers != '' else None)
+            aformat = dict(aformat, url='dash:audio')
         if headers != '':
             headers = "\n".join(av_utils.dict_to_list(headers))
         ff = FFMpegAV()
@@ -95,7 +153,7 @@ class FFMpegAV(DumbReader):
         _finput = None
 
         if file_name:
-            ff.file_name = "'" + file_name.replace('/', '').replace('\'', '') + "'"
+            ff.file_name = output_file_name(file_name)
 
         cut_time_fix_args = []
         cut_time_start = cut_time_end = None
@@ -116,6 +174,8 @@ class FFMpegAV(DumbReader):
                                        i=aformat['url'])
             else:
                 _finput = ffmpeg.input(vformat['url'], headers=headers, i=aformat['url'])
+        elif hls is not None:
+            _finput = ffmpeg.input('pipe:')
         else:
             if cut_time_start is not None:
                 _finput = ffmpeg.input(vformat['url'], headers=headers, **{'noaccurate_seek': None}, ss=cut_time_start)
@@ -208,17 +268,44 @@ class FFMpegAV(DumbReader):
             # if cut_time_start is not None and not audio_only:
             #     args[args.index('-acodec') + 1] = 'copy'  # copy audio if cutting due to music issue
 
+        if ff.file_name:
+            if await upload_journal.journal.output_ready(ff.file_name):
+                # complete file is left by previous run, it's uploaded without running ffmpeg again
+                ff.stream = FinishedProcess()
+                return ff
+            # partial file of interrupted ffmpeg
+            try:
+                os.remove(ff.file_name)
+            except FileNotFoundError:
+                pass
+
         args = args[:1] + ["-loglevel",  "error", "-icy", "0", "-err_detect", "ignore_err", "-reconnect", "1", "-reconnect_streamed", "1", "-reconnect_delay_max", "10"] + args[1:]
-        if not ff.file_name:
-            proc = await asyncio.create_subprocess_exec('ffmpeg',
-                                                        *args[1:],
-                                                        stdout=asyncio.subprocess.PIPE)
-        else:
-            proc = await asyncio.create_subprocess_exec('ffmpeg',
-                                                        *args[1:])
-        if headers != '':
+        stdin = asyncio.subprocess.PIPE if hls is not None else None
+        dash_pipes = {}
+        for placeholder in dash:
+            read_fd, write_fd = os.pipe()
+            buffered_reader.enlarge_pipe(read_fd)
+            dash_pipes[placeholder] = (read_fd, write_fd)
+        args = _pipe_inputs(['pipe:' + str(dash_pipes[a][0]) if a in dash_pipes else a for a in args])
+        pass_fds = [read_fd for read_fd, _ in dash_pipes.values()]
+        try:
+            proc = await FFMpegAV._start(ff, args, stdin, pass_fds)
+        except:
+            for _, write_fd in dash_pipes.values():
+                os.close(write_fd)
+            raise
+        finally:
+            for read_fd, _ in dash_pipes.values():
+                os.close(read_fd)
+        for placeholder, (_, write_fd) in dash_pipes.items():
+            ff.feeders.append(asyncio.ensure_future(dash[placeholder].feed(buffered_reader.PipeSink(write_fd))))
+        if hls is not None:
+            ff.feeders.append(asyncio.ensure_future(hls.feed(proc.stdin)))
+        if not ff.feeders and headers != '':
             await asyncio.sleep(1)
             if proc.returncode is not None and proc.returncode != 0:
+                ff.stream = proc
+                ff.close()
                 return await FFMpegAV.create(vformat,
                                              aformat=aformat,
                                              audio_only=audio_only,
@@ -231,34 +318,61 @@ class FFMpegAV(DumbReader):
 
         return ff
 
-    async def read(self, n: int = -1):
-        buf = b''
-        if len(self._buf) != 0:
-            buf += self._buf
-            self._buf = b''
-        if n == -1:
-            return await self.stream.stdout.read()
-
-        while len(buf) < n:
-            _data = await self.stream.stdout.read(n)
-            if len(_data) == 0:
-                break
-            buf += _data
-        if len(buf) > n != -1:
-            self._buf = buf[n:]
-            return buf[:n]
+    @staticmethod
+    async def _start(ff, args, stdin, pass_fds):
+        if not ff.file_name:
+            # own pipe is read straight into buffer memory, bigger pipe means less wakeups
+            read_fd, write_fd = os.pipe()
+            buffered_reader.enlarge_pipe(read_fd)
+            try:
+                proc = await asyncio.create_subprocess_exec('ffmpeg',
+                                                            *args[1:],
+                                                            stdin=stdin,
+                                                            stdout=write_fd,
+                                                            pass_fds=pass_fds)
+            except:
+                os.close(read_fd)
+                raise
+            finally:
+                os.close(write_fd)
+            ff.reader = buffered_reader.BufferedReader(buffered_reader.PipeSource(read_fd))
         else:
-            return buf
+            proc = await asyncio.create_subprocess_exec('ffmpeg',
+                                                        *args[1:],
+                                                        stdin=stdin,
+                                                        pass_fds=pass_fds)
+        return proc
+
+    # raises error of segment download, ffmpeg output is broken then.
+    # Failed feeder closes its pipe as the last step, so it's done before ffmpeg output ends
+    def check_feeders(self):
+        for feeder in self.feeders:
+            if feeder.done() and not feeder.cancelled() and feeder.exception() is not None:
+                raise feeder.exception()
+
+    async def read(self, n: int = -1):
+        if self.reader is None:
+            return b''
+        data = await self.reader.read(n)
+        if not data:
+            self.check_feeders()
+        return data
 
     def close(self) -> None:
         # print('last data ', len(self.stream.stdout.read()))
+        for feeder in self.feeders:
+            feeder.cancel()
         try:
             os.kill(self.stream.pid, signal.SIGTERM)
         except:
             pass
+        if self.reader is not None:
+            self.reader.close()
 
     def safe_close(self):
         self.close()
+        if self.stream.pid is None:
+            return
         time.sleep(2)
         # sometimes ffmpeg don't want to exit after any signal except SIGKILL
         os.kill(self.stream.pid, signal.SIGKILL)
@@ -268,6 +382,10 @@ class FFMpegAV(DumbReader):
             os.kill(self.stream.pid, signal.SIGKILL)
         except:
             pass
+        try:
+            self.reader.close()
+        except:
+            pass
 
     def __aiter__(self):
         return self
@@ -282,49 +400,63 @@ class FFMpegAV(DumbReader):
 
 class URLav(DumbReader):
     def __init__(self):
-        self._buf = b''
+        self.reader = None
+        self.request = None
+        self.source = None
 
     @staticmethod
     async def create(url, headers=None):
+        urlav = await URLav._create_segmented(url, headers)
+        if urlav is not None:
+            return urlav
         urlav = await URLav._create(url, headers)
         if urlav.request.status != 200:
             await urlav.close()
             urlav = await URLav._create(url)
         return urlav
 
+    # media is downloaded by several range requests at once if server supports them,
+    # None means it should be read by one request
+    @staticmethod
+    async def _create_segmented(url, headers=None):
+        if range_downloader.RANGE_CONNECTIONS <= 1:
+            return None
+        for _headers in ([headers, None] if headers else [None]):
+            try:
+                probe = await av_utils.probe(url, http_headers=_headers)
+            except Exception as e:
+                print('range probe failed: ' + str(e))
+                continue
+            # too small media isn't worth several requests
+            if probe.status != 206 or probe.size < 2 * range_downloader.RANGE_SEGMENT_SIZE:
+                break
+            u = URLav()
+            u.source = range_downloader.RangeSource(url, probe.size, _headers)
+            u.reader = buffered_reader.BufferedReader(u.source)
+            return u
+        range_downloader.stats.fallbacks += 1
+        return None
+
 
     @staticmethod
     async def _create(url, headers=None):
         u = URLav()
         timeout = ClientTimeout(total=3600)
-        u.session = await ClientSession(timeout=timeout, connector=TCPConnector(verify_ssl=False)).__aenter__()
-        u.request = await u.session.get(url, headers=headers)
+        u.request = await http_pool.pool.session().get(url, headers=headers, timeout=timeout)
+        u.reader = buffered_reader.BufferedReader(buffered_reader.StreamSource(u.request.content))
         # u.request = await asks.get(url, headers=headers, stream=True, max_redirects=5)
         # u.body = u.request.body(timeout=14400)
         return u
 
     async def read(self, n: int = -1):
-        buf = b''
-        if len(self._buf) != 0:
-            buf += self._buf
-            self._buf = b''
-        if n == -1:
-            return await self.request.read()
-
-        while len(buf) < n:
-            _data = await self.request.content.read(n)
-            if len(_data) == 0:
-                break
-            buf += _data
-        if len(buf) > n != -1:
-            self._buf = buf[n:]
-            return buf[:n]
-        else:
-            return buf
+        return await self.reader.read(n)
 
     async def close(self) -> None:
-        # self.request.release()
-        await self.session.__aexit__(exc_type=None, exc_val=None, exc_tb=None)
+        if self.source is not None:
+            self.source.close()
+        # connection goes back to the shared pool only if body was read to the end
+        if self.request is not None:
+            self.request.release()
 
     def __aiter__(self):
         return self
@@ -1,10 +1,29 @@
 import m3u8
 import asyncio
+import collections
+import contextlib
+import contextvars
+import functools
 import json
 import os, signal
-from aiohttp import ClientSession, hdrs, TCPConnector
+import time
+from aiohttp import hdrs
 from http.client import responses
 from urllib.parse import urlparse
+import http_pool
+import metrics
+
+
+M3U8_PROBE_CONCURRENCY = int(os.getenv('M3U8_PROBE_CONCURRENCY', 16))
+# segments count probed for size estimation, whole playlist is probed if it is smaller
+M3U8_SAMPLE_SEGMENTS = int(os.getenv('M3U8_SAMPLE_SEGMENTS', 12))
+# leading bytes requested by probe, enough to sniff media container
+PROBE_BYTES = int(os.getenv('PROBE_BYTES', 64 * 1024))
+# ffprobe results are reused for the same url and headers during this time
+AV_INFO_TTL = int(os.getenv('AV_INFO_TTL', 600))
+AV_INFO_CACHE_SIZE = int(os.getenv('AV_INFO_CACHE_SIZE', 1024))
+# ffprobe processes which may run at once
+FFPROBE_CONCURRENCY = int(os.getenv('FFPROBE_CONCURRENCY', 8))
 
 
 # convert each key-value to string like "key: value"
@@ -15,11 +34,127 @@ def dict_to_list(_dict):
 
     return ret
 
+class AvInfoCache:
+
+    def __init__(self, ttl, max_entries, concurrency):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.concurrency = concurrency
+        # key -> (expire time, info json), least recently used first
+        self._entries = collections.OrderedDict()
+        # key -> future of probe which is running now
+        self._inflight = {}
+        # created lazily, it must belong to running loop
+        self._semaphore = None
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.queue_wait = metrics.Histogram()
+        self.probe_duration = metrics.Histogram()
+
+    @staticmethod
+    def make_key(url, http_headers):
+        return url + '\0' + (json.dumps(http_headers, sort_keys=True) if http_headers else '')
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expire, info_json = entry
+        if expire < time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        # callers get their own copy
+        return json.loads(info_json)
+
+    def put(self, key, info):
+        self._entries[key] = (time.time() + self.ttl, json.dumps(info))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    # probes of the same key which are started while the first one runs wait for its result
+    async def coalesce(self, key, probe_fn):
+        info = self.get(key)
+        if info is not None:
+            self.hits += 1
+            return info
+        fut = self._inflight.get(key)
+        if fut is not None:
+            self.coalesced += 1
+            try:
+                await asyncio.shield(fut)
+            except asyncio.CancelledError:
+                if not fut.cancelled():
+                    raise
+                # first probe was cancelled with its job, make own one
+                return await self.coalesce(key, probe_fn)
+            return json.loads(fut.result())
+
+        self.misses += 1
+        fut = asyncio.get_event_loop().create_future()
+        self._inflight[key] = fut
+        try:
+            info = await probe_fn()
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except Exception as e:
+            fut.set_exception(e)
+            # don't warn about exception nobody waits for
+            fut.exception()
+            raise
+        finally:
+            del self._inflight[key]
+        # failed probe returns empty info, don't remember it
+        if len(info.keys()) != 0:
+            self.put(key, info)
+        fut.set_result(json.dumps(info))
+        return info
+
+    # run ffprobe when one of limited slots is free
+    async def run_limited(self, probe_fn, *args):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        queued = time.monotonic()
+        async with self._semaphore:
+            started = time.monotonic()
+            self.queue_wait.observe(started - queued)
+            try:
+                return await probe_fn(*args)
+            finally:
+                self.probe_duration.observe(time.monotonic() - started)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'hit_ratio': self.hits / total if total else 0.0,
+            'inflight': len(self._inflight),
+            'concurrency': self.concurrency,
+            'queue_wait': self.queue_wait.stats(),
+            'probe_duration': self.probe_duration.stats()
+        }
+
+
+av_info_cache = AvInfoCache(AV_INFO_TTL, AV_INFO_CACHE_SIZE, FFPROBE_CONCURRENCY)
+
+
 async def av_info(url, http_headers=''):
-    info = await _av_info(url, http_headers)
+    key = AvInfoCache.make_key(url, http_headers)
+    return await av_info_cache.coalesce(key, functools.partial(_av_info_with_retry, url, http_headers))
+
+
+async def _av_info_with_retry(url, http_headers=''):
+    info = await av_info_cache.run_limited(_av_info, url, http_headers)
     if len(info.keys()) == 0:
         # some sites return error if headers was passed
-        info = await _av_info(url)
+        info = await av_info_cache.run_limited(_av_info, url)
 
     return info
 
@@ -85,68 +220,133 @@ async def _av_info(url, http_headers=''):
     #     return w, h, dur
 
 
-async def media_size(url, session=None, http_headers=None):
-    content_length = None
-    try:
-        content_length = await _media_size(url, session, http_headers)
-    except Exception as e:
-        print(e)
+# (magic bytes offset, magic bytes, mime) checked by sniff_mime in order
+MEDIA_MAGIC = [(4, b'ftypM4A', 'audio/mp4'),
+               (4, b'ftyp', 'video/mp4'),
+               (0, b'\x1aE\xdf\xa3', 'video/webm'),
+               (0, b'ID3', 'audio/mpeg'),
+               (0, b'OggS', 'audio/ogg'),
+               (0, b'fLaC', 'audio/flac'),
+               (8, b'WAVE', 'audio/x-wav'),
+               (8, b'AVI ', 'video/x-msvideo'),
+               (0, b'FLV', 'video/x-flv'),
+               (0, b'PK\x03\x04', 'application/zip')]
 
-    if content_length is not None:
-        return content_length
 
-    return await _media_size(url, session)
+def sniff_mime(head):
+    for offset, magic, mime in MEDIA_MAGIC:
+        if head[offset:offset + len(magic)] == magic:
+            return mime
+    # mpeg audio frame sync without ID3 tag
+    if len(head) > 1 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0:
+        return 'audio/mpeg'
+    return None
+
+
+class ProbeResult:
+
+    def __init__(self, url, status, size, content_type, file_name, head):
+        self.url = url
+        self.status = status
+        # total media size, 0 if server didn't tell it
+        self.size = size
+        self.content_type = content_type
+        # file name from content disposition
+        self.file_name = file_name
+        # leading bytes of media
+        self.head = head
 
-async def _media_size(url, session=None, http_headers=None):
-    _session = None
-    if session is None:
-        _session = await ClientSession(connector=TCPConnector(verify_ssl=False)).__aenter__()
-    else:
-        _session = session
-    content_length = 0
-    try:
-        async with _session.head(url, headers=http_headers, allow_redirects=True) as resp:
-            if resp.status != 200:
-                print('Request to url {} failed: '.format(url) + responses[resp.status])
-            else:
-                content_length = int(resp.headers.get(hdrs.CONTENT_LENGTH, '0'))
-    except Exception as e:
-        print(e)
 
-    # try GET request when HEAD failed
+# probes of urls made by current job, shared by tasks which the job starts
+_job_probes = contextvars.ContextVar('job_probes', default=None)
+
+
+# url probes inside of this block are made once per url and headers
+@contextlib.contextmanager
+def probe_scope():
+    token = _job_probes.set({})
     try:
-        if content_length < 100:
-            async with _session.get(url, headers=http_headers) as get_resp:
-                if get_resp.status != 200:
-                    raise Exception('Request failed: ' + str(get_resp.status) + " " + responses[get_resp.status])
-                else:
-                    content_length = int(get_resp.headers.get(hdrs.CONTENT_LENGTH, '0'))
+        yield
     finally:
-        if session is None:
-            await _session.__aexit__(exc_type=None, exc_val=None, exc_tb=None)
+        _job_probes.reset(token)
+
 
-    return content_length
-    # head_req = request.Request(url, method='HEAD', headers=http_headers)
-    # try:
-    #     with request.urlopen(head_req) as resp:
-    #         return int(resp.headers['Content-Length'])
-    # except:
-    #     return None
+# size, type, file name and leading bytes of media by one ranged GET request
+async def probe(url, http_headers=None, session=None):
+    probes = _job_probes.get()
+    if probes is None:
+        return await _probe(url, http_headers, session)
+    key = (url, json.dumps(http_headers, sort_keys=True) if http_headers else '')
+    fut = probes.get(key)
+    if fut is None:
+        fut = asyncio.ensure_future(_probe(url, http_headers, session))
+        probes[key] = fut
+    # one waiter cancellation must not cancel probe for the others
+    return await asyncio.shield(fut)
 
 
+async def _probe(url, http_headers=None, session=None):
+    _session = session if session is not None else http_pool.pool.session()
+    headers = dict(http_headers) if http_headers else {}
+    headers[hdrs.RANGE] = 'bytes=0-' + str(PROBE_BYTES - 1)
+    async with _session.get(url, headers=headers) as resp:
+        # 416 is returned for empty media
+        if resp.status not in (200, 206, 416):
+            raise Exception('Request failed: ' + str(resp.status) + " " + responses.get(resp.status, ''))
+        size = 0
+        content_range = resp.headers.get(hdrs.CONTENT_RANGE, '')
+        if resp.status != 200:
+            total = content_range.rsplit('/', maxsplit=1)[-1]
+            if total.isdigit():
+                size = int(total)
+        else:
+            # server ignored range, its body is the whole media
+            size = int(resp.headers.get(hdrs.CONTENT_LENGTH, '0') or 0)
+
+        content_type = None
+        content_types = resp.headers.getall(hdrs.CONTENT_TYPE, [])
+        for ct in content_types:
+            _media_type = ct.split('/')[0]
+            if _media_type == 'audio' or _media_type == 'video':
+                content_type = ct
+                break
+        else:
+            if len(content_types) > 0:
+                content_type = content_types[0]
+
+        file_name = None
+        if resp.content_disposition and resp.content_disposition.filename:
+            file_name = resp.content_disposition.filename
+
+        head = bytearray()
+        if resp.status != 416:
+            while len(head) < PROBE_BYTES:
+                chunk = await resp.content.read(PROBE_BYTES - len(head))
+                if not chunk:
+                    break
+                head += chunk
+    return ProbeResult(url, resp.status, size, content_type, file_name, bytes(head))
+
+
+async def media_size(url, session=None, http_headers=None):
+    try:
+        return (await probe(url, http_headers, session)).size
+    except Exception as e:
+        print(e)
+    # some sites return error if headers was passed
+    return (await probe(url, session=session)).size
+
+
+# returns (mime, None) or (None, file name from content disposition)
 async def media_mime(url, http_headers=None):
-    async with ClientSession(connector=TCPConnector(verify_ssl=False)) as session:
-        async with session.get(url, headers=http_headers) as get_resp:
-            if get_resp.content_disposition and get_resp.content_disposition.filename:
-                return None, get_resp.content_disposition.filename
-            _content_type = get_resp.headers.getall(hdrs.CONTENT_TYPE)
-            for ct in _content_type:
-                _media_type = ct.split('/')[0]
-                if _media_type == 'audio' or _media_type == 'video':
-                    return ct, None
-            else:
-                if len(_content_type) > 0:
-                    return _content_type[0], None
+    res = await probe(url, http_headers)
+    if res.file_name:
+        return None, res.file_name
+    if res.content_type is None or res.content_type.split(';')[0] == 'application/octet-stream':
+        sniffed = sniff_mime(res.head)
+        if sniffed is not None:
+            return sniffed, None
+    return res.content_type or 'application/octet-stream', None
 
 
 def m3u8_parse_url(url):
@@ -158,15 +358,88 @@ def m3u8_parse_url(url):
 
 
 async def m3u8_video_size(url, http_headers=None):
-    m3u8_data = None
-    m3u8_obj = None
-    async with ClientSession(connector=TCPConnector(verify_ssl=False)) as session:
+    size, _ = await m3u8_size_estimate(url, http_headers)
+    return size
+
+
+# returns (estimated size, estimation error in bytes)
+async def m3u8_size_estimate(url, http_headers=None, sample_count=None):
+    if sample_count is None:
+        sample_count = M3U8_SAMPLE_SEGMENTS
+    sample_count = max(2, sample_count)
+    session = http_pool.pool.session()
+    m3u8_obj, bandwidth = await load_media_playlist(session, url, http_headers)
+    segments = m3u8_obj.segments
+    if len(segments) == 0:
+        return 0, 0
+
+    if len(segments) <= sample_count:
+        sample = list(range(len(segments)))
+    else:
+        # evenly spaced segments including the first and the last one
+        step = (len(segments) - 1) / (sample_count - 1)
+        sample = sorted(set(round(i * step) for i in range(sample_count)))
+
+    semaphore = asyncio.Semaphore(M3U8_PROBE_CONCURRENCY)
+
+    async def probe(seg):
+        if seg.byterange:
+            return int(seg.byterange.split('@')[0])
+        async with semaphore:
+            try:
+                return await media_size(seg.absolute_uri, session=session, http_headers=http_headers)
+            except Exception as e:
+                print(e)
+                return None
+    sizes = await asyncio.gather(*[probe(segments[i]) for i in sample])
+
+    probed = [(segments[i], size) for i, size in zip(sample, sizes) if size]
+    durations = [seg.duration or 0 for seg in segments]
+    total_duration = sum(durations)
+    if len(probed) == 0:
+        if bandwidth and total_duration:
+            # BANDWIDTH is a peak bitrate, so it is an upper bound
+            size = int(bandwidth / 8 * total_duration)
+            return size, size // 2
+        return 0, 0
+    if len(probed) == len(segments):
+        return sum(size for _, size in probed), 0
+
+    probed_duration = sum(seg.duration or 0 for seg, _ in probed)
+    if total_duration > 0 and probed_duration > 0:
+        # extrapolate by bytes per second of probed segments
+        rates = [size / seg.duration for seg, size in probed if seg.duration]
+        rate = sum(size for _, size in probed) / probed_duration
+        size = rate * total_duration
+    else:
+        rates = [size for _, size in probed]
+        rate = sum(rates) / len(rates)
+        size = rate * len(segments)
+
+    return int(size), int(size * _relative_error(rates, rate, len(segments)))
+
+
+# ~95% confidence bound of estimation by sample mean
+def _relative_error(values, mean, population):
+    if len(values) < 2 or mean == 0:
+        return 1.0
+    variance = sum((v - mean) ** 2 for v in values) / (len(values) - 1)
+    finite_population = 1 - len(values) / population
+    return 2 * (variance ** 0.5 / mean) * (finite_population / len(values)) ** 0.5
+
+
+# returns media playlist and BANDWIDTH of the chosen variant if url points to master playlist
+async def load_media_playlist(session, url, http_headers=None):
+    bandwidth = None
+    for _ in range(2):
         async with session.get(url, headers=http_headers) as resp:
             m3u8_data = await resp.read()
             m3u8_obj = m3u8.loads(m3u8_data.decode())
             m3u8_obj.base_uri = m3u8_parse_url(str(resp.url))
-        size = 0
-        for seg in m3u8_obj.segments:
-            size += await media_size(seg.absolute_uri, session=session, http_headers=http_headers)
-
-    return size
+        if not m3u8_obj.is_variant or len(m3u8_obj.playlists) == 0:
+            break
+        # ffmpeg picks the best variant
+        variant = max(m3u8_obj.playlists, key=lambda p: p.stream_info.bandwidth or 0)
+        bandwidth = variant.stream_info.bandwidth
+        url = variant.absolute_uri
+    return m3u8_obj, bandwidth
@@ -0,0 +1,73 @@
+import asyncio
+import os
+import sys
+import time
+import buffered_reader
+
+
+# compares reading ffmpeg pipe by parts with the former bytes concatenation
+
+
+async def _benchmark_concat(proc, part_size):
+    # former FFMpegAV.read
+    _buf = b''
+    total = 0
+    while True:
+        buf = b''
+        if len(_buf) != 0:
+            buf += _buf
+            _buf = b''
+        while len(buf) < part_size:
+            _data = await proc.stdout.read(part_size)
+            if len(_data) == 0:
+                break
+            buf += _data
+        if len(buf) > part_size:
+            _buf = buf[part_size:]
+            buf = buf[:part_size]
+        if len(buf) == 0:
+            return total
+        total += len(buf)
+
+
+async def _benchmark_buffered(reader, part_size):
+    total = 0
+    while True:
+        part = await reader.read(part_size)
+        if len(part) == 0:
+            return total
+        total += len(part)
+
+
+async def _benchmark(size, part_size):
+    cmd = ['head', '-c', str(size), '/dev/zero']
+
+    started = time.perf_counter()
+    proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE)
+    total = await _benchmark_concat(proc, part_size)
+    await proc.wait()
+    concat_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    read_fd, write_fd = os.pipe()
+    enlarged = buffered_reader.enlarge_pipe(read_fd)
+    proc = await asyncio.create_subprocess_exec(*cmd, stdout=write_fd)
+    os.close(write_fd)
+    reader = buffered_reader.BufferedReader(buffered_reader.PipeSource(read_fd))
+    buffered_total = await _benchmark_buffered(reader, part_size)
+    reader.close()
+    await proc.wait()
+    buffered_time = time.perf_counter() - started
+
+    assert total == buffered_total == size
+    mb = size / 1024 / 1024
+    print('read {} MB by {} KB parts, pipe enlarged: {}'.format(mb, part_size // 1024, enlarged))
+    print('bytes concatenation: {:.1f} MB/s'.format(mb / concat_time))
+    print('buffered reader:     {:.1f} MB/s'.format(mb / buffered_time))
+
+
+# python buffered_bench.py [size MB] [part KB]
+if __name__ == '__main__':
+    _size = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+    _part = int(sys.argv[2]) if len(sys.argv) > 2 else 512
+    asyncio.get_event_loop().run_until_complete(_benchmark(_size * 1024 * 1024, _part * 1024))
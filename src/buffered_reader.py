@@ -0,0 +1,185 @@
+import asyncio
+import fcntl
+import os
+
+
+# size of ffmpeg stdout pipe, linux limits it by /proc/sys/fs/pipe-max-size
+PIPE_SIZE = int(os.getenv('PIPE_SIZE', 1024 * 1024))
+# linux only fcntl command, python exposes it since 3.10
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+# room for a few upload parts, grows if bigger part is requested
+READ_BUFFER_SIZE = int(os.getenv('READ_BUFFER_SIZE', 2 * 1024 * 1024))
+
+
+def enlarge_pipe(fd, size=PIPE_SIZE):
+    try:
+        fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+        return True
+    except OSError:
+        return False
+
+
+# non-blocking pipe end which is read straight into memory of buffer
+class PipeSource:
+
+    def __init__(self, fd):
+        self.fd = fd
+        self._loop = asyncio.get_event_loop()
+        self._waiter = None
+        os.set_blocking(fd, False)
+
+    async def readinto(self, view):
+        while self.fd is not None:
+            try:
+                return os.readv(self.fd, [view])
+            except BlockingIOError:
+                await self._wait_readable()
+        return 0
+
+    async def _wait_readable(self):
+        self._waiter = self._loop.create_future()
+        waiter = self._waiter
+        self._loop.add_reader(self.fd, lambda: waiter.done() or waiter.set_result(None))
+        try:
+            await waiter
+        finally:
+            if self.fd is not None:
+                self._loop.remove_reader(self.fd)
+            self._waiter = None
+
+    def close(self):
+        if self.fd is None:
+            return
+        fd, self.fd = self.fd, None
+        self._loop.remove_reader(fd)
+        os.close(fd)
+        # wake up reader, it gets end of data
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+
+# non-blocking pipe end which ffmpeg reads as extra input, has write and drain like asyncio StreamWriter
+class PipeSink:
+
+    def __init__(self, fd):
+        self.fd = fd
+        self._loop = asyncio.get_event_loop()
+        self._pending = []
+        self._waiter = None
+        os.set_blocking(fd, False)
+
+    def write(self, data):
+        self._pending.append(memoryview(data))
+
+    async def drain(self):
+        while self._pending:
+            if self.fd is None:
+                raise BrokenPipeError('pipe is closed')
+            try:
+                written = os.write(self.fd, self._pending[0])
+            except BlockingIOError:
+                await self._wait_writable()
+                continue
+            if written == len(self._pending[0]):
+                self._pending.pop(0)
+            else:
+                self._pending[0] = self._pending[0][written:]
+
+    async def _wait_writable(self):
+        self._waiter = self._loop.create_future()
+        waiter = self._waiter
+        self._loop.add_writer(self.fd, lambda: waiter.done() or waiter.set_result(None))
+        try:
+            await waiter
+        finally:
+            if self.fd is not None:
+                self._loop.remove_writer(self.fd)
+            self._waiter = None
+
+    def close(self):
+        if self.fd is None:
+            return
+        fd, self.fd = self.fd, None
+        self._pending = []
+        self._loop.remove_writer(fd)
+        os.close(fd)
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+
+# asyncio or aiohttp stream, they have no readinto so data is copied once
+class StreamSource:
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    async def readinto(self, view):
+        data = await self.stream.read(len(view))
+        view[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        pass
+
+
+# Reads source into one preallocated buffer. Unread tail is moved to the buffer start
+# only when requested part doesn't fit after it, so part is copied only once when it is read out
+class BufferedReader:
+
+    def __init__(self, source, size=READ_BUFFER_SIZE):
+        self.source = source
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        # unread data is self._buf[self._start:self._end]
+        self._start = 0
+        self._end = 0
+        self.eof = False
+
+    def _make_room(self, n):
+        unread = self._end - self._start
+        if n > len(self._buf):
+            buf = bytearray(max(n, 2 * len(self._buf)))
+            buf[:unread] = self._view[self._start:self._end]
+            # the old buffer is dropped, unread data is moved to the new one
+            self._buf = buf
+            self._view = memoryview(buf)
+        elif self._start + n > len(self._buf):
+            self._view[:unread] = self._view[self._start:self._end]
+        else:
+            return
+        self._start, self._end = 0, unread
+
+    async def _fill(self, n):
+        self._make_room(n)
+        while self._end - self._start < n and not self.eof:
+            count = await self.source.readinto(self._view[self._end:])
+            if count == 0:
+                self.eof = True
+            else:
+                self._end += count
+
+    # up to n bytes, short only at the end of data. View is valid until the next read
+    async def _read_view(self, n):
+        await self._fill(n)
+        count = min(n, self._end - self._start)
+        view = self._view[self._start:self._start + count]
+        self._start += count
+        if self._start == self._end:
+            self._start = self._end = 0
+        return view
+
+    async def read(self, n=-1):
+        if n is None or n < 0:
+            return await self.read_all()
+        return bytes(await self._read_view(n))
+
+    async def read_all(self):
+        out = bytearray()
+        while True:
+            view = await self._read_view(len(self._buf))
+            if len(view) == 0:
+                return bytes(out)
+            out += view
+
+    def close(self):
+        self.source.close()
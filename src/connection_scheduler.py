@@ -0,0 +1,143 @@
+import asyncio
+import collections
+import contextlib
+import math
+import os
+import time
+import metrics
+
+
+# MTProto sender connections which all uploads may open at once
+TG_MAX_PARALLEL_CONNECTIONS = int(os.getenv('TG_MAX_PARALLEL_CONNECTIONS', 30))
+TG_UPLOAD_MAX_CONNECTIONS = int(os.getenv('TG_UPLOAD_MAX_CONNECTIONS', 4))
+# how long upload waits for a free connection before it falls back to the main one
+TG_CONNECTION_WAIT = float(os.getenv('TG_CONNECTION_WAIT', 15))
+# each such file size step lets upload use one more connection
+TG_CONNECTION_SIZE_STEP = 50 * 1024 * 1024
+
+
+# connections given to one upload, count may grow while upload runs
+class ConnectionGrant:
+
+    def __init__(self, scheduler, wanted):
+        self.scheduler = scheduler
+        self.wanted = wanted
+        self.count = 0
+
+    # asks for another count of connections, extra ones are given back at once
+    def want(self, wanted):
+        self.scheduler._want(self, wanted)
+
+
+class ConnectionScheduler:
+
+    def __init__(self, capacity, max_per_upload):
+        self.capacity = capacity
+        self.max_per_upload = max_per_upload
+        self.in_use = 0
+        # (grant, future) of uploads waiting for the first connection, in arrival order
+        self._waiters = collections.deque()
+        # grants which hold connections now
+        self._active = set()
+        self.grants = 0
+        self.timeouts = 0
+        # connections freed by finished uploads and taken over by running ones
+        self.regranted = 0
+        self.wait_time = metrics.Histogram()
+
+    @property
+    def free(self):
+        return max(0, self.capacity - self.in_use)
+
+    def wanted_connections(self, file_size, max_connections=None):
+        limit = min(max_connections or self.max_per_upload, self.max_per_upload)
+        return max(1, min(limit, 1 + math.ceil(file_size / TG_CONNECTION_SIZE_STEP)))
+
+    # grant.count is 0 if no connection got free in time, upload should use the main connection then
+    @contextlib.asynccontextmanager
+    async def acquire(self, file_size, max_connections=None, timeout=TG_CONNECTION_WAIT):
+        grant = await self._acquire(self.wanted_connections(file_size, max_connections), timeout)
+        try:
+            yield grant
+        finally:
+            self._release(grant)
+
+    async def _acquire(self, wanted, timeout):
+        grant = ConnectionGrant(self, wanted)
+        if not self._waiters and self.free > 0:
+            self._grant(grant, min(wanted, self.free))
+            self.wait_time.observe(0)
+            return grant
+
+        fut = asyncio.get_event_loop().create_future()
+        waiter = (grant, fut)
+        self._waiters.append(waiter)
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(fut), timeout)
+        except asyncio.TimeoutError:
+            if grant.count == 0:
+                self.timeouts += 1
+        except asyncio.CancelledError:
+            self._release(grant)
+            raise
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+        self.wait_time.observe(time.monotonic() - started)
+        return grant
+
+    def _grant(self, grant, count):
+        if grant.count == 0:
+            self.grants += 1
+        grant.count += count
+        self.in_use += count
+        self._active.add(grant)
+
+    def _want(self, grant, wanted):
+        grant.wanted = max(1, min(wanted, self.max_per_upload))
+        if grant.count > grant.wanted:
+            self.in_use -= grant.count - grant.wanted
+            grant.count = grant.wanted
+        self._dispatch()
+
+    def _release(self, grant):
+        if grant.count == 0:
+            return
+        self.in_use -= grant.count
+        grant.count = 0
+        self._active.discard(grant)
+        self._dispatch()
+
+    def _dispatch(self):
+        # waiting uploads go first, they have no connection at all
+        while self._waiters and self.free > 0:
+            grant, fut = self._waiters.popleft()
+            if fut.done():
+                continue
+            self._grant(grant, min(grant.wanted, self.free))
+            fut.set_result(None)
+        # the rest is taken over by running uploads which got less than they wanted
+        for grant in sorted(self._active, key=lambda g: g.count - g.wanted):
+            if self.free == 0:
+                break
+            extra = min(grant.wanted - grant.count, self.free)
+            if extra > 0:
+                self._grant(grant, extra)
+                self.regranted += extra
+
+    def stats(self):
+        return {
+            'capacity': self.capacity,
+            'in_use': self.in_use,
+            'utilisation': self.in_use / self.capacity if self.capacity else 0.0,
+            'uploads': len(self._active),
+            'waiting': len(self._waiters),
+            'grants': self.grants,
+            'timeouts': self.timeouts,
+            'regranted': self.regranted,
+            'wait_time': self.wait_time.stats()
+        }
+
+
+scheduler = ConnectionScheduler(TG_MAX_PARALLEL_CONNECTIONS, TG_UPLOAD_MAX_CONNECTIONS)
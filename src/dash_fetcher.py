@@ -0,0 +1,50 @@
+import os
+from urllib.parse import urljoin
+import hls_fetcher
+
+
+# fragments of one dash format which are downloaded at once
+DASH_CONCURRENCY = int(os.getenv('DASH_CONCURRENCY', 4))
+DASH_WINDOW = int(os.getenv('DASH_WINDOW', 8))
+
+DASH_PROTOCOL = 'http_dash_segments'
+
+# 'playlists' are dash formats here
+stats = hls_fetcher.HlsStats()
+
+
+def is_dash(fmt):
+    return fmt is not None and fmt.get('protocol') == DASH_PROTOCOL
+
+
+# urls of youtube_dl fragments, they are relative to fragment_base_url if there is no own url
+def fragment_urls(fmt):
+    base = fmt.get('fragment_base_url')
+    urls = []
+    for fragment in fmt.get('fragments') or []:
+        url = fragment.get('url')
+        if url is None:
+            url = urljoin(base, fragment['path']) if base else fragment['path']
+        urls.append(url)
+    return urls
+
+
+# size of dash format without requests, 0 if it's unknown
+def size_estimate(fmt, duration=None):
+    for key in ('filesize', 'filesize_approx'):
+        if fmt.get(key):
+            return int(fmt[key])
+    fragments = fmt.get('fragments') or []
+    sizes = [f.get('filesize') for f in fragments]
+    if sizes and all(sizes):
+        return sum(sizes)
+    duration = fmt.get('duration') or duration or sum(f.get('duration') or 0 for f in fragments)
+    # tbr is in KBit/s
+    if fmt.get('tbr') and duration:
+        return int(fmt['tbr'] * 1000 / 8 * duration)
+    return 0
+
+
+def create(fmt, headers=None):
+    return hls_fetcher.HlsFetcher(fragment_urls(fmt), fmt.get('http_headers') or headers,
+                                  concurrency=DASH_CONCURRENCY, window=DASH_WINDOW, stats=stats)
@@ -0,0 +1,129 @@
+import asyncio
+import functools
+import io
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from urllib.error import HTTPError
+import youtube_dl
+import ydl_pool
+
+
+# 0 disables process pool, extraction runs in default thread executor then
+EXTRACTOR_PROCESSES = int(os.getenv('EXTRACTOR_PROCESSES', min(4, os.cpu_count() or 1)))
+
+# info keys which bot never uses, don't send them between processes
+UNUSED_INFO_KEYS = ['automatic_captions', 'subtitles', 'requested_subtitles', 'thumbnails', 'description',
+                    'chapters', 'tags', 'categories', 'heatmap', 'comments']
+
+
+def slim_info(info):
+    if not isinstance(info, dict):
+        return info
+    for k in UNUSED_INFO_KEYS:
+        info.pop(k, None)
+    entries = info.get('entries')
+    if entries is not None:
+        # playlist entries may be a generator
+        info['entries'] = [slim_info(e) for e in entries]
+    return info
+
+
+def _worker_init():
+    # worker must not handle signals which are addressed to bot
+    import signal
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def _worker_extract_info(url, params):
+    try:
+        # worker process has its own copy of the pool with warm instances
+        with ydl_pool.pool.lease() as ydls:
+            ydl = ydls.get(params)
+            info = ydl.extract_info(url, download=False,
+                                    force_generic_extractor=params.get('force_generic_extractor', False))
+        return 'ok', slim_info(info)
+    except youtube_dl.DownloadError as e:
+        http_error = None
+        if e.exc_info is not None and e.exc_info[0] is HTTPError:
+            http_error = (e.exc_info[1].geturl(), e.exc_info[1].code, str(e.exc_info[1].reason))
+        return 'download_error', (str(e), http_error)
+    except Exception as e:
+        return 'error', str(e)
+
+
+def _worker_warmup():
+    return os.getpid()
+
+
+# restore DownloadError in a form main.py checks for 429 errors
+def _download_error(msg, http_error):
+    if http_error is None:
+        return youtube_dl.DownloadError(msg)
+    url, code, reason = http_error
+    fp = io.BytesIO()
+    fp.code = code
+    err = HTTPError(url, code, reason, None, fp)
+    return youtube_dl.DownloadError(msg, (HTTPError, err, None))
+
+
+class ExtractorPool:
+
+    def __init__(self, processes):
+        self.processes = processes
+        self._executor = None
+        self.extractions = 0
+        self.fallbacks = 0
+
+    # must be called before any threads are started, workers are forked
+    def start(self):
+        if self.processes <= 0:
+            return
+        self._executor = ProcessPoolExecutor(max_workers=self.processes,
+                                             mp_context=multiprocessing.get_context('fork'),
+                                             initializer=_worker_init)
+        for _ in range(self.processes):
+            self._executor.submit(_worker_warmup)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    async def extract_info(self, ydl, url):
+        loop = asyncio.get_event_loop()
+        if self._executor is not None:
+            try:
+                status, res = await loop.run_in_executor(self._executor, _worker_extract_info, url,
+                                                         dict(ydl.params))
+            except BrokenProcessPool as e:
+                print('extractor pool is broken, fallback to threads: ' + str(e))
+                self._executor = None
+            else:
+                self.extractions += 1
+                if status == 'ok':
+                    return res
+                elif status == 'download_error':
+                    raise _download_error(*res)
+                raise Exception(res)
+
+        self.fallbacks += 1
+        info = await loop.run_in_executor(None,
+                                          functools.partial(ydl.extract_info,
+                                                            download=False,
+                                                            force_generic_extractor=ydl.params.get(
+                                                                'force_generic_extractor', False)),
+                                          url)
+        return slim_info(info)
+
+    def stats(self):
+        return {
+            'processes': self.processes if self._executor is not None else 0,
+            'extractions': self.extractions,
+            'thread_fallbacks': self.fallbacks
+        }
+
+
+pool = ExtractorPool(EXTRACTOR_PROCESSES)
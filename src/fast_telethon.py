@@ -7,32 +7,42 @@ import hashlib
 import inspect
 import logging
 import os
+import time
 from collections import defaultdict
-from typing import Optional, List, AsyncGenerator, Union, Awaitable, DefaultDict, Tuple, BinaryIO
+from typing import Optional, List, AsyncGenerator, Union, Awaitable, DefaultDict, Tuple, BinaryIO, Callable
 
 import math
-from telethon import utils, helpers, TelegramClient
+from telethon import utils, helpers, errors, TelegramClient
 from telethon.crypto import AuthKey
 from telethon.network import MTProtoSender
+from telethon.tl.functions import PingRequest
 from telethon.tl.functions.auth import ExportAuthorizationRequest, ImportAuthorizationRequest
 from telethon.tl.functions.upload import (GetFileRequest, SaveFilePartRequest,
                                           SaveBigFilePartRequest)
 from telethon.tl.types import (Document, InputFileLocation, InputDocumentFileLocation,
                                InputPhotoFileLocation, InputPeerPhotoFileLocation, TypeInputFile,
                                InputFileBig, InputFile)
+import connection_scheduler
+import metrics
+import upload_tuner
 
 log: logging.Logger = logging.getLogger("telethon")
 logging.basicConfig(level=logging.WARNING)
 TypeLocation = Union[Document, InputDocumentFileLocation, InputPeerPhotoFileLocation,
                      InputFileLocation, InputPhotoFileLocation]
 
-
-async def stream_file(file_to_stream: BinaryIO, chunk_size=1024):
-    while True:
-        data_read = await file_to_stream.read(chunk_size)
-        if not data_read:
-            break
-        yield data_read
+# memory for parts which are read ahead of their upload
+UPLOAD_READ_AHEAD = int(os.getenv('UPLOAD_READ_AHEAD', 8 * 1024 * 1024))
+# telegram accepts small files without md5 checksum, 0 skips hashing
+UPLOAD_MD5 = int(os.getenv('UPLOAD_MD5', 1))
+# failed part is sent again this many times before the whole upload fails
+TG_PART_RETRIES = int(os.getenv('TG_PART_RETRIES', 5))
+TG_PART_RETRY_DELAY = 1
+TG_PART_MAX_RETRY_DELAY = 30
+# part which isn't confirmed in time is sent through a new connection
+TG_PART_TIMEOUT = float(os.getenv('TG_PART_TIMEOUT', 60))
+# longer flood wait fails the upload, it's better to fall back than to hang
+TG_PART_MAX_FLOOD_WAIT = int(os.getenv('TG_PART_MAX_FLOOD_WAIT', 120))
 
 
 class DownloadSender:
@@ -62,40 +72,252 @@ class DownloadSender:
 
 class UploadSender:
     sender: MTProtoSender
-    request: Union[SaveFilePartRequest, SaveBigFilePartRequest]
-    part_count: int
-    stride: int
-    previous: Optional[asyncio.Task]
-    loop: asyncio.AbstractEventLoop
+    file_id: int
+    big: bool
 
-    def __init__(self, sender: MTProtoSender, file_id: int, part_count: int, big: bool, index: int,
-                 stride: int, loop: asyncio.AbstractEventLoop) -> None:
+    def __init__(self, sender: MTProtoSender, file_id: int, big: bool,
+                 replace: Callable[[MTProtoSender], Awaitable[MTProtoSender]]) -> None:
         self.sender = sender
-        self.part_count = part_count
-        if big:
-            self.request = SaveBigFilePartRequest(file_id, index, part_count, b"")
+        self.file_id = file_id
+        self.big = big
+        self._replace = replace
+        self._replacing = asyncio.Lock()
+
+    # part is kept in request until telegram confirms it, so it's sent again after any failure
+    async def send(self, data: bytes, part: int, part_count: int) -> None:
+        if self.big:
+            request = SaveBigFilePartRequest(self.file_id, part, part_count, data)
         else:
-            self.request = SaveFilePartRequest(file_id, index, b"")
-        self.stride = stride
-        self.previous = None
-        self.loop = loop
+            request = SaveFilePartRequest(self.file_id, part, data)
+        log.debug(f"Sending file part {part}/{part_count}"
+                  f" with {len(data)} bytes")
+        attempt = 0
+        while True:
+            sender = self.sender
+            try:
+                await asyncio.wait_for(sender.send(request), TG_PART_TIMEOUT)
+                return
+            except errors.FloodWaitError as e:
+                if e.seconds > TG_PART_MAX_FLOOD_WAIT:
+                    raise
+                # telegram tells how long to wait, it doesn't count as attempt
+                log.warning(f"Flood wait {e.seconds}s for part {part}")
+                transfer_stats.flood_waits += 1
+                await asyncio.sleep(e.seconds)
+                continue
+            except errors.ServerError as e:
+                error = e
+            except (ConnectionError, OSError, asyncio.TimeoutError) as e:
+                error = e
+                try:
+                    await self._replace_sender(sender)
+                except (ConnectionError, OSError, asyncio.TimeoutError) as e:
+                    log.warning(f"Failed replace sender: {e!r}")
+            attempt += 1
+            if attempt > TG_PART_RETRIES:
+                raise error
+            delay = min(TG_PART_RETRY_DELAY * 2 ** (attempt - 1), TG_PART_MAX_RETRY_DELAY)
+            log.warning(f"Part {part} failed: {error!r}, retry {attempt} in {delay}s")
+            transfer_stats.retries += 1
+            await asyncio.sleep(delay)
+
+    # consumers which share the sender replace broken connection only once
+    async def _replace_sender(self, broken: MTProtoSender) -> None:
+        async with self._replacing:
+            if self.sender is broken:
+                self.sender = await self._replace(broken)
+                transfer_stats.reconnects += 1
+
+    def disconnect(self) -> Awaitable[None]:
+        return self.sender.disconnect()
 
-    async def next(self, data: bytes) -> None:
-        if self.previous:
-            await self.previous
-        self.previous = self.loop.create_task(self._next(data))
 
-    async def _next(self, data: bytes) -> None:
-        self.request.bytes = data
-        log.debug(f"Sending file part {self.request.file_part}/{self.part_count}"
-                  f" with {len(data)} bytes")
-        await self.sender.send(self.request)
-        self.request.file_part += self.stride
+# pooled connection which was not used longer is pinged before it's handed out
+TG_SENDER_CHECK_AFTER = float(os.getenv('TG_SENDER_CHECK_AFTER', 60))
+# pooled connection which was not used longer is closed
+TG_SENDER_IDLE = float(os.getenv('TG_SENDER_IDLE', 300))
+# idle connections which are kept for one DC
+TG_SENDER_POOL_SIZE = int(os.getenv('TG_SENDER_POOL_SIZE', 30))
+TG_SENDER_PING_TIMEOUT = 5
+
 
-    async def disconnect(self) -> None:
-        if self.previous:
-            await self.previous
-        return await self.sender.disconnect()
+class _IdleSender:
+
+    def __init__(self, sender: MTProtoSender) -> None:
+        self.sender = sender
+        self.since = time.monotonic()
+
+
+# authorized connections to DCs which transfers take and give back
+class SenderPool:
+
+    def __init__(self, size: int, idle: float, check_after: float,
+                 budget: Optional[Callable[[], int]] = None) -> None:
+        self.size = size
+        # connections which may be open besides the granted ones, idle senders above it are closed
+        self.budget = budget
+        self.idle = idle
+        self.check_after = check_after
+        # (client, dc id) -> idle senders, the most recently used at the end
+        self._idle: DefaultDict[tuple, List[_IdleSender]] = defaultdict(list)
+        # (client, dc id) -> auth key which was imported to DC
+        self._auth_keys = {}
+        self._auth_locks: DefaultDict[tuple, asyncio.Lock] = defaultdict(lambda: asyncio.Lock())
+        self._reaper = None
+        self.in_use = 0
+        self.created = 0
+        self.reused = 0
+        self.evicted = 0
+        self.broken = 0
+
+    def auth_key(self, client: TelegramClient, dc_id: int) -> Optional[AuthKey]:
+        if dc_id == client.session.dc_id:
+            return client.session.auth_key
+        return self._auth_keys.get((client, dc_id))
+
+    async def acquire(self, client: TelegramClient, dc_id: int) -> MTProtoSender:
+        idle = self._idle[(client, dc_id)]
+        while idle:
+            entry = idle.pop()
+            if await self._healthy(entry):
+                self.reused += 1
+                self.in_use += 1
+                return entry.sender
+            self.broken += 1
+            await self._disconnect(entry.sender)
+        # new connection takes the place which idle ones of other DCs may hold
+        await self._trim()
+        sender = await self._connect(client, dc_id)
+        self.created += 1
+        self.in_use += 1
+        return sender
+
+    async def release(self, client: TelegramClient, dc_id: int, sender: MTProtoSender,
+                      healthy: bool = True) -> None:
+        self.in_use -= 1
+        idle = self._idle[(client, dc_id)]
+        if not healthy or not sender.is_connected() or len(idle) >= self.size:
+            await self._disconnect(sender)
+            return
+        idle.append(_IdleSender(sender))
+        await self._trim()
+        if self._reaper is None:
+            self._reaper = asyncio.get_event_loop().create_task(self._reap())
+
+    async def _healthy(self, entry: _IdleSender) -> bool:
+        if not entry.sender.is_connected():
+            return False
+        if time.monotonic() - entry.since < self.check_after:
+            return True
+        try:
+            await asyncio.wait_for(entry.sender.send(PingRequest(helpers.generate_random_long())),
+                                   TG_SENDER_PING_TIMEOUT)
+            return True
+        except Exception as e:
+            log.warning(f"Pooled sender failed ping: {e!r}")
+            return False
+
+    async def _connect(self, client: TelegramClient, dc_id: int) -> MTProtoSender:
+        auth_key = self.auth_key(client, dc_id)
+        if auth_key:
+            return await self._new_sender(client, dc_id, auth_key)
+        # the first cross-DC sender exports the authorization, the rest reuse its key
+        key = (client, dc_id)
+        async with self._auth_locks[key]:
+            auth_key = self.auth_key(client, dc_id)
+            sender = await self._new_sender(client, dc_id, auth_key)
+            if not auth_key:
+                log.debug(f"Exporting auth to DC {dc_id}")
+                try:
+                    auth = await client(ExportAuthorizationRequest(dc_id))
+                    req = client._init_with(ImportAuthorizationRequest(
+                        id=auth.id, bytes=auth.bytes
+                    ))
+                    await sender.send(req)
+                except BaseException:
+                    await self._disconnect(sender)
+                    raise
+                self._auth_keys[key] = sender.auth_key
+        return sender
+
+    @staticmethod
+    async def _new_sender(client: TelegramClient, dc_id: int,
+                          auth_key: Optional[AuthKey]) -> MTProtoSender:
+        dc = await client._get_dc(dc_id)
+        sender = MTProtoSender(auth_key, client.loop, loggers=client._log)
+        await sender.connect(client._connection(dc.ip_address, dc.port, dc.id,
+                                                loop=client.loop, loggers=client._log,
+                                                proxy=client._proxy))
+        return sender
+
+    @staticmethod
+    async def _disconnect(sender: MTProtoSender) -> None:
+        try:
+            await sender.disconnect()
+        except Exception as e:
+            log.warning(f"Failed disconnect sender: {e!r}")
+
+    # closes the longest idle senders until they fit into the budget
+    async def _trim(self) -> None:
+        if self.budget is None:
+            return
+        entries = sorted(((e.since, key, e) for key, idle in self._idle.items() for e in idle),
+                         key=lambda t: t[0])
+        excess = len(entries) - max(0, self.budget())
+        trimmed = entries[:max(0, excess)]
+        for _, key, entry in trimmed:
+            self._idle[key].remove(entry)
+            if not self._idle[key]:
+                del self._idle[key]
+        self.evicted += len(trimmed)
+        await asyncio.gather(*[self._disconnect(entry.sender) for _, _, entry in trimmed])
+
+    def _expired(self) -> List[MTProtoSender]:
+        expired = []
+        now = time.monotonic()
+        for key, idle in list(self._idle.items()):
+            keep = [e for e in idle if now - e.since < self.idle]
+            expired.extend(e.sender for e in idle if now - e.since >= self.idle)
+            if keep:
+                self._idle[key] = keep
+            else:
+                del self._idle[key]
+        return expired
+
+    async def _reap(self) -> None:
+        try:
+            while self._idle:
+                await asyncio.sleep(self.idle / 2)
+                for sender in self._expired():
+                    self.evicted += 1
+                    await self._disconnect(sender)
+        finally:
+            self._reaper = None
+
+    async def close(self) -> None:
+        if self._reaper is not None:
+            self._reaper.cancel()
+        idle = [e.sender for senders in self._idle.values() for e in senders]
+        self._idle.clear()
+        await asyncio.gather(*[self._disconnect(s) for s in idle])
+
+    def stats(self):
+        idle = defaultdict(int)
+        for (_, dc_id), senders in self._idle.items():
+            idle[str(dc_id)] += len(senders)
+        return {
+            'idle': dict(idle),
+            'idle_budget': self.budget() if self.budget is not None else None,
+            'in_use': self.in_use,
+            'created': self.created,
+            'reused': self.reused,
+            'evicted': self.evicted,
+            'broken': self.broken
+        }
+
+
+sender_pool = SenderPool(TG_SENDER_POOL_SIZE, TG_SENDER_IDLE, TG_SENDER_CHECK_AFTER,
+                         lambda: connection_scheduler.scheduler.free)
 
 
 class ParallelTransferrer:
@@ -103,21 +325,21 @@ class ParallelTransferrer:
     loop: asyncio.AbstractEventLoop
     dc_id: int
     senders: Optional[List[Union[DownloadSender, UploadSender]]]
-    auth_key: AuthKey
-    upload_ticker: int
 
     def __init__(self, client: TelegramClient, dc_id: Optional[int] = None) -> None:
         self.client = client
         self.loop = self.client.loop
         self.dc_id = dc_id or self.client.session.dc_id
-        self.auth_key = (None if dc_id and self.client.session.dc_id != dc_id
-                         else self.client.session.auth_key)
         self.senders = None
-        self.upload_ticker = 0
+        self.upload_args = None
 
-    async def _cleanup(self) -> None:
-        await asyncio.gather(*[sender.disconnect() for sender in self.senders])
-        self.senders = None
+    # connections go back to pool, after a failure their state is unknown so they are closed
+    async def _cleanup(self, healthy: bool = True) -> None:
+        if self.senders is None:
+            return
+        senders, self.senders = self.senders, None
+        await asyncio.gather(*[sender_pool.release(self.client, self.dc_id, s.sender, healthy)
+                               for s in senders])
 
     @staticmethod
     def _get_connection_count(file_size: int, max_count: int = 2,
@@ -156,36 +378,41 @@ class ParallelTransferrer:
         return DownloadSender(await self._create_sender(), file, index * part_size, part_size,
                               stride, part_count)
 
-    async def _init_upload(self, connections: int, file_id: int, part_count: int, big: bool
-                           ) -> None:
+    async def _init_upload(self, connections: int, file_id: int, big: bool) -> None:
+        self.upload_args = (file_id, big)
         self.senders = [
-            await self._create_upload_sender(file_id, part_count, big, 0, connections),
+            await self._create_upload_sender(file_id, big),
             *await asyncio.gather(
-                *[self._create_upload_sender(file_id, part_count, big, i, connections)
-                  for i in range(1, connections)])
+                *[self._create_upload_sender(file_id, big)
+                  for _ in range(1, connections)])
         ]
 
-    async def _create_upload_sender(self, file_id: int, part_count: int, big: bool, index: int,
-                                    stride: int) -> UploadSender:
-        return UploadSender(await self._create_sender(), file_id, part_count, big, index, stride,
-                            loop=self.loop)
+    async def _create_upload_sender(self, file_id: int, big: bool) -> UploadSender:
+        return UploadSender(await self._create_sender(), file_id, big, self._replace_sender)
 
-    async def _create_sender(self) -> MTProtoSender:
-        dc = await self.client._get_dc(self.dc_id)
-        sender = MTProtoSender(self.auth_key, self.loop, loggers=self.client._log)
-        await sender.connect(self.client._connection(dc.ip_address, dc.port, dc.id,
-                                                     loop=self.loop, loggers=self.client._log,
-                                                     proxy=self.client._proxy))
-        if not self.auth_key:
-            log.debug(f"Exporting auth to DC {self.dc_id}")
-            auth = await self.client(ExportAuthorizationRequest(self.dc_id))
-            req = self.client._init_with(ImportAuthorizationRequest(
-                id=auth.id, bytes=auth.bytes
-            ))
-            await sender.send(req)
-            self.auth_key = sender.auth_key
+    # new connection is made first, broken one stays owned by upload if that fails
+    async def _replace_sender(self, broken: MTProtoSender) -> MTProtoSender:
+        sender = await self._create_sender()
+        await sender_pool.release(self.client, self.dc_id, broken, healthy=False)
         return sender
 
+    # take over connections which were freed by other uploads
+    async def add_upload_senders(self, count: int) -> List[UploadSender]:
+        file_id, big = self.upload_args
+        senders = await asyncio.gather(*[self._create_upload_sender(file_id, big) for _ in range(count)])
+        self.senders.extend(senders)
+        return senders
+
+    # sender which upload doesn't need anymore goes back to pool
+    async def remove_upload_sender(self, sender: UploadSender) -> None:
+        if self.senders is None or sender not in self.senders:
+            return
+        self.senders.remove(sender)
+        await sender_pool.release(self.client, self.dc_id, sender.sender)
+
+    async def _create_sender(self) -> MTProtoSender:
+        return await sender_pool.acquire(self.client, self.dc_id)
+
     async def init_upload(self, file_id: int, file_size: int, part_size_kb: Optional[float] = None,
                           connection_count: Optional[int] = None, max_connection=None) -> Tuple[int, int, bool]:
         connection_count = connection_count or self._get_connection_count(file_size, max_count=max_connection)
@@ -193,15 +420,11 @@ class ParallelTransferrer:
         part_size = (part_size_kb or utils.get_appropriated_part_size(file_size)) * 1024
         part_count = (file_size + part_size - 1) // part_size
         is_large = file_size > 10 * 1024 * 1024
-        await self._init_upload(connection_count, file_id, part_count, is_large)
+        await self._init_upload(connection_count, file_id, is_large)
         return part_size, part_count, is_large
 
-    async def upload(self, part: bytes) -> None:
-        await self.senders[self.upload_ticker].next(part)
-        self.upload_ticker = (self.upload_ticker + 1) % len(self.senders)
-
-    async def finish_upload(self) -> None:
-        await self._cleanup()
+    async def finish_upload(self, healthy: bool = True) -> None:
+        await self._cleanup(healthy)
 
     async def download(self, file: TypeLocation, file_size: int,
                        part_size_kb: Optional[float] = None,
@@ -235,64 +458,237 @@ class ParallelTransferrer:
 parallel_transfer_locks: DefaultDict[int, asyncio.Lock] = defaultdict(lambda: asyncio.Lock())
 
 
+class TransferStats:
+
+    def __init__(self):
+        self.uploads = 0
+        self.parts = 0
+        self.bytes = 0
+        self.retries = 0
+        self.flood_waits = 0
+        self.reconnects = 0
+        # waits of senders for the next part, source is the bottleneck
+        self.source_stall = metrics.Histogram()
+        # waits of source for a free place in queue, telegram is the bottleneck
+        self.telegram_stall = metrics.Histogram()
+
+    def stats(self):
+        return {
+            'uploads': self.uploads,
+            'parts': self.parts,
+            'bytes': self.bytes,
+            'retries': self.retries,
+            'flood_waits': self.flood_waits,
+            'reconnects': self.reconnects,
+            'source_stall': self.source_stall.stats(),
+            'telegram_stall': self.telegram_stall.stats()
+        }
+
+
+transfer_stats = TransferStats()
+
+
+# exactly part_size bytes unless source is over
+async def _read_part(response: BinaryIO, part_size: int) -> bytes:
+    data = await response.read(part_size)
+    if len(data) == 0 or len(data) == part_size:
+        return data
+    # source gives less than asked, part is joined once at the end
+    pieces = [data]
+    size = len(data)
+    while size < part_size:
+        data = await response.read(part_size - size)
+        if not data:
+            break
+        pieces.append(data)
+        size += len(data)
+    return b''.join(pieces)
+
+
 async def _internal_transfer_to_telegram(client: TelegramClient,
                                          response: BinaryIO,
                                          file_size,
                                          file_name,
                                          progress_callback: callable,
-                                         max_connection=None
+                                         max_connection=None,
+                                         grant=None,
+                                         checkpoint=None
                                          ) -> Tuple[TypeInputFile, int]:
-    file_id = helpers.generate_random_long()
+    file_id = checkpoint.file_id if checkpoint is not None and checkpoint.resumed else helpers.generate_random_long()
     # file_size = os.path.getsize(response.name)
 
     hash_md5 = hashlib.md5()
+    # md5 of previous parts, calculated in thread one after another
+    hashing = None
     uploader = ParallelTransferrer(client)
-    part_size, part_count, is_large = await uploader.init_upload(file_id, file_size, max_connection=max_connection)
-    buffer = bytearray()
-    part_index = 0
-    async for data in stream_file(response, chunk_size=part_size):
-        part_index += 1
-        if len(data) == 0:
-            part_index -= 1
-            break
-        # if len(data) != part_size and part_index != part_count:
-        #     dat = b'\0' * (part_size - len(data))
-        #     data += dat
-        if not is_large:
-            hash_md5.update(data)
-        if len(buffer) == 0:
-            await uploader.upload(data)
-            if part_index >= part_count:
-                break
-            else:
+    tuner = None
+    if grant is not None:
+        tuner = upload_tuner.UploadTuner(upload_tuner.history, uploader.dc_id, file_size,
+                                         utils.get_appropriated_part_size(file_size),
+                                         grant.scheduler.max_per_upload, grant.count)
+        if checkpoint is not None and checkpoint.resumed:
+            # parts which telegram already has must keep their size
+            tuner.part_kb = checkpoint.part_size // 1024
+        grant.want(tuner.connections)
+        tuner.granted(grant.count)
+        part_size, part_count, is_large = await uploader.init_upload(file_id, file_size,
+                                                                     part_size_kb=tuner.part_kb,
+                                                                     connection_count=tuner.connections)
+    else:
+        part_size, part_count, is_large = await uploader.init_upload(
+            file_id, file_size,
+            part_size_kb=checkpoint.part_size // 1024 if checkpoint is not None and checkpoint.resumed else None,
+            max_connection=max_connection)
+    # only big files are resumed, small ones need md5 of whole file
+    if not is_large:
+        checkpoint = None
+    elif checkpoint is not None and not checkpoint.resumed:
+        checkpoint.start(file_id, part_size)
+    loop = asyncio.get_event_loop()
+    # ready parts (index, data, parts count), None after the last one
+    queue = asyncio.Queue(maxsize=max(1, UPLOAD_READ_AHEAD // part_size))
+    source_stall = telegram_stall = 0.0
+    sent_parts = sent_bytes = 0
+    failure = loop.create_future()
+    workers = []
+    # sender -> its running consumers, there are as many as requests depth
+    consumers: DefaultDict[UploadSender, int] = defaultdict(int)
+    depth = tuner.depth if tuner is not None else 1
+    # senders which finish their current parts and go back to pool
+    retired = set()
+    used_senders = len(uploader.senders)
+
+    def start(coro) -> None:
+        def on_done(task: asyncio.Task) -> None:
+            if not task.cancelled() and task.exception() is not None and not failure.done():
+                failure.set_exception(task.exception())
+        task = loop.create_task(coro)
+        task.add_done_callback(on_done)
+        workers.append(task)
+
+    async def put(item) -> None:
+        nonlocal telegram_stall
+        started = time.monotonic()
+        await queue.put(item)
+        stall = time.monotonic() - started
+        telegram_stall += stall
+        transfer_stats.telegram_stall.observe(stall)
+
+    async def hash_part(previous, data: bytes) -> None:
+        if previous is not None:
+            await previous
+        # hashlib releases GIL for big buffers
+        await loop.run_in_executor(None, hash_md5.update, data)
+
+    # follows connections granted by scheduler and depth chosen by tuner
+    async def scale() -> None:
+        nonlocal depth, used_senders
+        if tuner is not None and tuner.sample(sent_bytes, source_stall, sum(consumers.values())):
+            grant.want(tuner.connections)
+            tuner.granted(grant.count)
+            depth = tuner.depth
+        if grant is None:
+            return
+        active = [s for s in uploader.senders if s not in retired]
+        if grant.count > len(active):
+            added = await uploader.add_upload_senders(grant.count - len(active))
+            used_senders += len(added)
+            active.extend(added)
+        for sender in active[max(1, grant.count):]:
+            retired.add(sender)
+        for sender in active[:max(1, grant.count)]:
+            for _ in range(consumers[sender], depth):
+                start(consume(sender))
+
+    async def produce() -> None:
+        nonlocal part_count, hashing
+        index = 0
+        # part is held until the next one is read, the last part must carry real parts count
+        held = None
+        while index < part_count:
+            if checkpoint is not None and index in checkpoint.parts:
+                # telegram has the part from previous run
+                index += 1
+                await response.seek(index * part_size)
                 continue
-        new_len = len(buffer) + len(data)
-        if new_len >= part_size:
-            cutoff = part_size - len(buffer)
-            buffer.extend(data[:cutoff])
-            await uploader.upload(bytes(buffer))
-            buffer.clear()
-            buffer.extend(data[cutoff:])
-        else:
-            buffer.extend(data)
-
-        if part_index >= part_count:
-            break
-        else:
-            continue
-
-    for u in uploader.senders:
-        u.request.file_total_parts = part_index
-        u.part_count = part_index
-    part_count = part_index
+            data = await _read_part(response, part_size)
+            if len(data) == 0:
+                break
+            if not is_large and UPLOAD_MD5:
+                hashing = loop.create_task(hash_part(hashing, data))
+            await scale()
+            if held is not None:
+                await put((held[0], held[1], part_count))
+            held = (index, data)
+            index += 1
+        part_count = index
+        if held is not None:
+            await put((held[0], held[1], part_count))
+        await queue.put(None)
+
+    async def consume(sender: UploadSender) -> None:
+        nonlocal source_stall, sent_parts, sent_bytes
+        consumers[sender] += 1
+        try:
+            while sender not in retired and consumers[sender] <= depth:
+                started = time.monotonic()
+                item = await queue.get()
+                stall = time.monotonic() - started
+                source_stall += stall
+                transfer_stats.source_stall.observe(stall)
+                if item is None:
+                    # let the other senders finish too
+                    queue.put_nowait(None)
+                    return
+                part, data, count = item
+                await sender.send(data, part, count)
+                if checkpoint is not None:
+                    checkpoint.done(part)
+                sent_parts += 1
+                sent_bytes += len(data)
+                transfer_stats.parts += 1
+                transfer_stats.bytes += len(data)
+        finally:
+            consumers[sender] -= 1
+        if sender in retired and consumers[sender] == 0:
+            await uploader.remove_upload_sender(sender)
+
+    start(produce())
+    for sender in uploader.senders:
+        for _ in range(depth):
+            start(consume(sender))
+    completed = False
+    try:
+        while True:
+            running = [w for w in workers if not w.done()]
+            if not running:
+                break
+            await asyncio.wait(running + [failure], return_when=asyncio.FIRST_COMPLETED)
+            if failure.done():
+                failure.result()
+        if hashing is not None:
+            await hashing
+        completed = True
+    finally:
+        for w in workers:
+            w.cancel()
+        if hashing is not None:
+            hashing.cancel()
+        await uploader.finish_upload(healthy=completed)
+        if checkpoint is not None:
+            checkpoint.save()
+    transfer_stats.uploads += 1
+    if tuner is not None:
+        tuner.finish(sent_bytes)
+        log.info(f"Upload tuned to {tuner.part_kb}KB parts, {tuner.connections} senders, "
+                 f"depth {tuner.depth}")
+    log.info(f"Uploaded {sent_parts} parts by {used_senders} senders, "
+             f"stalled on source {source_stall:.1f}s, on telegram {telegram_stall:.1f}s")
 
-    if len(buffer) > 0:
-        await uploader.upload(bytes(buffer))
-    await uploader.finish_upload()
     if is_large:
         return InputFileBig(file_id, part_count, file_name), file_size
     else:
-        return InputFile(file_id, part_count, file_name, hash_md5.hexdigest()), file_size
+        return InputFile(file_id, part_count, file_name, hash_md5.hexdigest() if UPLOAD_MD5 else ''), file_size
 
 
 async def download_file(client: TelegramClient,
@@ -320,7 +716,11 @@ async def upload_file(client: TelegramClient,
                                         file_size,
                                         file_name,
                                         progress_callback: callable = None,
-                                        max_connection=None
+                                        max_connection=None,
+                                        grant=None,
+                                        checkpoint=None
                                         ) -> TypeInputFile:
-    res = (await _internal_transfer_to_telegram(client, file, file_size, file_name, progress_callback, max_connection=max_connection))[0]
+    res = (await _internal_transfer_to_telegram(client, file, file_size, file_name, progress_callback,
+                                                max_connection=max_connection, grant=grant,
+                                                checkpoint=checkpoint))[0]
     return res
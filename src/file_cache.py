@@ -0,0 +1,176 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+
+FILE_CACHE_PATH = os.getenv('FILE_CACHE_PATH', 'file_cache.db')
+FILE_CACHE_MAX_ENTRIES = int(os.getenv('FILE_CACHE_MAX_ENTRIES', 100000))
+# telegram file ids don't expire, but keep cache fresh anyway
+FILE_CACHE_TTL = int(os.getenv('FILE_CACHE_TTL', 90 * 24 * 3600))
+# how long to wait for file which is being sent to bot right now
+FILE_CACHE_PENDING_TIMEOUT = int(os.getenv('FILE_CACHE_PENDING_TIMEOUT', 60))
+
+# separates cache key and flight token from reply message id in agent caption:
+# "<chat_id>:<msg_id>#<key>#<token>:<caption>"
+KEY_SEPARATOR = '#'
+
+
+def make_key(extractor, video_id, format_id, mode, cut_range=None, send_type=''):
+    cut = ''
+    if cut_range is not None:
+        cut_start, cut_end = cut_range
+        cut = str(cut_start) + '-' + (str(cut_end) if cut_end is not None else '')
+    raw = '\0'.join([str(extractor), str(video_id), str(format_id), str(mode), cut, str(send_type)])
+    return hashlib.sha1(raw.encode()).hexdigest()[:24]
+
+
+# how file is sent to telegram: as audio, as streamable video or as document
+def send_type(audio_mode, ext, force_document=False):
+    if audio_mode:
+        return 'audio'
+    return 'document' if force_document or ext != 'mp4' else 'video'
+
+
+# returns None if entry can't be cached (live streams, unknown ids)
+def key_for_entry(entry, mode, cut_range=None, send_type=''):
+    if entry.get('is_live'):
+        return None
+    extractor = entry.get('extractor_key') or entry.get('extractor')
+    video_id = entry.get('id')
+    format_id = entry.get('format_id')
+    if not extractor or not video_id or not format_id:
+        return None
+    return make_key(extractor, video_id, format_id, mode, cut_range, send_type)
+
+
+def split_key(reply_msg_id):
+    reply_msg_id, key, token = (reply_msg_id.split(KEY_SEPARATOR, maxsplit=2) + [None, None])[:3]
+    return reply_msg_id, key or None, token or None
+
+
+def caption_prefix(chat_id, msg_id, key=None, token=None):
+    prefix = str(chat_id) + ':' + str(msg_id)
+    if key or token:
+        prefix += KEY_SEPARATOR + (key or '')
+    if token:
+        prefix += KEY_SEPARATOR + token
+    return prefix + ':'
+
+
+class FileCache:
+
+    def __init__(self, path, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key -> event which is set when file id arrives from agent
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._db.execute('CREATE TABLE IF NOT EXISTS files ('
+                             'key TEXT PRIMARY KEY, '
+                             'file_id TEXT NOT NULL, '
+                             'media_type TEXT NOT NULL, '
+                             'created REAL NOT NULL, '
+                             'last_used REAL NOT NULL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS files_last_used ON files (last_used)')
+            self._db.commit()
+
+    async def get(self, key):
+        res = await asyncio.get_event_loop().run_in_executor(None, self._get, key)
+        if res is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return res
+
+    def _get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute('SELECT file_id, media_type, created FROM files WHERE key = ?',
+                                   (key,)).fetchone()
+            if row is None:
+                return None
+            file_id, media_type, created = row
+            if now - created > self.ttl:
+                self._db.execute('DELETE FROM files WHERE key = ?', (key,))
+                self._db.commit()
+                self.evictions += 1
+                return None
+            self._db.execute('UPDATE files SET last_used = ? WHERE key = ?', (now, key))
+            self._db.commit()
+            return file_id, media_type
+
+    async def put(self, key, file_id, media_type):
+        await asyncio.get_event_loop().run_in_executor(None, self._put, key, file_id, media_type)
+        pending = self._pending.pop(key, None)
+        if pending is not None:
+            pending.set()
+
+    # file with this key is going to be sent to bot soon
+    def expect(self, key, timeout=FILE_CACHE_PENDING_TIMEOUT):
+        if key in self._pending:
+            return
+        pending = asyncio.Event()
+        self._pending[key] = pending
+
+        def expire():
+            if self._pending.get(key) is pending:
+                del self._pending[key]
+                pending.set()
+        asyncio.get_event_loop().call_later(timeout, expire)
+
+    async def wait_pending(self, key):
+        pending = self._pending.get(key)
+        if pending is not None:
+            await pending.wait()
+
+    def _put(self, key, file_id, media_type):
+        now = time.time()
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO files (key, file_id, media_type, created, last_used) '
+                             'VALUES (?, ?, ?, ?, ?)', (key, file_id, media_type, now, now))
+            self._evict()
+            self._db.commit()
+
+    # drop expired entries then least recently used ones above the limit
+    def _evict(self):
+        cur = self._db.execute('DELETE FROM files WHERE created < ?', (time.time() - self.ttl,))
+        self.evictions += max(cur.rowcount, 0)
+        count = self._db.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+        if count > self.max_entries:
+            cur = self._db.execute('DELETE FROM files WHERE key IN '
+                                   '(SELECT key FROM files ORDER BY last_used ASC LIMIT ?)',
+                                   (count - self.max_entries,))
+            self.evictions += max(cur.rowcount, 0)
+
+    async def delete(self, key):
+        await asyncio.get_event_loop().run_in_executor(None, self._delete, key)
+
+    def _delete(self, key):
+        with self._lock:
+            self._db.execute('DELETE FROM files WHERE key = ?', (key,))
+            self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            size = self._db.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            'size': size,
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'pending': len(self._pending),
+            'hit_ratio': self.hits / total if total else 0.0
+        }
+
+
+cache = FileCache(FILE_CACHE_PATH, FILE_CACHE_MAX_ENTRIES, FILE_CACHE_TTL)
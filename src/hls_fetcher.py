@@ -0,0 +1,182 @@
+import asyncio
+import collections
+import os
+import time
+import aiohttp
+from aiohttp import ClientTimeout
+import av_utils
+import http_pool
+import metrics
+
+
+# segments of one playlist which are downloaded at once
+HLS_CONCURRENCY = int(os.getenv('HLS_CONCURRENCY', 4))
+# segments which are downloaded ahead of ffmpeg, they bound memory of one download
+HLS_WINDOW = int(os.getenv('HLS_WINDOW', 8))
+HLS_RETRIES = int(os.getenv('HLS_RETRIES', 3))
+HLS_RETRY_DELAY = 1
+HLS_SEGMENT_TIMEOUT = 60
+
+
+class HlsStats:
+
+    def __init__(self):
+        self.playlists = 0
+        self.fallbacks = 0
+        self.segments = 0
+        self.failed_segments = 0
+        self.bytes = 0
+        self.retries = 0
+        # time of segment requests, throughput is bytes by it
+        self.fetch_time = 0.0
+        self.segment_time = metrics.Histogram()
+        # ffmpeg waits for the next segment
+        self.stall = metrics.Histogram()
+
+    def stats(self):
+        return {
+            'playlists': self.playlists,
+            'fallbacks': self.fallbacks,
+            'segments': self.segments,
+            'failed_segments': self.failed_segments,
+            'bytes': self.bytes,
+            'retries': self.retries,
+            'segment_throughput': self.bytes / self.fetch_time if self.fetch_time else 0.0,
+            'segment_time': self.segment_time.stats(),
+            'stall': self.stall.stats()
+        }
+
+
+stats = HlsStats()
+
+
+# playlist ffmpeg can't get from concatenated segments is left to ffmpeg itself
+def _suitable(playlist, variant_bandwidth):
+    # master playlist may have separate audio renditions
+    if variant_bandwidth is not None or playlist.is_variant:
+        return False
+    # live playlist is refreshed by ffmpeg
+    if not playlist.is_endlist or len(playlist.segments) == 0:
+        return False
+    for key in playlist.keys:
+        if key is not None and key.method != 'NONE':
+            return False
+    for seg in playlist.segments:
+        init = getattr(seg, 'init_section', None)
+        if seg.byterange or (init is not None and init.byterange):
+            return False
+    return True
+
+
+# downloads hls segments several at once and gives them in playlist order
+class HlsFetcher:
+
+    def __init__(self, urls, headers=None, concurrency=HLS_CONCURRENCY, window=HLS_WINDOW, stats=stats):
+        self.urls = urls
+        self.headers = headers
+        self.window = max(window, concurrency)
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self.bytes = 0
+        self.stats = stats
+        stats.playlists += 1
+
+    # None if playlist should be read by ffmpeg
+    @staticmethod
+    async def create(url, headers=None):
+        try:
+            playlist, bandwidth = await av_utils.load_media_playlist(http_pool.pool.session(), url, headers)
+        except Exception as e:
+            print('hls playlist load failed: ' + str(e))
+            playlist = bandwidth = None
+        if playlist is None or not _suitable(playlist, bandwidth):
+            stats.fallbacks += 1
+            return None
+        urls = []
+        init_uri = None
+        for seg in playlist.segments:
+            init = getattr(seg, 'init_section', None)
+            # fmp4 init section goes before its segments
+            if init is not None and init.absolute_uri != init_uri:
+                init_uri = init.absolute_uri
+                urls.append(init_uri)
+            urls.append(seg.absolute_uri)
+        return HlsFetcher(urls, headers)
+
+    async def _fetch(self, index, url):
+        attempt = 0
+        async with self._semaphore:
+            started = time.monotonic()
+            while True:
+                try:
+                    async with http_pool.pool.session().get(
+                            url, headers=self.headers,
+                            timeout=ClientTimeout(total=HLS_SEGMENT_TIMEOUT)) as resp:
+                        resp.raise_for_status()
+                        data = await resp.read()
+                    break
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    attempt += 1
+                    if attempt > HLS_RETRIES:
+                        self.stats.failed_segments += 1
+                        # the first one can be init section, media can't be made without it
+                        if index == 0:
+                            raise Exception('first segment failed: {!r}'.format(e))
+                        # ffmpeg skips broken segment too
+                        print('segment {} is skipped: {!r}'.format(index, e))
+                        return b''
+                    self.stats.retries += 1
+                    await asyncio.sleep(HLS_RETRY_DELAY * 2 ** (attempt - 1))
+            elapsed = time.monotonic() - started
+        self.stats.segments += 1
+        self.stats.bytes += len(data)
+        self.stats.fetch_time += elapsed
+        self.stats.segment_time.observe(elapsed)
+        return data
+
+    async def segments(self):
+        tasks = collections.deque()
+        urls = enumerate(self.urls)
+
+        def fill():
+            while len(tasks) < self.window:
+                item = next(urls, None)
+                if item is None:
+                    return
+                tasks.append(asyncio.ensure_future(self._fetch(*item)))
+
+        try:
+            fill()
+            while tasks:
+                started = time.monotonic()
+                data = await tasks.popleft()
+                self.stats.stall.observe(time.monotonic() - started)
+                fill()
+                if data:
+                    self.bytes += len(data)
+                    yield data
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    # writes segments to ffmpeg stdin, stdin is closed at the end so ffmpeg finishes output.
+    # Raises if the first segment failed
+    async def feed(self, stdin):
+        started = time.monotonic()
+        segments = self.segments()
+        try:
+            async for data in segments:
+                stdin.write(data)
+                await stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # ffmpeg exited or was killed
+            pass
+        finally:
+            # segments which are downloaded ahead are cancelled
+            await segments.aclose()
+            try:
+                stdin.close()
+            except Exception:
+                pass
+        elapsed = time.monotonic() - started
+        print('fetched {} segments, {:.1f} MB/s'.format(
+            len(self.urls), self.bytes / elapsed / 1024 / 1024 if elapsed else 0.0))
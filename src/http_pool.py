@@ -0,0 +1,69 @@
+import os
+from aiohttp import ClientSession, TCPConnector
+
+
+HTTP_POOL_LIMIT = int(os.getenv('HTTP_POOL_LIMIT', 256))
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv('HTTP_POOL_LIMIT_PER_HOST', 32))
+HTTP_POOL_KEEPALIVE = float(os.getenv('HTTP_POOL_KEEPALIVE', 30))
+HTTP_DNS_CACHE_TTL = int(os.getenv('HTTP_DNS_CACHE_TTL', 600))
+
+
+def _resolver():
+    try:
+        # aiodns (pycares) resolves without blocking default executor
+        from aiohttp.resolver import AsyncResolver
+        return AsyncResolver()
+    except Exception as e:
+        print('async dns resolver is not available: ' + str(e))
+        return None
+
+
+# one connection pool for all http probes and downloads of the process
+class HttpPool:
+
+    def __init__(self):
+        self._session = None
+        self.sessions_created = 0
+
+    # must be called from coroutine, session is bound to running loop
+    def session(self):
+        if self._session is None or self._session.closed:
+            connector = TCPConnector(verify_ssl=False,
+                                     limit=HTTP_POOL_LIMIT,
+                                     limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+                                     keepalive_timeout=HTTP_POOL_KEEPALIVE,
+                                     use_dns_cache=True,
+                                     ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+                                     resolver=_resolver())
+            self._session = ClientSession(connector=connector)
+            self.sessions_created += 1
+        return self._session
+
+    async def close(self, _app=None):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def stats(self):
+        stats = {
+            'limit': HTTP_POOL_LIMIT,
+            'limit_per_host': HTTP_POOL_LIMIT_PER_HOST,
+            'sessions_created': self.sessions_created,
+            'acquired': 0,
+            'idle': 0,
+            'acquired_per_host': {}
+        }
+        if self._session is None or self._session.closed:
+            return stats
+        connector = self._session.connector
+        acquired = getattr(connector, '_acquired', ())
+        stats['acquired'] = len(acquired)
+        stats['idle'] = sum(len(c) for c in getattr(connector, '_conns', {}).values())
+        stats['utilisation'] = len(acquired) / HTTP_POOL_LIMIT if HTTP_POOL_LIMIT else 0.0
+        for key, conns in getattr(connector, '_acquired_per_host', {}).items():
+            if len(conns) > 0:
+                stats['acquired_per_host'][str(key.host) + ':' + str(key.port)] = len(conns)
+        return stats
+
+
+pool = HttpPool()
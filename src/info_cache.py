@@ -0,0 +1,200 @@
+import asyncio
+import collections
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import urlparse, urlunparse, parse_qs, parse_qsl, urlencode
+
+
+INFO_CACHE_PATH = os.getenv('INFO_CACHE_PATH', 'info_cache.db')
+INFO_CACHE_MEMORY_ENTRIES = int(os.getenv('INFO_CACHE_MEMORY_ENTRIES', 512))
+INFO_CACHE_DISK_ENTRIES = int(os.getenv('INFO_CACHE_DISK_ENTRIES', 20000))
+INFO_CACHE_DEFAULT_TTL = int(os.getenv('INFO_CACHE_DEFAULT_TTL', 1800))
+# don't return media urls which will expire soon
+INFO_CACHE_EXPIRE_MARGIN = int(os.getenv('INFO_CACHE_EXPIRE_MARGIN', 1800))
+
+# params of YoutubeDL which change extract_info result
+KEY_PARAMS = ['noplaylist', 'playlist_items', 'playliststart', 'playlistend', 'format',
+              'force_generic_extractor', 'username', 'youtube_include_dash_manifest']
+
+
+# parse ttl per extractor from string like "youtube=3600,generic=300"
+def parse_ttls(ttls):
+    res = {}
+    for item in ttls.split(','):
+        if '=' not in item:
+            continue
+        extractor, ttl = item.split('=', maxsplit=1)
+        res[extractor.strip().lower()] = int(ttl)
+    return res
+
+
+INFO_CACHE_TTLS = parse_ttls(os.getenv('INFO_CACHE_TTLS', 'youtube=3600,youtube:tab=1800,generic=300,vk=600'))
+
+
+def normalize_url(url):
+    parsed = urlparse(url.strip())
+    query = urlencode(sorted(parse_qsl(parsed.query, keep_blank_values=True)))
+    return urlunparse((parsed.scheme.lower(), parsed.netloc.lower(), parsed.path or '/', parsed.params, query, ''))
+
+
+def make_key(url, params):
+    key_params = {p: params.get(p) for p in KEY_PARAMS}
+    raw = normalize_url(url) + '\0' + json.dumps(key_params, sort_keys=True, default=str)
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+def _media_urls(info):
+    if info is None:
+        return
+    if 'url' in info:
+        yield info['url']
+    for f in (info.get('requested_formats') or []):
+        if 'url' in f:
+            yield f['url']
+    for e in (info.get('entries') or []):
+        yield from _media_urls(e)
+
+
+# min "expire" timestamp of signed media urls (googlevideo etc.)
+def urls_expire_time(info):
+    expire = None
+    for url in _media_urls(info):
+        try:
+            values = parse_qs(urlparse(url).query).get('expire')
+            if not values:
+                continue
+            url_expire = int(values[0])
+        except (ValueError, TypeError):
+            continue
+        if expire is None or url_expire < expire:
+            expire = url_expire
+    return expire
+
+
+def info_ttl(info):
+    extractor = str(info.get('extractor_key') or info.get('extractor') or '').lower()
+    ttl = INFO_CACHE_TTLS.get(extractor, INFO_CACHE_DEFAULT_TTL)
+    expire = urls_expire_time(info)
+    if expire is not None:
+        ttl = min(ttl, expire - time.time() - INFO_CACHE_EXPIRE_MARGIN)
+    return ttl
+
+
+def is_cacheable(info):
+    if info is None or info.get('is_live'):
+        return False
+    # some playlist entries failed, they may succeed next time
+    entries = info.get('entries')
+    if entries is not None and any(e is None for e in entries):
+        return False
+    return True
+
+
+class InfoCache:
+
+    def __init__(self, path, memory_entries, disk_entries):
+        self.memory_entries = memory_entries
+        self.disk_entries = disk_entries
+        # key -> (expire time, serialized info)
+        self._memory = collections.OrderedDict()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._db.execute('CREATE TABLE IF NOT EXISTS info ('
+                             'key TEXT PRIMARY KEY, '
+                             'expire REAL NOT NULL, '
+                             'data TEXT NOT NULL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS info_expire ON info (expire)')
+            self._db.commit()
+
+    # always return new copy, callers modify info dict
+    async def get(self, key):
+        # memory hit doesn't wait for executor
+        info = self._get_memory(key)
+        if info is not None:
+            return info
+        row = await asyncio.get_event_loop().run_in_executor(None, self._get, key)
+        if row is None:
+            self.misses += 1
+            return None
+        expire, data = row
+        self._remember(key, expire, data)
+        self.disk_hits += 1
+        return json.loads(data)
+
+    def _get_memory(self, key):
+        cached = self._memory.get(key)
+        if cached is None:
+            return None
+        expire, data = cached
+        if expire <= time.time():
+            del self._memory[key]
+            return None
+        self._memory.move_to_end(key)
+        self.memory_hits += 1
+        return json.loads(data)
+
+    def _get(self, key):
+        with self._lock:
+            return self._db.execute('SELECT expire, data FROM info WHERE key = ? AND expire > ?',
+                                    (key, time.time())).fetchone()
+
+    async def put(self, key, info):
+        if not is_cacheable(info):
+            return
+        ttl = info_ttl(info)
+        if ttl <= 0:
+            return
+        expire = time.time() + ttl
+        data = await asyncio.get_event_loop().run_in_executor(None, self._put, key, expire, info)
+        if data is not None:
+            self._remember(key, expire, data)
+
+    def _put(self, key, expire, info):
+        try:
+            data = json.dumps(info)
+        except (TypeError, ValueError) as e:
+            print('failed serialize info: ' + str(e))
+            return None
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO info (key, expire, data) VALUES (?, ?, ?)', (key, expire, data))
+            self._db.execute('DELETE FROM info WHERE expire < ?', (time.time(),))
+            self._db.execute('DELETE FROM info WHERE key IN '
+                             '(SELECT key FROM info ORDER BY expire DESC LIMIT -1 OFFSET ?)', (self.disk_entries,))
+            self._db.commit()
+        return data
+
+    def _remember(self, key, expire, data):
+        self._memory[key] = (expire, data)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    async def invalidate(self, key):
+        self._memory.pop(key, None)
+        await asyncio.get_event_loop().run_in_executor(None, self._invalidate, key)
+
+    def _invalidate(self, key):
+        with self._lock:
+            self._db.execute('DELETE FROM info WHERE key = ?', (key,))
+            self._db.commit()
+
+    def stats(self):
+        total = self.memory_hits + self.disk_hits + self.misses
+        return {
+            'memory_size': len(self._memory),
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_ratio': (self.memory_hits + self.disk_hits) / total if total else 0.0
+        }
+
+
+cache = InfoCache(INFO_CACHE_PATH, INFO_CACHE_MEMORY_ENTRIES, INFO_CACHE_DISK_ENTRIES)
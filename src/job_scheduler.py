@@ -0,0 +1,203 @@
+import asyncio
+import collections
+import contextlib
+import os
+import time
+import metrics
+
+
+# jobs which are processed at once by the whole bot
+JOBS_MAX_CONCURRENCY = int(os.getenv('JOBS_MAX_CONCURRENCY', 8))
+# jobs which are processed at once for one user
+JOBS_USER_CONCURRENCY = int(os.getenv('JOBS_USER_CONCURRENCY', 1))
+JOBS_DONATOR_CONCURRENCY = int(os.getenv('JOBS_DONATOR_CONCURRENCY', 2))
+# share of donator in the queue comparing to ordinary user
+JOBS_DONATOR_WEIGHT = float(os.getenv('JOBS_DONATOR_WEIGHT', 3))
+# jobs which one user may have waiting in the queue, the rest are rejected
+JOBS_USER_QUEUE = int(os.getenv('JOBS_USER_QUEUE', 5))
+# the most expensive job in the fair queue, bigger ones are queued as if they cost this much, see estimate_cost
+JOBS_MAX_COST = float(os.getenv('JOBS_MAX_COST', 10))
+JOBS_DONATOR_MAX_COST = float(os.getenv('JOBS_DONATOR_MAX_COST', 250))
+
+# cost of one media comparing to ordinary download
+CMD_COST = {
+    'z': 4,
+    's': 0.25,
+    't': 0.25
+}
+
+
+class JobRejected(Exception):
+    pass
+
+
+# rough cost of a job known before any request is made: count of media times their weight
+def estimate_cost(urls_count, cmd=None, playlist_start=None, playlist_end=None):
+    entries = 1
+    if playlist_start is not None and playlist_end is not None:
+        if playlist_start == 0 and playlist_end == 0:
+            entries = 10
+        else:
+            entries = playlist_end - playlist_start + 1
+    return urls_count * entries * CMD_COST.get(cmd, 1)
+
+
+class _Job:
+
+    def __init__(self, user_id, cost, tag, donator):
+        self.user_id = user_id
+        self.cost = cost
+        # virtual finish time, the least one goes first
+        self.tag = tag
+        self.donator = donator
+        self.queued = time.monotonic()
+        self.fut = asyncio.get_event_loop().create_future()
+
+
+# weighted fair queue with global and per-user limits of running jobs
+class JobScheduler:
+
+    def __init__(self, max_jobs, user_jobs, donator_jobs, donator_weight, user_queue):
+        self.max_jobs = max_jobs
+        self.user_jobs = user_jobs
+        self.donator_jobs = donator_jobs
+        self.donator_weight = donator_weight
+        self.user_queue = user_queue
+        self.running = 0
+        self._running_per_user = collections.Counter()
+        self._queued_per_user = collections.Counter()
+        self._queue = []
+        # user id -> virtual finish time of last queued job of the user
+        self._finish = {}
+        self._vtime = 0.0
+        self.admitted = 0
+        self.rejected = 0
+        self.queue_wait = metrics.Histogram()
+        self.donator_queue_wait = metrics.Histogram()
+
+    def _user_limit(self, donator):
+        return self.donator_jobs if donator else self.user_jobs
+
+    # raises JobRejected if user has too many jobs queued
+    def admission(self, user_id, donator, cost):
+        if self._queued_per_user[user_id] >= self.user_queue:
+            self.rejected += 1
+            raise JobRejected('Too many requests in the queue, wait until previous ones are finished')
+        return Admission(self, user_id, donator, min(cost, JOBS_DONATOR_MAX_COST if donator else JOBS_MAX_COST))
+
+    def _enqueue(self, user_id, donator, cost):
+        weight = self.donator_weight if donator else 1.0
+        start = max(self._vtime, self._finish.get(user_id, 0.0))
+        job = _Job(user_id, cost, start + cost / weight, donator)
+        self._finish[user_id] = job.tag
+        self._queue.append(job)
+        self._queued_per_user[user_id] += 1
+        self._dispatch()
+        return job
+
+    def _dispatch(self):
+        while self.running < self.max_jobs:
+            eligible = [j for j in self._queue
+                        if self._running_per_user[j.user_id] < self._user_limit(j.donator)]
+            if not eligible:
+                return
+            job = min(eligible, key=lambda j: j.tag)
+            self._queue.remove(job)
+            self._queued_per_user[job.user_id] -= 1
+            self._running_per_user[job.user_id] += 1
+            self.running += 1
+            self.admitted += 1
+            self._vtime = max(self._vtime, job.tag - job.cost / (self.donator_weight if job.donator else 1.0))
+            waited = time.monotonic() - job.queued
+            (self.donator_queue_wait if job.donator else self.queue_wait).observe(waited)
+            job.fut.set_result(None)
+
+    def _cancel(self, job):
+        if job in self._queue:
+            self._queue.remove(job)
+            self._queued_per_user[job.user_id] -= 1
+            self._forget(job.user_id)
+        elif job.fut.done() and not job.fut.cancelled():
+            self._release(job)
+
+    def _release(self, job):
+        self.running -= 1
+        self._running_per_user[job.user_id] -= 1
+        self._forget(job.user_id)
+        self._dispatch()
+
+    # drop counters of user who has nothing running or queued
+    def _forget(self, user_id):
+        if self._running_per_user[user_id] <= 0 and self._queued_per_user[user_id] <= 0:
+            del self._running_per_user[user_id]
+            del self._queued_per_user[user_id]
+        # finish time which is already passed makes no difference
+        for u in [u for u, f in self._finish.items() if f <= self._vtime and u not in self._running_per_user]:
+            del self._finish[u]
+
+    def stats(self):
+        return {
+            'max_jobs': self.max_jobs,
+            'running': self.running,
+            'queued': len(self._queue),
+            'users_running': len([u for u, c in self._running_per_user.items() if c > 0]),
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+            'queue_wait': self.queue_wait.stats(),
+            'donator_queue_wait': self.donator_queue_wait.stats()
+        }
+
+
+# slot of one message job, it's held only while some parts of the job work.
+# Parts which wait for other jobs or for delivery order give it away, it's queued again after that
+class Admission:
+
+    def __init__(self, scheduler, user_id, donator, cost):
+        self.scheduler = scheduler
+        self.user_id = user_id
+        self.donator = donator
+        self.cost = cost
+        self._job = None
+        self._holders = 0
+
+    async def _enter(self):
+        self._holders += 1
+        if self._job is None:
+            self._job = self.scheduler._enqueue(self.user_id, self.donator, self.cost)
+        job = self._job
+        try:
+            await asyncio.shield(job.fut)
+        except asyncio.CancelledError:
+            self._leave()
+            raise
+
+    def _leave(self):
+        self._holders -= 1
+        if self._holders == 0 and self._job is not None:
+            self.scheduler._cancel(self._job)
+            self._job = None
+
+    @contextlib.asynccontextmanager
+    async def hold(self):
+        await self._enter()
+        try:
+            yield
+        finally:
+            self._leave()
+
+    # part of job which holds slot waits without it.
+    # Failed or cancelled part doesn't queue for slot again, it only gives its hold back to hold()
+    @contextlib.asynccontextmanager
+    async def pause(self):
+        self._leave()
+        try:
+            yield
+        except BaseException:
+            self._holders += 1
+            raise
+        else:
+            await self._enter()
+
+
+scheduler = JobScheduler(JOBS_MAX_CONCURRENCY, JOBS_USER_CONCURRENCY, JOBS_DONATOR_CONCURRENCY,
+                         JOBS_DONATOR_WEIGHT, JOBS_USER_QUEUE)
@@ -33,6 +33,22 @@ import signal
 import functools
 import fast_telethon
 import aiofiles
+import file_cache
+import info_cache
+import single_flight
+import extractor_pool
+import ydl_pool
+import ordered_delivery
+import http_pool
+import connection_scheduler
+import upload_tuner
+import upload_journal
+import range_downloader
+import hls_fetcher
+import dash_fetcher
+import job_scheduler
+import storage
+import json
 
 
 def get_client_session():
@@ -165,8 +181,7 @@ async def on_message(request):
                     traceback.print_exc()
             return web.Response(status=200)
 
-        msg_task = asyncio.get_event_loop().create_task(_on_message_task(message))
-        asyncio.get_event_loop().create_task(task_timeout_cancel(msg_task, timemout=21600))
+        start_message_task(message)
     except Exception as e:
         print(e)
         traceback.print_exc()
@@ -174,6 +189,29 @@ async def on_message(request):
     return web.Response(status=200)
 
 
+async def on_stats(request):
+    stats = {
+        'file_cache': file_cache.cache.stats(),
+        'info_cache': info_cache.cache.stats(),
+        'single_flight': single_flight.flights.stats(),
+        'extractor_pool': extractor_pool.pool.stats(),
+        'ydl_pool': ydl_pool.pool.stats(),
+        'http_pool': http_pool.pool.stats(),
+        'av_info': av_utils.av_info_cache.stats(),
+        'tg_connections': connection_scheduler.scheduler.stats(),
+        'uploads': fast_telethon.transfer_stats.stats(),
+        'tg_senders': fast_telethon.sender_pool.stats(),
+        'upload_tuner': upload_tuner.history.stats(),
+        'jobs': job_scheduler.scheduler.stats(),
+        'storage': storage.manager.stats(),
+        'upload_journal': upload_journal.journal.stats(),
+        'range_downloads': range_downloader.stats.stats(),
+        'hls': hls_fetcher.stats.stats(),
+        'dash': dash_fetcher.stats.stats()
+    }
+    return web.Response(text=json.dumps(stats), content_type='application/json')
+
+
 async def task_timeout_cancel(task, timemout=5):
     try:
         await asyncio.wait_for(task, timeout=timemout)
@@ -184,16 +222,57 @@ async def task_timeout_cancel(task, timemout=5):
 # share uploaded by client api file to user
 async def share_content_with_user(message, with_reply=True):
     _user_id, _reply_msg_id, user_caption = message['caption'].split(':', maxsplit=2)
+    _reply_msg_id, cache_key, flight_token = file_cache.split_key(_reply_msg_id)
     user_id = int(_user_id)
     reply_msg_id = int(_reply_msg_id) if with_reply else None
     caption = user_caption if user_caption != '' else None
-    if 'video' in message:
-        await _bot.send_video(user_id, message['video']['file_id'], reply_to_message_id=reply_msg_id, caption=caption)
-    elif 'audio' in message:
-        await _bot.send_audio(user_id, message['audio']['file_id'], reply_to_message_id=reply_msg_id, caption=caption)
-    elif 'document' in message:
-        await _bot.send_document(user_id, message['document']['file_id'], reply_to_message_id=reply_msg_id,
-                                 caption=caption)
+    for media_type in ['video', 'audio', 'document']:
+        if media_type in message:
+            file_id = message[media_type]['file_id']
+            await send_file_by_id(user_id, media_type, file_id, reply_msg_id, caption)
+            if cache_key:
+                await file_cache.cache.put(cache_key, file_id, media_type)
+            if flight_token:
+                single_flight.flights.file_sent(flight_token, media_type, file_id)
+            break
+
+
+async def send_file_by_id(chat_id, media_type, file_id, reply_msg_id=None, caption=None):
+    if media_type == 'video':
+        await _bot.send_video(chat_id, file_id, reply_to_message_id=reply_msg_id, caption=caption)
+    elif media_type == 'audio':
+        await _bot.send_audio(chat_id, file_id, reply_to_message_id=reply_msg_id, caption=caption)
+    elif media_type == 'document':
+        await _bot.send_document(chat_id, file_id, reply_to_message_id=reply_msg_id, caption=caption)
+
+
+# send already uploaded media, returns (file id, media type) or None if there is nothing in cache
+async def send_cached_file(chat_id, msg_id, cache_key, user, entry, audio_mode, log, before_send=None):
+    await file_cache.cache.wait_pending(cache_key)
+    cached = await file_cache.cache.get(cache_key)
+    if cached is None:
+        return None
+    if before_send is not None:
+        await before_send()
+    file_id, media_type = cached
+    caption = media_caption(user, entry, audio_mode or media_type == 'audio')
+    try:
+        await send_file_by_id(chat_id, media_type, file_id, msg_id, caption if caption != '' else None)
+    except Exception as e:
+        # file id was invalidated by telegram, upload it again
+        log.warning('failed send cached file: ' + str(e))
+        await file_cache.cache.delete(cache_key)
+        return None
+    log.info('sent cached file ' + cache_key)
+    return cached
+
+
+def media_caption(user, entry, audio_mode):
+    return entry['title'] if (user.default_media_type == users.DefaultMediaType.Video.value
+                              and user.video_caption and audio_mode == False) or \
+                             (((user.default_media_type == users.DefaultMediaType.Audio.value) or
+                               (audio_mode == True))
+                              and user.audio_caption) else ''
 
 
 async def _on_message_task(message):
@@ -204,41 +283,63 @@ async def _on_message_task(message):
         log = new_logger(chat_id, msg_id)
         try:
             await _on_message(message, log)
-        except HTTPError as e:
-            # crashing to try change ip
-            # otherwise youtube.com will not allow us
-            # to download any video for some time
-            if e.code == 429:
-                log.critical(e)
-                await shutdown()
-            else:
-                log.exception(e)
-                await _bot.send_message(chat_id, e.__str__(), reply_to_message_id=msg_id)
-                # await bot.send_message(chat_id, e.__str__(), reply_to=msg_id)
-        except youtube_dl.DownloadError as e:
-            # crashing to try change ip
-            # otherwise youtube.com will not allow us
-            # to download any video for some time
-            if e.exc_info[0] is HTTPError:
-                if e.exc_info[1].file.code == 429:
-                    log.critical(e)
-                    await shutdown()
-
-            log.exception(e)
-            await _bot.send_message(chat_id, str(e), reply_to_message_id=msg_id)
-            # await bot.send_message(chat_id, e.__str__(), reply_to=msg_id)
         except Exception as e:
-            log.exception(e)
-            if 'ERROR' not in str(e):
-                err_msg = 'ERROR: ' + str(e)
-            else:
-                err_msg = str(e)
-            await _bot.send_message(chat_id, err_msg, reply_to_message_id=msg_id)
-            # await bot.send_message(chat_id, e.__str__(), reply_to=msg_id)
+            await report_error(e, chat_id, msg_id, log)
     except Exception as e:
         logging.error(e)
 
 
+def start_message_task(message):
+    msg_task = asyncio.get_event_loop().create_task(_on_message_task(message))
+    asyncio.get_event_loop().create_task(task_timeout_cancel(msg_task, timemout=21600))
+
+
+# jobs which were interrupted by restart start again from their messages
+def requeue_jobs():
+    for message in upload_journal.journal.pending_jobs():
+        logging.info('requeue message {}:{}'.format(message['chat']['id'], message['message_id']))
+        start_message_task(message)
+
+
+# job of message is dropped before rate limit shutdown, so restart doesn't hit the site again
+async def report_error(e, chat_id, msg_id, log, job=None):
+    if isinstance(e, HTTPError):
+        # crashing to try change ip
+        # otherwise youtube.com will not allow us
+        # to download any video for some time
+        if e.code == 429:
+            log.critical(e)
+            if job is not None:
+                await job.finish()
+            await shutdown()
+        else:
+            log.exception(e)
+            await _bot.send_message(chat_id, e.__str__(), reply_to_message_id=msg_id)
+            # await bot.send_message(chat_id, e.__str__(), reply_to=msg_id)
+    elif isinstance(e, youtube_dl.DownloadError):
+        # crashing to try change ip
+        # otherwise youtube.com will not allow us
+        # to download any video for some time
+        if e.exc_info[0] is HTTPError:
+            if e.exc_info[1].file.code == 429:
+                log.critical(e)
+                if job is not None:
+                    await job.finish()
+                await shutdown()
+
+        log.exception(e)
+        await _bot.send_message(chat_id, str(e), reply_to_message_id=msg_id)
+        # await bot.send_message(chat_id, e.__str__(), reply_to=msg_id)
+    else:
+        log.exception(e)
+        if 'ERROR' not in str(e):
+            err_msg = 'ERROR: ' + str(e)
+        else:
+            err_msg = str(e)
+        await _bot.send_message(chat_id, err_msg, reply_to_message_id=msg_id)
+        # await bot.send_message(chat_id, e.__str__(), reply_to=msg_id)
+
+
 # extract telegram command from message
 def cmd_from_message(message):
     cmd = None
@@ -261,12 +362,13 @@ async def extract_url_info(ydl, url):
     # async with ClientSession() as session:
     #     async with session.post(YTDL_LAMBDA_URL, json=data, headers=headers, timeout=14400) as req:
     #         return await req.json()
-    return await asyncio.get_event_loop().run_in_executor(None,
-                                                          functools.partial(ydl.extract_info,
-                                                                            download=False,
-                                                                            force_generic_extractor=ydl.params.get(
-                                                                                'force_generic_extractor', False)),
-                                                          url)
+    cache_key = info_cache.make_key(url, ydl.params)
+    vinfo = await info_cache.cache.get(cache_key)
+    if vinfo is not None:
+        return vinfo
+    vinfo = await extractor_pool.pool.extract_info(ydl, url)
+    await info_cache.cache.put(cache_key, vinfo)
+    return vinfo
 
 
 async def send_settings(user, user_id, edit_id=None):
@@ -361,19 +463,16 @@ async def upload_multipart_zip(source, name, file_size, chat_id, msg_id):
     zfile = zip_file.ZipTorrentContentFile(source, name, file_size)
 
     async def upload_torrent_content(file, chat_id, msg_id):
-        global TG_CONNECTIONS_COUNT
-        global TG_MAX_PARALLEL_CONNECTIONS
-        if 20 > TG_CONNECTIONS_COUNT and file.size > 100 * 1024 * 1024:
-            TG_CONNECTIONS_COUNT += 2
-            try:
-                uploaded_file = await fast_telethon.upload_file(client,
-                                                                file,
-                                                                file_size=file.size,
-                                                                file_name=file.name,
-                                                                max_connection=2)
-            finally:
-                TG_CONNECTIONS_COUNT -= 2
-        else:
+        uploaded_file = None
+        if file.size > 100 * 1024 * 1024:
+            async with connection_scheduler.scheduler.acquire(file.size, max_connections=2) as grant:
+                if grant.count > 0:
+                    uploaded_file = await fast_telethon.upload_file(client,
+                                                                    file,
+                                                                    file_size=file.size,
+                                                                    file_name=file.name,
+                                                                    grant=grant)
+        if uploaded_file is None:
             uploaded_file = await client.upload_file(file, file_size=file.size, file_name=file.name)
         await client.send_file(bot_entity, uploaded_file, caption=str(chat_id)+":"+str(msg_id)+":")
 
@@ -403,7 +502,6 @@ async def upload_multipart_zip(source, name, file_size, chat_id, msg_id):
 
 
 async def _on_message(message, log):
-    global STORAGE_SIZE
     if message['from']['is_bot']:
         log.info('Message from bot, skip')
         return
@@ -597,705 +695,947 @@ async def _on_message(message, log):
     # if len(urls) == 1 and 'youtube.com/playlist?list=' in urls[0] and playlist_start is not None:
     #     urls = await ytb_playlist_to_invidious(urls[0], (playlist_start,playlist_end))
 
+    # keep order of urls in message, results are sent in the same order
+    urls = list(dict.fromkeys(urls))
+    cost = job_scheduler.estimate_cost(len(urls), cmd, playlist_start, playlist_end)
+    try:
+        # urls wait for turn of this user before any media is touched
+        admission = job_scheduler.scheduler.admission(chat_id, user.donator, cost)
+    except job_scheduler.JobRejected as e:
+        log.info('job rejected: ' + str(e))
+        await _bot.send_message(chat_id, str(e), reply_to_message_id=msg_id)
+        return
+    # message is processed again if bot restarts before the job is done
+    job = await upload_journal.journal.job(chat_id, msg_id, message)
+    try:
+        await _on_urls(urls, chat_id, msg_id, msg_txt, cmd, user, audio_mode, preferred_formats,
+                       playlist_start, playlist_end, cut_time_start, cut_time_end, admission, job, log)
+    finally:
+        # it does nothing after shutdown, the job stays for restart
+        await job.finish()
+
+
+async def _on_urls(urls, chat_id, msg_id, msg_txt, cmd, user, audio_mode, preferred_formats,
+                   playlist_start, playlist_end, cut_time_start, cut_time_end, admission, job, log):
     async with tgaction.TGAction(_bot, chat_id, "upload_document"):
-        urls = set(urls)
-        for iu, u in enumerate(urls):
-            vinfo = None
-            params = {'noplaylist': True,
-                      'youtube_include_dash_manifest': False,
-                      'quiet': True,
-                      'no_color': True,
-                      'nocheckcertificate': True
-                      # 'force_generic_extractor': True if 'invidio.us/watch' in u else False
-                      }
-            if playlist_start != None and playlist_end != None: #and 'invidio.us/watch' not in u:
-                params['ignoreerrors'] = True
-                if playlist_start == 0 and playlist_end == 0:
-                    params['playliststart'] = 1
-                    params['playlistend'] = 10
-                else:
-                    params['playliststart'] = playlist_start
-                    params['playlistend'] = playlist_end
-            else:
-                params['playlist_items'] = '1'
+        delivery = ordered_delivery.OrderedDelivery()
+
+        async def url_job(iu, u):
+            try:
+                return await _on_url(u, iu, len(urls), chat_id, msg_id, msg_txt, cmd, user, audio_mode,
+                                     preferred_formats, playlist_start, playlist_end, cut_time_start, cut_time_end,
+                                     delivery, admission, job, log)
+            except Exception as e:
+                await report_error(e, chat_id, msg_id, log, job)
+            finally:
+                await delivery.done(iu)
+
+        await ordered_delivery.run_bounded([functools.partial(url_job, iu, u) for iu, u in enumerate(urls)],
+                                           functools.partial(budget_concurrency, MESSAGE_URLS_CONCURRENCY))
+
+
+# how many jobs of one message can be processed at once
+def budget_concurrency(limit):
+    concurrency = min(limit, connection_scheduler.scheduler.free // connection_scheduler.TG_UPLOAD_MAX_CONNECTIONS)
+    if storage.manager.free < storage.manager.capacity // 2:
+        # don't let multi-link message take the whole storage
+        concurrency = 1
+    return concurrency
+
+
+# process single url from message, returns True if the rest of message urls must be skipped
+async def _on_url(u, iu, urls_count, chat_id, msg_id, msg_txt, cmd, user, audio_mode, preferred_formats,
+                  playlist_start, playlist_end, cut_time_start, cut_time_end, delivery, admission, job, log):
+    # identical requests wait for the first one and then send what it has sent
+    flight_key = None
+    if cmd in single_flight.SHARED_CMDS:
+        flight_key = single_flight.make_key(u, cmd, audio_mode, preferred_formats,
+                                            (cut_time_start, cut_time_end) if cut_time_start else None,
+                                            (playlist_start, playlist_end))
+    async with single_flight.flights.join(flight_key) as (flight, is_leader):
+        if not is_leader:
+            stopped = await send_flight_results(flight, iu, chat_id, msg_id, user, audio_mode, delivery, log)
+            if stopped is not None:
+                return stopped
+            log.info('result of the same request can\'t be shared, process it again')
+            flight = None
+        # followers above don't take a job slot while they wait
+        async with admission.hold():
+            # only messages which download media are journaled
+            await job.start()
+            with ydl_pool.pool.lease() as ydls, av_utils.probe_scope():
+                stopped = await _process_url(u, iu, urls_count, chat_id, msg_id, msg_txt, cmd, user, audio_mode,
+                                             preferred_formats, playlist_start, playlist_end, cut_time_start,
+                                             cut_time_end, ydls, delivery, admission, flight, job, log)
+        if flight is not None:
+            flight.stopped = stopped
+        return stopped
+
+
+# follower sends results of the same request of other user, returns None if they can't be shared
+async def send_flight_results(flight, iu, chat_id, msg_id, user, audio_mode, delivery, log):
+    results = single_flight.flights.results(flight)
+    if flight.error is not None:
+        raise flight.error
+    if results is None:
+        return None
+    await delivery.wait_turn(iu)
+    for result in results:
+        if result[0] == single_flight.FILE:
+            _, media_type, file_id, title = result
+            caption = media_caption(user, {'title': title}, audio_mode or media_type == 'audio')
+            await send_file_by_id(chat_id, media_type, file_id, msg_id, caption if caption != '' else None)
+        elif result[0] == single_flight.MESSAGE:
+            _, text, parse_mode = result
+            await _bot.send_message(chat_id, text, reply_to_message_id=msg_id, parse_mode=parse_mode)
+        elif result[0] == single_flight.SKIPPED:
+            await send_entry_skipped(chat_id, msg_id, result[1])
+    log.info('sent {} results of the same request'.format(len(results)))
+    return flight.stopped
+
+
+async def _process_url(u, iu, urls_count, chat_id, msg_id, msg_txt, cmd, user, audio_mode, preferred_formats,
+                       playlist_start, playlist_end, cut_time_start, cut_time_end, ydls, delivery, admission, flight,
+                       job, log):
+    vinfo = None
+    params = {'noplaylist': True,
+              'youtube_include_dash_manifest': False,
+              'quiet': True,
+              'no_color': True,
+              'nocheckcertificate': True
+              # 'force_generic_extractor': True if 'invidio.us/watch' in u else False
+              }
+    if playlist_start != None and playlist_end != None: #and 'invidio.us/watch' not in u:
+        params['ignoreerrors'] = True
+        if playlist_start == 0 and playlist_end == 0:
+            params['playliststart'] = 1
+            params['playlistend'] = 10
+        else:
+            params['playliststart'] = playlist_start
+            params['playlistend'] = playlist_end
+    else:
+        params['playlist_items'] = '1'
 
-            ydl = youtube_dl.YoutubeDL(params=params)
-            recover_playlist_index = None  # to save last playlist position if finding format failed
-            for ip, pref_format in enumerate(preferred_formats):
+    ydl = ydls.get(params)
+    # extract info with the first preferred format which is available,
+    # entries fall back to the next formats themselves
+    for ip, pref_format in enumerate(preferred_formats):
+        try:
+            params['format'] = pref_format
+            ydl.params = params
+            for _ in range(2):
                 try:
-                    params['format'] = pref_format
-                    if recover_playlist_index is not None and 'playliststart' in params:
-                        params['playliststart'] += recover_playlist_index
-                    ydl.params = params
-                    if vinfo is None:
-                        for _ in range(2):
-                            try:
-                                vinfo = await extract_url_info(ydl, u)
-                                if vinfo.get('age_limit') == 18 and is_ytb_link_re.search(vinfo.get('webpage_url', '')):
-                                    raise youtube_dl.DownloadError('youtube age limit')
-                            except youtube_dl.DownloadError as e:
-                                # try to use invidio.us youtube frontend to bypass 429 block
-                                if (e.exc_info is not None and e.exc_info[0] is HTTPError and e.exc_info[
-                                    1].file.code == 429) or \
-                                        'video available in your country' in str(e) or \
-                                        'youtube age limit' == str(e):
-                                    invid_url = youtube_to_invidio(u, audio_mode == True)
-                                    if invid_url:
-                                        u = invid_url
-                                        ydl.params['force_generic_extractor'] = True
-                                        continue
-                                    raise
-                                else:
-                                    raise
-
-                            break
-
-                        log.debug('video info received')
-                    else:
-                        if '_type' in vinfo and vinfo['_type'] == 'playlist':
-                            for i, e in enumerate(vinfo['entries']):
-                                e['requested_formats'] = None
-                                vinfo['entries'][i] = ydl.process_video_result(e, download=False)
-                        else:
-                            vinfo['requested_formats'] = None
-                            vinfo = ydl.process_video_result(vinfo, download=False)
-                        log.debug('video info reprocessed with new format')
-                except Exception as e:
-                    if "Please log in or sign up to view this video" in str(e):
-                        if 'vk.com' in u:
-                            params['username'] = os.environ['VIDEO_ACCOUNT_USERNAME']
-                            params['password'] = os.environ['VIDEO_ACCOUNT_PASSWORD']
-                            ydl = youtube_dl.YoutubeDL(params=params)
-                            try:
-                                vinfo = await extract_url_info(ydl, u)
-                            except Exception as e:
-                                log.error(e)
-                                await _bot.send_message(chat_id, str(e), reply_to_message_id=msg_id)
-                                # await bot.send_message(chat_id, str(e), reply_to=msg_id)
-                                continue
-                        else:
-                            log.error(e)
-                            await _bot.send_message(chat_id, str(e), reply_to_message_id=msg_id)
-                            # await bot.send_message(chat_id, str(e), reply_to=msg_id)
-                            continue
-                    elif 'are video-only' in str(e):
-                        params['format'] = 'bestvideo[ext=mp4]'
-                        ydl = youtube_dl.YoutubeDL(params=params)
-                        try:
-                            vinfo = await extract_url_info(ydl, u)
-                        except Exception as e:
-                            log.error(e)
-                            await _bot.send_message(chat_id, str(e), reply_to_message_id=msg_id)
-                            # await bot.send_message(chat_id, str(e), reply_to=msg_id)
+                    vinfo = await extract_url_info(ydl, u)
+                    if vinfo.get('age_limit') == 18 and is_ytb_link_re.search(vinfo.get('webpage_url', '')):
+                        raise youtube_dl.DownloadError('youtube age limit')
+                except youtube_dl.DownloadError as e:
+                    # try to use invidio.us youtube frontend to bypass 429 block
+                    if (e.exc_info is not None and e.exc_info[0] is HTTPError and e.exc_info[
+                        1].file.code == 429) or \
+                            'video available in your country' in str(e) or \
+                            'youtube age limit' == str(e):
+                        invid_url = youtube_to_invidio(u, audio_mode == True)
+                        if invid_url:
+                            u = invid_url
+                            ydl.params['force_generic_extractor'] = True
                             continue
+                        raise
                     else:
-                        if iu < len(urls) - 1:
-                            log.error(e)
-                            await _bot.send_message(chat_id, str(e), reply_to_message_id=msg_id)
-                            break
-
                         raise
 
-                entries = None
-                if '_type' in vinfo and (vinfo['_type'] == 'playlist' or vinfo['_type'] == 'multi_video'):
-                    entries = vinfo['entries']
-                else:
-                    entries = [vinfo]
+                break
 
-                for ie, entry in enumerate(entries):
-                    if entry is None:
-                        try:
-                            await _bot.send_message(chat_id, f'WARN: #{params["playliststart"] + ie} was skipped due to error', reply_to_message_id=msg_id)
-                        except:
-                            pass
+            log.debug('video info received')
+        except Exception as e:
+            if "Please log in or sign up to view this video" in str(e):
+                if 'vk.com' in u:
+                    params['username'] = os.environ['VIDEO_ACCOUNT_USERNAME']
+                    params['password'] = os.environ['VIDEO_ACCOUNT_PASSWORD']
+                    ydl = ydls.get(params)
+                    try:
+                        vinfo = await extract_url_info(ydl, u)
+                    except Exception as e:
+                        log.error(e)
+                        await _bot.send_message(chat_id, str(e), reply_to_message_id=msg_id)
+                        # await bot.send_message(chat_id, str(e), reply_to=msg_id)
                         continue
-                    formats = entry.get('requested_formats')
-                    _file_size = None
-                    chosen_format = None
-                    ffmpeg_av = None
-                    http_headers = None
-                    if 'http_headers' not in entry:
-                        if formats is not None and 'http_headers' in formats[0]:
-                            http_headers = formats[0]['http_headers']
-                    else:
-                        http_headers = entry['http_headers']
-                    if not entry.get('direct', False):
-                        http_headers['Referer'] = u
+                else:
+                    log.error(e)
+                    await _bot.send_message(chat_id, str(e), reply_to_message_id=msg_id)
+                    # await bot.send_message(chat_id, str(e), reply_to=msg_id)
+                    continue
+            elif 'are video-only' in str(e):
+                params['format'] = 'bestvideo[ext=mp4]'
+                ydl = ydls.get(params)
+                try:
+                    vinfo = await extract_url_info(ydl, u)
+                except Exception as e:
+                    log.error(e)
+                    await _bot.send_message(chat_id, str(e), reply_to_message_id=msg_id)
+                    # await bot.send_message(chat_id, str(e), reply_to=msg_id)
+                    continue
+            else:
+                if iu < urls_count - 1:
+                    log.error(e)
+                    await _bot.send_message(chat_id, str(e), reply_to_message_id=msg_id)
+                    break
 
-                    _title = entry.get('title', '')
-                    if _title == '':
-                        entry['title'] = str(msg_id)
+                raise
 
-                    if cmd == 's':
-                        direct_url = entry.get('url') if formats is None else formats[0].get('url')
-                        if 'invidio.us' in direct_url:
-                            direct_url = normalize_url_path(direct_url)
-
-                        await send_screenshot(chat_id,
-                                              msg_txt,
-                                              direct_url,
-                                              http_headers=http_headers)
-                        return
-                    if cmd == 't':
-                        thumb_url = entry.get('thumbnail')
-                        if thumb_url:
-                            await _bot.send_photo(chat_id, thumb_url)
-                        else:
-                            await _bot.send_message(chat_id, 'Media don\'t contain thumbnail')
+        entries = None
+        if '_type' in vinfo and (vinfo['_type'] == 'playlist' or vinfo['_type'] == 'multi_video'):
+            entries = vinfo['entries']
+        else:
+            entries = [vinfo]
+        if flight is not None:
+            flight.set_entries(len(entries))
+
+        entry_delivery = ordered_delivery.OrderedDelivery()
+
+        async def wait_entry_turn(ie):
+            # previous urls of message may follow other requests which may follow this one,
+            # so followers don't wait for leader which is blocked by delivery order
+            if flight is not None and not delivery.is_turn(iu):
+                single_flight.flights.release(flight)
+            # previous urls of message and previous playlist entries must be sent first,
+            # slot is given away meanwhile as they may wait for other jobs
+            if delivery.is_turn(iu) and entry_delivery.is_turn(ie):
+                return
+            async with admission.pause():
+                await delivery.wait_turn(iu)
+                await entry_delivery.wait_turn(ie)
+
+        async def entry_job(ie, entry):
+            # results of entry which followers of the same request send too
+            publish = functools.partial(flight.publish, ie) if flight is not None else None
+            # user got something for the entry, requeued job doesn't send it again
+            sent = False
+            try:
+                if job.delivered(iu, ie):
+                    log.info('entry {} was sent before restart'.format(ie))
+                    return
+                if entry is None:
+                    await send_entry_skipped(chat_id, msg_id, params.get('playliststart', 1) + ie)
+                    sent = True
+                    if publish:
+                        publish((single_flight.SKIPPED, params.get('playliststart', 1) + ie))
+                    return
+                for entry_ip in range(ip, len(preferred_formats)):
+                    if entry_ip > ip:
+                        entry = reprocess_entry(ydl, entry, preferred_formats[entry_ip])
+                        log.debug('video info reprocessed with new format')
+                    # local files of the entry are removed on any exit
+                    async with storage.manager.lease() as storage_lease:
+                        status = await _process_entry(u, entry, entry_ip, chat_id, msg_id, msg_txt, cmd, user,
+                                                      audio_mode, preferred_formats, cut_time_start, cut_time_end,
+                                                      storage_lease, functools.partial(wait_entry_turn, ie), publish,
+                                                      log)
+                    if status != ENTRY_RETRY:
+                        sent = True
+                        return status == ENTRY_STOP
+            except Exception as e:
+                if len(entries) == 1:
+                    raise
+                # don't stall the rest of playlist
+                log.exception(e)
+                await send_entry_skipped(chat_id, msg_id, params.get('playliststart', 1) + ie)
+                sent = True
+                if publish:
+                    publish((single_flight.SKIPPED, params.get('playliststart', 1) + ie))
+            finally:
+                if sent:
+                    await job.entry_sent(iu, ie)
+                await entry_delivery.done(ie)
 
-                        return
+        return await ordered_delivery.run_bounded(
+            [functools.partial(entry_job, ie, entry) for ie, entry in enumerate(entries)],
+            functools.partial(budget_concurrency, PLAYLIST_CONCURRENCY if len(entries) > 1 else 1))
 
-                    _cut_time = (cut_time_start, cut_time_end) if cut_time_start else None
-                    try:
-                        if formats is not None:
-                            for i, f in enumerate(formats):
-                                if f['protocol'] in ['rtsp', 'rtmp', 'rtmpe', 'mms', 'f4m', 'ism',
-                                                     'http_dash_segments']:
-                                    # await bot.send_message(chat_id, "ERROR: Failed find suitable format for: " + entry['title'], reply_to=msg_id)
-                                    continue
-                                if 'm3u8' in f['protocol']:
-                                    _file_size = await av_utils.m3u8_video_size(f['url'], http_headers)
-                                else:
-                                    if 'filesize' in f and f['filesize'] != 0 and f['filesize'] is not None and f[
-                                        'filesize'] != 'none':
-                                        _file_size = f['filesize']
-                                    else:
-                                        try:
-                                            direct_url = f['url']
-                                            if 'invidio.us' in direct_url:
-                                                direct_url = normalize_url_path(direct_url)
-                                            _file_size = await av_utils.media_size(direct_url, http_headers=http_headers)
-                                        except Exception as e:
-                                            if i < len(formats) - 1 and '404 Not Found' in str(e):
-                                                break
-                                            else:
-                                                raise
-
-                                # Dash video
-                                if f['protocol'] == 'https' and \
-                                        (True if ('acodec' in f and (
-                                                f['acodec'] == 'none' or f['acodec'] == None)) else False):
-                                    vformat = f
-                                    mformat = None
-                                    vsize = 0
-
-                                    direct_url = vformat['url']
-                                    if 'invidio.us' in direct_url:
-                                        vformat['url'] = normalize_url_path(direct_url)
-
-                                    if 'filesize' in vformat and vformat['filesize'] != 0 and vformat[
-                                        'filesize'] is not None and vformat['filesize'] != 'none':
-                                        vsize = vformat['filesize']
-                                    else:
-                                        vsize = await av_utils.media_size(vformat['url'], http_headers=http_headers)
-                                    msize = 0
-                                    # if there is one more format than
-                                    # it's likely an url to audio
-                                    if len(formats) > i + 1:
-                                        mformat = formats[i + 1]
-
-                                        direct_url = mformat['url']
-                                        if 'invidio.us' in direct_url:
-                                            mformat['url'] = normalize_url_path(direct_url)
-
-                                        if 'filesize' in mformat and mformat['filesize'] != 0 and mformat[
-                                            'filesize'] is not None and mformat['filesize'] != 'none':
-                                            msize = mformat['filesize']
-                                        else:
-                                            msize = await av_utils.media_size(mformat['url'], http_headers=http_headers)
-                                    # we can't precisely predict media size so make it large for prevent cutting
-                                    _file_size = vsize + msize + 10 * 1024 * 1024
-                                    if _file_size < TG_MAX_FILE_SIZE or cut_time_start is not None or cmd == 'z':
-                                        file_name = None
-                                        if not cut_time_start and STORAGE_SIZE > _file_size > 0:
-                                            STORAGE_SIZE -= _file_size
-                                            _ext = 'mp4' if audio_mode == False else 'mp3'
-                                            file_name = str(chat_id) + ':' + str(msg_id) + ':' + entry[
-                                                'title'] + '.' + _ext
-                                        ffmpeg_av = await av_source.FFMpegAV.create(vformat,
-                                                                                    mformat,
-                                                                                    headers=http_headers,
-                                                                                    cut_time_range=_cut_time,
-                                                                                    file_name=file_name if cmd != 'z' else None,
-                                                                                    restrict_size=False if cmd == 'z' else True)
-                                        chosen_format = f
-                                    break
-                                # m3u8
-                                if ('m3u8' in f['protocol'] and
-                                        (_file_size <= TG_MAX_FILE_SIZE or cut_time_start is not None or cmd == 'z')):
-                                    chosen_format = f
-                                    acodec = f.get('acodec')
-                                    if acodec is None or acodec == 'none':
-                                        if len(formats) > i + 1:
-                                            mformat = formats[i + 1]
-                                            if 'filesize' in mformat and mformat['filesize'] != 0 and mformat[
-                                                'filesize'] is not None and mformat['filesize'] != 'none':
-                                                msize = mformat['filesize']
-                                            else:
-                                                msize = await av_utils.media_size(mformat['url'],
-                                                                                  http_headers=http_headers)
-                                            msize += 10 * 1024 * 1024
-                                            if (msize + _file_size) > TG_MAX_FILE_SIZE and cut_time_start is None and cmd != 'z':
-                                                mformat = None
-                                            else:
-                                                _file_size += msize
-
-                                    file_name = None
-                                    if not cut_time_start and STORAGE_SIZE > _file_size > 0:
-                                        STORAGE_SIZE -= _file_size
-                                        _ext = 'mp4' if audio_mode == False else 'mp3'
-                                        file_name = str(chat_id) + ':' + str(msg_id) + ':' + entry['title'] + '.' + _ext
-                                    ffmpeg_av = await av_source.FFMpegAV.create(chosen_format,
-                                                                                aformat=mformat,
-                                                                                audio_only=True if audio_mode == True else False,
-                                                                                headers=http_headers,
-                                                                                cut_time_range=_cut_time,
-                                                                                file_name=file_name if cmd != 'z' else None,
-                                                                                restrict_size=False if cmd == 'z' else True)
-                                    break
-                                # regular video stream
-                                if (0 < _file_size <= TG_MAX_FILE_SIZE) or cut_time_start is not None or cmd == 'z':
-                                    chosen_format = f
-
-                                    direct_url = chosen_format['url']
-                                    if 'invidio.us' in direct_url:
-                                        chosen_format['url'] = normalize_url_path(direct_url)
-
-                                    if audio_mode == True and not (chosen_format['ext'] == 'mp3'):
-                                        ffmpeg_av = await av_source.FFMpegAV.create(chosen_format,
-                                                                                    audio_only=True,
-                                                                                    headers=http_headers,
-                                                                                    cut_time_range=_cut_time,
-                                                                                    restrict_size=False if cmd == 'z' else True)
-                                    break
 
-                        else:
-                            if entry['protocol'] in ['rtsp', 'rtmp', 'rtmpe', 'mms', 'f4m', 'ism',
-                                                     'http_dash_segments']:
-                                # await bot.send_message(chat_id, "ERROR: Failed find suitable format for : " + entry['title'], reply_to=msg_id)
-                                # if 'playlist' in entry and entry['playlist'] is not None:
-                                recover_playlist_index = ie
+def reprocess_entry(ydl, entry, pref_format):
+    ydl.params['format'] = pref_format
+    entry['requested_formats'] = None
+    return ydl.process_video_result(entry, download=False)
+
+
+async def send_entry_skipped(chat_id, msg_id, playlist_index):
+    try:
+        await _bot.send_message(chat_id, f'WARN: #{playlist_index} was skipped due to error', reply_to_message_id=msg_id)
+    except:
+        pass
+
+
+# error which is the same for every user, followers of the request get it too
+async def send_entry_error(chat_id, text, publish, reply_to_message_id=None, parse_mode=None):
+    await _bot.send_message(chat_id, text, reply_to_message_id=reply_to_message_id, parse_mode=parse_mode)
+    if publish:
+        publish((single_flight.MESSAGE, text, parse_mode))
+
+
+# results of _process_entry
+ENTRY_DONE = 0
+# entry must be processed again with next preferred format
+ENTRY_RETRY = 1
+# the rest of message must be skipped
+ENTRY_STOP = 2
+
+
+# reserves disk space for local ffmpeg output, it can be seekable mp4 with faststart unlike piped one.
+# Returns None if there is no space in time, ffmpeg output is piped then
+async def local_output_name(storage_lease, size, chat_id, msg_id, title, audio_mode, log):
+    if not size or size <= 0:
+        return None
+    file_name = str(chat_id) + ':' + str(msg_id) + ':' + title + '.' + ('mp4' if audio_mode == False else 'mp3')
+    reservation = await storage_lease.reserve(size, av_source.output_file_name(file_name))
+    if reservation is None:
+        log.info('no storage space for {} bytes, output is piped'.format(size))
+        return None
+    await upload_journal.journal.output_started(av_source.output_file_name(file_name), chat_id, msg_id, size)
+    return file_name
+
+
+async def _process_entry(u, entry, ip, chat_id, msg_id, msg_txt, cmd, user, audio_mode, preferred_formats,
+                         cut_time_start, cut_time_end, storage_lease, wait_turn, publish, log):
+    formats = entry.get('requested_formats')
+    _file_size = None
+    chosen_format = None
+    ffmpeg_av = None
+    http_headers = None
+    if 'http_headers' not in entry:
+        if formats is not None and 'http_headers' in formats[0]:
+            http_headers = formats[0]['http_headers']
+    else:
+        http_headers = entry['http_headers']
+    if not entry.get('direct', False):
+        http_headers['Referer'] = u
+
+    _title = entry.get('title', '')
+    if _title == '':
+        entry['title'] = str(msg_id)
+
+    if cmd == 's':
+        direct_url = entry.get('url') if formats is None else formats[0].get('url')
+        if 'invidio.us' in direct_url:
+            direct_url = normalize_url_path(direct_url)
+
+        await send_screenshot(chat_id,
+                              msg_txt,
+                              direct_url,
+                              http_headers=http_headers)
+        return ENTRY_STOP
+    if cmd == 't':
+        thumb_url = entry.get('thumbnail')
+        if thumb_url:
+            await _bot.send_photo(chat_id, thumb_url)
+        else:
+            await _bot.send_message(chat_id, 'Media don\'t contain thumbnail')
+
+        return ENTRY_STOP
+
+    _cut_time = (cut_time_start, cut_time_end) if cut_time_start else None
+    cache_key = None
+    # file id is reused only if the file is sent the same way
+    cache_send_type = file_cache.send_type(audio_mode == True, entry.get('ext'))
+    if cmd != 'z':
+        cache_mode = 'audio' if audio_mode == True else ('remux' if cmd == 'm' else 'video')
+        cache_key = file_cache.key_for_entry(entry, cache_mode, _cut_time, cache_send_type)
+        cached = await send_cached_file(chat_id, msg_id, cache_key, user, entry, audio_mode, log,
+                                        before_send=wait_turn) if cache_key else None
+        if cached is not None:
+            if publish:
+                file_id, media_type = cached
+                publish((single_flight.FILE, media_type, file_id, entry['title']))
+            return ENTRY_DONE
+    try:
+        if formats is not None:
+            for i, f in enumerate(formats):
+                if f['protocol'] in ['rtsp', 'rtmp', 'rtmpe', 'mms', 'f4m', 'ism']:
+                    # await bot.send_message(chat_id, "ERROR: Failed find suitable format for: " + entry['title'], reply_to=msg_id)
+                    continue
+                if 'm3u8' in f['protocol']:
+                    _file_size, _size_error = await av_utils.m3u8_size_estimate(f['url'], http_headers)
+                    log.debug('m3u8 size estimate {} ±{}'.format(_file_size, _size_error))
+                elif dash_fetcher.is_dash(f):
+                    _file_size = dash_fetcher.size_estimate(f, entry.get('duration'))
+                else:
+                    if 'filesize' in f and f['filesize'] != 0 and f['filesize'] is not None and f[
+                        'filesize'] != 'none':
+                        _file_size = f['filesize']
+                    else:
+                        try:
+                            direct_url = f['url']
+                            if 'invidio.us' in direct_url:
+                                direct_url = normalize_url_path(direct_url)
+                            _file_size = await av_utils.media_size(direct_url, http_headers=http_headers)
+                        except Exception as e:
+                            if i < len(formats) - 1 and '404 Not Found' in str(e):
                                 break
-                            if 'm3u8' in entry['protocol']:
-                                if cut_time_start is None and entry.get('is_live', False) is False and audio_mode == False:
-                                    _file_size = await av_utils.m3u8_video_size(entry['url'], http_headers=http_headers)
-                                else:
-                                    # we don't know real size
-                                    _file_size = 0
-                            else:
-                                if 'filesize' in entry and entry['filesize'] != 0 and entry['filesize'] is not None and \
-                                        entry['filesize'] != 'none':
-                                    _file_size = entry['filesize']
-                                else:
-                                    direct_url = entry['url']
-                                    if 'invidio.us' in direct_url:
-                                        entry['url'] = normalize_url_path(direct_url)
-                                    try:
-                                        _file_size = await av_utils.media_size(direct_url, http_headers=http_headers)
-                                    except:
-                                        _file_size = 1500 * 1024 * 1024
-                            if ('m3u8' in entry['protocol'] and
-                                    (_file_size <= TG_MAX_FILE_SIZE or cut_time_start is not None or cmd == 'z')):
-                                chosen_format = entry
-                                if entry.get('is_live') and not _cut_time:
-                                    if cmd != 'z':
-                                        cut_time_start, cut_time_end = (time(hour=0, minute=0, second=0),
-                                                                        time(hour=1, minute=0, second=0))
-                                    else:
-                                        cut_time_start, cut_time_end = (time(hour=0, minute=0, second=0),
-                                                                        time(hour=5, minute=30, second=0))
-                                    _cut_time = (cut_time_start, cut_time_end)
-                                file_name = None
-                                if not cut_time_start and STORAGE_SIZE > _file_size > 0:
-                                    STORAGE_SIZE -= _file_size
-                                    _ext = 'mp4' if audio_mode == False else 'mp3'
-                                    file_name = str(chat_id) + ':' + str(msg_id) + ':' + entry['title'] + '.' + _ext
-                                ffmpeg_av = await av_source.FFMpegAV.create(chosen_format,
-                                                                            audio_only=True if audio_mode == True else False,
-                                                                            headers=http_headers,
-                                                                            cut_time_range=_cut_time,
-                                                                            file_name=file_name if cmd != 'z' else None,
-                                                                            restrict_size=False if cmd == 'z' else True)
-                            elif (_file_size <= TG_MAX_FILE_SIZE) or cut_time_start is not None or cmd == 'z':
-                                chosen_format = entry
-                                direct_url = chosen_format['url']
-                                if 'invidio.us' in direct_url:
-                                    chosen_format['url'] = normalize_url_path(direct_url)
-                                if audio_mode == True and not (chosen_format['ext'] == 'mp3'):
-                                    ffmpeg_av = await av_source.FFMpegAV.create(chosen_format,
-                                                                                audio_only=True,
-                                                                                headers=http_headers,
-                                                                                cut_time_range=_cut_time,
-                                                                                restrict_size=False if cmd == 'z' else True)
-
-                        if chosen_format is None and ffmpeg_av is None and cmd != 'z':
-                            if len(preferred_formats) - 1 == ip:
-                                if _file_size > TG_MAX_FILE_SIZE:
-                                    log.info('too big file ' + str(_file_size))
-                                    if 'http' in entry.get('protocol', '') and 'unknown' in entry.get('format', '') and entry.get('ext', '') not in ['unknown_video', 'mp3', 'mp4', 'm4a', 'ogg', 'mkv', 'flv', 'avi', 'webm']:
-                                        if not user.donator:
-                                            await _bot.send_message(chat_id,
-                                                                    'File bigger than *1.5 GB*\n' +
-                                                                    'Only *donators* can download files above this limit\n' +
-                                                                    'Donate to me at least *5$* to use this feature\n'
-                                                                    'Send /donate command to get info\n'
-                                                                    'Notify @pony0boy after donation',
-                                                                    reply_to_message_id=msg_id,
-                                                                    parse_mode='Markdown')
-                                            return
-                                        source = await av_source.URLav.create(entry.get('url'), http_headers)
-                                        await upload_multipart_zip(source, entry['title']+'.'+entry['ext'], _file_size, chat_id, msg_id)
-                                    else:
-                                        await _bot.send_message(chat_id,
-                                                                f'ERROR: Too big media file size *{sizeof_fmt(_file_size)}*,\n'
-                                                                'Telegram allow only up to *1.5GB*\n'
-                                                                'you can try cut it by command like:\n `/c 0-10:00 ' + u + '`',
-                                                                reply_to_message_id=msg_id,
-                                                                parse_mode="Markdown")
-                                else:
-                                    log.info('failed find suitable media format')
-                                    await _bot.send_message(chat_id, "ERROR: Failed find suitable media format",
-                                                            reply_to_message_id=msg_id)
-                                # await bot.send_message(chat_id, "ERROR: Failed find suitable video format", reply_to=msg_id)
-                                return
-                            # if 'playlist' in entry and entry['playlist'] is not None:
-                            recover_playlist_index = ie
-                            break
-                        if cmd == 'z':
-                            if not user.donator:
-                                await _bot.send_message(chat_id,
-                                                        'Only *donators* can use multipart archiving\n' +
-                                                        'Donate to me at least *5$* to use this feature\n'
-                                                        'Send /donate command to get info\n'
-                                                        'Notify @pony0boy after donation',
-                                                        reply_to_message_id=msg_id,
-                                                        parse_mode='Markdown')
-                                return
-                            if 'unknown' in entry.get('ext', '') or 'php' in entry.get('ext', ''):
-                                mime, cd_file_name = await av_utils.media_mime(entry['url'],
-                                                                               http_headers=http_headers)
-                                if cd_file_name:
-                                    cd_splited_file_name, cd_ext = os.path.splitext(cd_file_name)
-                                    if len(cd_ext) > 0:
-                                        entry['ext'] = cd_ext[1:]
-                                    else:
-                                        entry['ext'] = 'bin'
-                                    if len(cd_splited_file_name) > 0:
-                                        entry['title'] = cd_splited_file_name
-                                else:
-                                    ext = mimetypes.guess_extension(mime)
-                                    if ext is None or ext == '' or ext == '.bin':
-                                        entry['ext'] = 'bin'
-                                    else:
-                                        ext = ext[1:]
-                                        entry['ext'] = ext
-                            upload_file = ffmpeg_av if ffmpeg_av is not None else await av_source.URLav.create(
-                                chosen_format['url'],
-                                http_headers)
-                            await upload_multipart_zip(upload_file,
-                                                       entry['title'] + '.' + entry['ext'], _file_size, chat_id,
-                                                       msg_id)
-                            return
-                        if audio_mode == True and _file_size != 0 and (ffmpeg_av is None or ffmpeg_av.file_name is None):
-                            # we don't know real size due to converting formats
-                            # so increase it in case of real size is less large then estimated
-                            _file_size += 10 * 1024 * 1024  # 10MB
-
-                        log.debug('uploading file')
-
-                        width = height = duration = video_codec = audio_codec = None
-                        title = performer = None
-                        format_name = ''
-                        if audio_mode == True:
-                            if entry.get('duration') is None and chosen_format.get('duration') is None:
-                                # info = await av_utils.av_info(chosen_format['url'],
-                                #                               use_m3u8=('m3u8' in chosen_format['protocol']))
-                                info = await av_utils.av_info(chosen_format['url'], http_headers=http_headers)
-                                duration = int(float(info['format'].get('duration', 0)))
                             else:
-                                duration = int(chosen_format['duration']) if 'duration' not in entry else int(
-                                    entry['duration'])
-
-                        elif (entry.get('duration') is None and chosen_format.get('duration') is None) or \
-                                (chosen_format.get('width') is None or chosen_format.get('height') is None):
-                            # info =  await av_utils.av_info(chosen_format['url'],
-                            #                                use_m3u8=('m3u8' in chosen_format['protocol']))
-                            info = await av_utils.av_info(chosen_format['url'], http_headers=http_headers)
-                            try:
-                                streams = info['streams']
-                                for s in streams:
-                                    if s.get('codec_type') == 'video':
-                                        width = s['width']
-                                        height = s['height']
-                                        video_codec = s['codec_name']
-                                    elif s.get('codec_type') == 'audio':
-                                        audio_codec = s['codec_name']
-                                if video_codec is None:
-                                    audio_mode = True
-                                _av_format = info['format']
-                                duration = int(float(_av_format.get('duration', 0)))
-                                format_name = _av_format.get('format_name', '').split(',')[0]
-                                av_tags = _av_format.get('tags')
-                                if av_tags is not None and len(av_tags.keys()) > 0:
-                                    title = av_tags.get('title')
-                                    performer = av_tags.get('artist')
-                                    if performer is None:
-                                        performer = av_tags.get('album')
-                                _av_ext = chosen_format.get('ext', '')
-                                if _av_ext == 'mp3' or _av_ext == 'm4a' or _av_ext == 'ogg' or format_name == 'mp3' or format_name == 'ogg':
-                                    audio_mode = True
-                            except KeyError:
-                                width = 0
-                                height = 0
-                                duration = 0
-                                format_name = ''
+                                raise
+
+                # Dash video
+                if f['protocol'] in ('https', dash_fetcher.DASH_PROTOCOL) and \
+                        (True if ('acodec' in f and (
+                                f['acodec'] == 'none' or f['acodec'] == None)) else False):
+                    vformat = f
+                    mformat = None
+                    vsize = 0
+
+                    direct_url = vformat['url']
+                    if 'invidio.us' in direct_url:
+                        vformat['url'] = normalize_url_path(direct_url)
+
+                    if dash_fetcher.is_dash(vformat):
+                        vsize = dash_fetcher.size_estimate(vformat, entry.get('duration'))
+                    elif 'filesize' in vformat and vformat['filesize'] != 0 and vformat[
+                        'filesize'] is not None and vformat['filesize'] != 'none':
+                        vsize = vformat['filesize']
+                    else:
+                        vsize = await av_utils.media_size(vformat['url'], http_headers=http_headers)
+                    msize = 0
+                    # if there is one more format than
+                    # it's likely an url to audio
+                    if len(formats) > i + 1:
+                        mformat = formats[i + 1]
+
+                        direct_url = mformat['url']
+                        if 'invidio.us' in direct_url:
+                            mformat['url'] = normalize_url_path(direct_url)
+
+                        if dash_fetcher.is_dash(mformat):
+                            msize = dash_fetcher.size_estimate(mformat, entry.get('duration'))
+                        elif 'filesize' in mformat and mformat['filesize'] != 0 and mformat[
+                            'filesize'] is not None and mformat['filesize'] != 'none':
+                            msize = mformat['filesize']
                         else:
-                            width, height, duration = chosen_format['width'], chosen_format['height'], \
-                                                      int(chosen_format[
-                                                              'duration']) if 'duration' not in entry else int(
-                                                          entry['duration'])
-                        if 'm3u8' in chosen_format.get('protocol',
-                                                       '') and duration == 0 and ffmpeg_av is not None and cut_time_start is None:
-                            if cmd != 'z':
-                                cut_time_start, cut_time_end = (time(hour=0, minute=0, second=0),
-                                                                time(hour=1, minute=0, second=0))
-                            else:
-                                cut_time_start, cut_time_end = (time(hour=0, minute=0, second=0),
-                                                                time(hour=5, minute=30, second=0))
-                            _cut_time = (cut_time_start, cut_time_end)
-                            ffmpeg_av.close()
-                            ffmpeg_av = None
-
-                        if 'mp4 - unknown' in chosen_format.get('format', '') and chosen_format.get('ext', '') != 'mp4':
-                            chosen_format['ext'] = 'mp4'
-                        elif 'unknown' in chosen_format['ext'] or 'php' in chosen_format['ext']:
-                            mime, cd_file_name = await av_utils.media_mime(chosen_format['url'],
-                                                                           http_headers=http_headers)
-                            if cd_file_name:
-                                cd_splited_file_name, cd_ext = os.path.splitext(cd_file_name)
-                                if len(cd_ext) > 0:
-                                    chosen_format['ext'] = cd_ext[1:]
-                                else:
-                                    chosen_format['ext'] = ''
-                                if len(cd_splited_file_name) > 0:
-                                    chosen_format['title'] = cd_splited_file_name
-                            else:
-                                ext = mimetypes.guess_extension(mime)
-                                if ext is None or ext == '' or ext == '.bin':
-                                    if format_name is None or format_name == '':
-                                        chosen_format['ext'] = 'bin'
-                                    else:
-                                        if format_name == 'mov':
-                                            if audio_mode == True:
-                                                format_name = 'm4a'
-                                            else:
-                                                format_name = 'mp4'
-                                        if format_name == 'matroska':
-                                            format_name = 'mkv'
-                                        chosen_format['ext'] = format_name
-                                else:
-                                    ext = ext[1:]
-                                    chosen_format['ext'] = ext
-
-                        # in case of video is live we don't know real duration
-                        if cut_time_start is not None:
-                            if not entry.get('is_live') and duration > 1:
-                                if cut_time.time_to_seconds(cut_time_start) > duration:
-                                    await _bot.send_message(chat_id,
-                                                            'ERROR: Cut start time is bigger than media duration: *' + str(
-                                                                timedelta(seconds=duration)) + '*',
-                                                            parse_mode='Markdown')
-                                    return
-                                elif cut_time_end is not None and (
-                                        cut_time.time_to_seconds(cut_time_end) > duration != 0):
-                                    await _bot.send_message(chat_id,
-                                                            'ERROR: Cut end time is bigger than media duration: *' + str(
-                                                                timedelta(seconds=duration)) + '*\n'
-                                                                                               'You can eliminate end time if you want it to be equal to media duration\n'
-                                                                                               'Like: `/c 1:24 youtube.com`',
-                                                            parse_mode='Markdown')
-                                    return
-                            if cut_time_end is None:
-                                if duration == 0:
-                                    duration = 20000
-                                duration = abs(duration - cut_time.time_to_seconds(cut_time_start))
+                            msize = await av_utils.media_size(mformat['url'], http_headers=http_headers)
+                    # we can't precisely predict media size so make it large for prevent cutting
+                    _file_size = vsize + msize + 10 * 1024 * 1024
+                    if _file_size < TG_MAX_FILE_SIZE or cut_time_start is not None or cmd == 'z':
+                        file_name = None
+                        if cmd != 'z':
+                            file_name = await local_output_name(storage_lease, _file_size, chat_id, msg_id,
+                                                                entry['title'], audio_mode, log)
+                        ffmpeg_av = await av_source.FFMpegAV.create(vformat,
+                                                                    mformat,
+                                                                    headers=http_headers,
+                                                                    cut_time_range=_cut_time,
+                                                                    file_name=file_name,
+                                                                    restrict_size=False if cmd == 'z' else True)
+                        chosen_format = f
+                    break
+                # m3u8
+                if ('m3u8' in f['protocol'] and
+                        (_file_size <= TG_MAX_FILE_SIZE or cut_time_start is not None or cmd == 'z')):
+                    chosen_format = f
+                    acodec = f.get('acodec')
+                    if acodec is None or acodec == 'none':
+                        if len(formats) > i + 1:
+                            mformat = formats[i + 1]
+                            if 'filesize' in mformat and mformat['filesize'] != 0 and mformat[
+                                'filesize'] is not None and mformat['filesize'] != 'none':
+                                msize = mformat['filesize']
                             else:
-                                duration = abs(
-                                    cut_time.time_to_seconds(cut_time_end) - cut_time.time_to_seconds(cut_time_start))
-
-                        if (cut_time_start is not None or (audio_mode == True and (
-                                chosen_format.get('ext') not in ['mp3', 'm4a', 'ogg']))) and ffmpeg_av is None:
-                            ext = chosen_format.get('ext')
-                            ffmpeg_av = await av_source.FFMpegAV.create(chosen_format,
-                                                                        headers=http_headers,
-                                                                        cut_time_range=_cut_time,
-                                                                        ext=ext,
-                                                                        audio_only=True if audio_mode == True else False,
-                                                                        format_name=format_name if ext != 'mp4' and format_name != '' else '')
-                        if cmd == 'm' and chosen_format.get('ext') != 'mp4' and ffmpeg_av is None and (
-                                video_codec == 'h264' or video_codec == 'hevc') and \
-                                (audio_codec == 'mp3' or audio_codec == 'aac'):
-                            file_name = entry.get('title', 'default') + '.mp4'
-                            if STORAGE_SIZE > _file_size > 0:
-                                STORAGE_SIZE -= _file_size
-                                ffmpeg_av = await av_source.FFMpegAV.create(chosen_format,
-                                                                            headers=http_headers,
-                                                                            file_name=file_name)
-                        upload_file = ffmpeg_av if ffmpeg_av is not None else await av_source.URLav.create(
-                            chosen_format['url'],
-                            http_headers)
-
-                        ext = (
-                            chosen_format['ext'] if ffmpeg_av is None or ffmpeg_av.format is None else ffmpeg_av.format)
-                        file_name_no_ext = entry['title']
-                        if not file_name_no_ext[-1].isalnum():
-                            file_name_no_ext = file_name_no_ext[:-1] + '_'
-                        file_name = file_name_no_ext + '.' + ext
-                        if _file_size == 0:
-                            log.warning('file size is 0')
-
-                        file_size = _file_size if _file_size != 0 and _file_size < TG_MAX_FILE_SIZE else TG_MAX_FILE_SIZE
-
-                        ffmpeg_cancel_task = None
-                        if ffmpeg_av is not None:
-                            cancel_time = 20000
-                            if cut_time_start is not None:
-                                cancel_time += duration + 300
-                            ffmpeg_cancel_task = asyncio.get_event_loop().call_later(cancel_time, ffmpeg_av.safe_close)
-                        global TG_CONNECTIONS_COUNT
-                        global TG_MAX_PARALLEL_CONNECTIONS
-                        try:
-                            if ffmpeg_av and ffmpeg_av.file_name:
-                                await ffmpeg_av.stream.wait()
-                                file_size_real = os.path.getsize(ffmpeg_av.file_name)
-                                STORAGE_SIZE += file_size - file_size_real
-                                file_size = file_size_real
-                                local_file = aiofiles.open(ffmpeg_av.file_name, mode='rb')
-                                upload_file = await local_file.__aenter__()
-                            # uploading piped ffmpeg file is slow anyway
-                            # TODO проверка на то что ffmpeg_av имееет file_name
-                            if (file_size > 20 * 1024 * 1024 and TG_CONNECTIONS_COUNT < TG_MAX_PARALLEL_CONNECTIONS) and \
-                                    (isinstance(upload_file, av_source.URLav) or
-                                     isinstance(upload_file, aiofiles.threadpool.binary.AsyncBufferedReader)):
-                                try:
-                                    connections = 2
-                                    if TG_CONNECTIONS_COUNT < 12 and file_size > 100 * 1024 * 1024:
-                                        connections = 4
-
-                                    TG_CONNECTIONS_COUNT += connections
-                                    file = await fast_telethon.upload_file(client,
-                                                                           upload_file,
-                                                                           file_size,
-                                                                           file_name,
-                                                                           max_connection=connections)
-                                finally:
-                                    TG_CONNECTIONS_COUNT -= connections
+                                msize = await av_utils.media_size(mformat['url'],
+                                                                  http_headers=http_headers)
+                            msize += 10 * 1024 * 1024
+                            if (msize + _file_size) > TG_MAX_FILE_SIZE and cut_time_start is None and cmd != 'z':
+                                mformat = None
                             else:
-                                file = await client.upload_file(upload_file,
+                                _file_size += msize
+
+                    file_name = None
+                    if cmd != 'z':
+                        file_name = await local_output_name(storage_lease, _file_size, chat_id, msg_id,
+                                                            entry['title'], audio_mode, log)
+                    ffmpeg_av = await av_source.FFMpegAV.create(chosen_format,
+                                                                aformat=mformat,
+                                                                audio_only=True if audio_mode == True else False,
+                                                                headers=http_headers,
+                                                                cut_time_range=_cut_time,
                                                                 file_name=file_name,
-                                                                file_size=file_size,
-                                                                http_headers=http_headers)
-                        except AuthKeyDuplicatedError as e:
-                            await _bot.send_message(chat_id, 'INTERNAL ERROR: try again')
-                            log.fatal(e)
-                            os.abort()
-                        except ConnectionError as e:
-                            if 'Cannot send requests while disconnected' in str(e):
-                                await client.connect()
-                                continue
-                            raise
-                        finally:
-                            if ffmpeg_av and ffmpeg_av.file_name:
-                                STORAGE_SIZE += file_size
-                                if STORAGE_SIZE > MAX_STORAGE_SIZE:
-                                    log.warning('logic error, reclaimed storage size bigger then initial')
-                                    STORAGE_SIZE = MAX_STORAGE_SIZE
-                                if isinstance(upload_file, aiofiles.threadpool.binary.AsyncBufferedReader):
-                                    await local_file.__aexit__(exc_type=None, exc_val=None, exc_tb=None)
-                                try:
-                                    os.remove(ffmpeg_av.file_name)
-                                except Exception as e:
-                                    log.exception(e)
-
-                            if ffmpeg_cancel_task is not None and not ffmpeg_cancel_task.cancelled():
-                                ffmpeg_cancel_task.cancel()
-
-                            if upload_file is not None:
-                                if inspect.iscoroutinefunction(upload_file.close):
-                                    await upload_file.close()
-                                else:
-                                    upload_file.close()
-
-                        attributes = None
-                        if audio_mode == True:
-                            if performer is None:
-                                performer = entry['artist'] if ('artist' in entry) and \
-                                                               (entry['artist'] is not None) else None
-                            if title is None:
-                                title = entry['alt_title'] if ('alt_title' in entry) and \
-                                                              (entry['alt_title'] is not None) else entry['title']
-                            attributes = DocumentAttributeAudio(duration, title=title, performer=performer)
-                        elif ext == 'mp4':
-                            supports_streaming = False if ffmpeg_av is not None and ffmpeg_av.file_name is None else True
-                            attributes = DocumentAttributeVideo(duration,
-                                                                width,
-                                                                height,
-                                                                supports_streaming=supports_streaming)
-                        else:
-                            attributes = DocumentAttributeFilename(file_name)
-                        force_document = False
-                        if ext != 'mp4' and audio_mode == False:
-                            force_document = True
-                        log.debug('sending file')
-                        video_note = False if audio_mode == True or force_document else True
-                        voice_note = True if audio_mode == True else False
-                        attributes = ((attributes,) if not force_document else None)
-                        caption = entry['title'] if (user.default_media_type == users.DefaultMediaType.Video.value
-                                                     and user.video_caption and audio_mode == False) or \
-                                                    (((user.default_media_type == users.DefaultMediaType.Audio.value) or
-                                                      (audio_mode == True))
-                                                     and user.audio_caption) else ''
-                        recover_playlist_index = None
-                        _thumb = None
-                        try:
-                            _thumb = await thumb.get_thumbnail(entry.get('thumbnail'), chosen_format)
-                        except Exception as e:
-                            log.warning('failed get thumbnail: ' + str(e))
-
-                        for i in range(10):
-                            try:
-                                await client.send_file(bot_entity, file,
-                                                       video_note=video_note,
-                                                       voice_note=voice_note,
-                                                       attributes=attributes,
-                                                       caption=str(chat_id) + ":" + str(msg_id) + ":" + caption,
-                                                       force_document=force_document,
-                                                       supports_streaming=False if ffmpeg_av is not None else True,
-                                                       thumb=_thumb)
-                            except AuthKeyDuplicatedError as e:
-                                await _bot.send_message(chat_id, 'INTERNAL ERROR: try again')
-                                log.fatal(e)
-                                os.abort()
-                            except Exception as e:
-                                log.exception(e)
-                                await asyncio.sleep(1)
-                                continue
-
-                            break
-                    except AuthKeyDuplicatedError as e:
-                        await _bot.send_message(chat_id, 'INTERNAL ERROR: try again')
-                        log.fatal(e)
-                        os.abort()
-                    except Exception as e:
-                        if len(preferred_formats) - 1 <= ip:
-                            # raise exception for notify user about error
-                            raise
-                        else:
-                            log.warning(e)
-                            recover_playlist_index = ie
-
-                if recover_playlist_index is None:
+                                                                restrict_size=False if cmd == 'z' else True)
+                    break
+                # dash format which has audio too is remuxed from its fragments
+                if (dash_fetcher.is_dash(f) and
+                        (_file_size <= TG_MAX_FILE_SIZE or cut_time_start is not None or cmd == 'z')):
+                    chosen_format = f
+                    file_name = None
+                    if cmd != 'z':
+                        file_name = await local_output_name(storage_lease, _file_size, chat_id, msg_id,
+                                                            entry['title'], audio_mode, log)
+                    ffmpeg_av = await av_source.FFMpegAV.create(chosen_format,
+                                                                audio_only=True if audio_mode == True else False,
+                                                                headers=http_headers,
+                                                                cut_time_range=_cut_time,
+                                                                file_name=file_name,
+                                                                restrict_size=False if cmd == 'z' else True)
                     break
+                # regular video stream
+                if (0 < _file_size <= TG_MAX_FILE_SIZE) or cut_time_start is not None or cmd == 'z':
+                    chosen_format = f
+
+                    direct_url = chosen_format['url']
+                    if 'invidio.us' in direct_url:
+                        chosen_format['url'] = normalize_url_path(direct_url)
+
+                    if audio_mode == True and not (chosen_format['ext'] == 'mp3'):
+                        ffmpeg_av = await av_source.FFMpegAV.create(chosen_format,
+                                                                    audio_only=True,
+                                                                    headers=http_headers,
+                                                                    cut_time_range=_cut_time,
+                                                                    restrict_size=False if cmd == 'z' else True)
+                    break
+
+        else:
+            if entry['protocol'] in ['rtsp', 'rtmp', 'rtmpe', 'mms', 'f4m', 'ism']:
+                # await bot.send_message(chat_id, "ERROR: Failed find suitable format for : " + entry['title'], reply_to=msg_id)
+                # if 'playlist' in entry and entry['playlist'] is not None:
+                return ENTRY_RETRY
+            if 'm3u8' in entry['protocol']:
+                if cut_time_start is None and entry.get('is_live', False) is False and audio_mode == False:
+                    _file_size, _size_error = await av_utils.m3u8_size_estimate(entry['url'], http_headers=http_headers)
+                    log.debug('m3u8 size estimate {} ±{}'.format(_file_size, _size_error))
+                else:
+                    # we don't know real size
+                    _file_size = 0
+            elif dash_fetcher.is_dash(entry):
+                _file_size = dash_fetcher.size_estimate(entry)
+            else:
+                if 'filesize' in entry and entry['filesize'] != 0 and entry['filesize'] is not None and \
+                        entry['filesize'] != 'none':
+                    _file_size = entry['filesize']
+                else:
+                    direct_url = entry['url']
+                    if 'invidio.us' in direct_url:
+                        entry['url'] = normalize_url_path(direct_url)
+                    try:
+                        _file_size = await av_utils.media_size(direct_url, http_headers=http_headers)
+                    except:
+                        _file_size = 1500 * 1024 * 1024
+            if (('m3u8' in entry['protocol'] or dash_fetcher.is_dash(entry)) and
+                    (_file_size <= TG_MAX_FILE_SIZE or cut_time_start is not None or cmd == 'z')):
+                chosen_format = entry
+                if entry.get('is_live') and not _cut_time:
+                    if cmd != 'z':
+                        cut_time_start, cut_time_end = (time(hour=0, minute=0, second=0),
+                                                        time(hour=1, minute=0, second=0))
+                    else:
+                        cut_time_start, cut_time_end = (time(hour=0, minute=0, second=0),
+                                                        time(hour=5, minute=30, second=0))
+                    _cut_time = (cut_time_start, cut_time_end)
+                file_name = None
+                if cmd != 'z':
+                    file_name = await local_output_name(storage_lease, _file_size, chat_id, msg_id,
+                                                        entry['title'], audio_mode, log)
+                ffmpeg_av = await av_source.FFMpegAV.create(chosen_format,
+                                                            audio_only=True if audio_mode == True else False,
+                                                            headers=http_headers,
+                                                            cut_time_range=_cut_time,
+                                                            file_name=file_name,
+                                                            restrict_size=False if cmd == 'z' else True)
+            elif (_file_size <= TG_MAX_FILE_SIZE) or cut_time_start is not None or cmd == 'z':
+                chosen_format = entry
+                direct_url = chosen_format['url']
+                if 'invidio.us' in direct_url:
+                    chosen_format['url'] = normalize_url_path(direct_url)
+                if audio_mode == True and not (chosen_format['ext'] == 'mp3'):
+                    ffmpeg_av = await av_source.FFMpegAV.create(chosen_format,
+                                                                audio_only=True,
+                                                                headers=http_headers,
+                                                                cut_time_range=_cut_time,
+                                                                restrict_size=False if cmd == 'z' else True)
+
+        if chosen_format is None and ffmpeg_av is None and cmd != 'z':
+            if len(preferred_formats) - 1 == ip:
+                if _file_size > TG_MAX_FILE_SIZE:
+                    log.info('too big file ' + str(_file_size))
+                    if 'http' in entry.get('protocol', '') and 'unknown' in entry.get('format', '') and entry.get('ext', '') not in ['unknown_video', 'mp3', 'mp4', 'm4a', 'ogg', 'mkv', 'flv', 'avi', 'webm']:
+                        if not user.donator:
+                            await _bot.send_message(chat_id,
+                                                    'File bigger than *1.5 GB*\n' +
+                                                    'Only *donators* can download files above this limit\n' +
+                                                    'Donate to me at least *5$* to use this feature\n'
+                                                    'Send /donate command to get info\n'
+                                                    'Notify @pony0boy after donation',
+                                                    reply_to_message_id=msg_id,
+                                                    parse_mode='Markdown')
+                            return ENTRY_STOP
+                        source = await av_source.URLav.create(entry.get('url'), http_headers)
+                        await upload_multipart_zip(source, entry['title']+'.'+entry['ext'], _file_size, chat_id, msg_id)
+                    else:
+                        await send_entry_error(chat_id,
+                                               f'ERROR: Too big media file size *{sizeof_fmt(_file_size)}*,\n'
+                                               'Telegram allow only up to *1.5GB*\n'
+                                               'you can try cut it by command like:\n `/c 0-10:00 ' + u + '`',
+                                               publish,
+                                               reply_to_message_id=msg_id,
+                                               parse_mode="Markdown")
+                else:
+                    log.info('failed find suitable media format')
+                    await send_entry_error(chat_id, "ERROR: Failed find suitable media format", publish,
+                                           reply_to_message_id=msg_id)
+                # await bot.send_message(chat_id, "ERROR: Failed find suitable video format", reply_to=msg_id)
+                return ENTRY_STOP
+            # if 'playlist' in entry and entry['playlist'] is not None:
+            return ENTRY_RETRY
+        if cmd == 'z':
+            if not user.donator:
+                await _bot.send_message(chat_id,
+                                        'Only *donators* can use multipart archiving\n' +
+                                        'Donate to me at least *5$* to use this feature\n'
+                                        'Send /donate command to get info\n'
+                                        'Notify @pony0boy after donation',
+                                        reply_to_message_id=msg_id,
+                                        parse_mode='Markdown')
+                return ENTRY_STOP
+            if 'unknown' in entry.get('ext', '') or 'php' in entry.get('ext', ''):
+                mime, cd_file_name = await av_utils.media_mime(entry['url'],
+                                                               http_headers=http_headers)
+                if cd_file_name:
+                    cd_splited_file_name, cd_ext = os.path.splitext(cd_file_name)
+                    if len(cd_ext) > 0:
+                        entry['ext'] = cd_ext[1:]
+                    else:
+                        entry['ext'] = 'bin'
+                    if len(cd_splited_file_name) > 0:
+                        entry['title'] = cd_splited_file_name
+                else:
+                    ext = mimetypes.guess_extension(mime)
+                    if ext is None or ext == '' or ext == '.bin':
+                        entry['ext'] = 'bin'
+                    else:
+                        ext = ext[1:]
+                        entry['ext'] = ext
+            upload_file = ffmpeg_av if ffmpeg_av is not None else await av_source.URLav.create(
+                chosen_format['url'],
+                http_headers)
+            await upload_multipart_zip(upload_file,
+                                       entry['title'] + '.' + entry['ext'], _file_size, chat_id,
+                                       msg_id)
+            return ENTRY_STOP
+        if audio_mode == True and _file_size != 0 and (ffmpeg_av is None or ffmpeg_av.file_name is None):
+            # we don't know real size due to converting formats
+            # so increase it in case of real size is less large then estimated
+            _file_size += 10 * 1024 * 1024  # 10MB
+
+        log.debug('uploading file')
+
+        width = height = duration = video_codec = audio_codec = None
+        title = performer = None
+        format_name = ''
+        if audio_mode == True:
+            if entry.get('duration') is None and chosen_format.get('duration') is None:
+                # info = await av_utils.av_info(chosen_format['url'],
+                #                               use_m3u8=('m3u8' in chosen_format['protocol']))
+                info = await av_utils.av_info(chosen_format['url'], http_headers=http_headers)
+                duration = int(float(info['format'].get('duration', 0)))
+            else:
+                duration = int(chosen_format['duration']) if 'duration' not in entry else int(
+                    entry['duration'])
+
+        elif (entry.get('duration') is None and chosen_format.get('duration') is None) or \
+                (chosen_format.get('width') is None or chosen_format.get('height') is None):
+            # info =  await av_utils.av_info(chosen_format['url'],
+            #                                use_m3u8=('m3u8' in chosen_format['protocol']))
+            info = await av_utils.av_info(chosen_format['url'], http_headers=http_headers)
+            try:
+                streams = info['streams']
+                for s in streams:
+                    if s.get('codec_type') == 'video':
+                        width = s['width']
+                        height = s['height']
+                        video_codec = s['codec_name']
+                    elif s.get('codec_type') == 'audio':
+                        audio_codec = s['codec_name']
+                if video_codec is None:
+                    audio_mode = True
+                _av_format = info['format']
+                duration = int(float(_av_format.get('duration', 0)))
+                format_name = _av_format.get('format_name', '').split(',')[0]
+                av_tags = _av_format.get('tags')
+                if av_tags is not None and len(av_tags.keys()) > 0:
+                    title = av_tags.get('title')
+                    performer = av_tags.get('artist')
+                    if performer is None:
+                        performer = av_tags.get('album')
+                _av_ext = chosen_format.get('ext', '')
+                if _av_ext == 'mp3' or _av_ext == 'm4a' or _av_ext == 'ogg' or format_name == 'mp3' or format_name == 'ogg':
+                    audio_mode = True
+            except KeyError:
+                width = 0
+                height = 0
+                duration = 0
+                format_name = ''
+        else:
+            width, height, duration = chosen_format['width'], chosen_format['height'], \
+                                      int(chosen_format[
+                                              'duration']) if 'duration' not in entry else int(
+                                          entry['duration'])
+        if 'm3u8' in chosen_format.get('protocol',
+                                       '') and duration == 0 and ffmpeg_av is not None and cut_time_start is None:
+            if cmd != 'z':
+                cut_time_start, cut_time_end = (time(hour=0, minute=0, second=0),
+                                                time(hour=1, minute=0, second=0))
+            else:
+                cut_time_start, cut_time_end = (time(hour=0, minute=0, second=0),
+                                                time(hour=5, minute=30, second=0))
+            _cut_time = (cut_time_start, cut_time_end)
+            # media was cut by default range, don't cache it as whole one
+            cache_key = None
+            ffmpeg_av.close()
+            ffmpeg_av = None
+            await storage_lease.release()
+
+        if 'mp4 - unknown' in chosen_format.get('format', '') and chosen_format.get('ext', '') != 'mp4':
+            chosen_format['ext'] = 'mp4'
+        elif 'unknown' in chosen_format['ext'] or 'php' in chosen_format['ext']:
+            mime, cd_file_name = await av_utils.media_mime(chosen_format['url'],
+                                                           http_headers=http_headers)
+            if cd_file_name:
+                cd_splited_file_name, cd_ext = os.path.splitext(cd_file_name)
+                if len(cd_ext) > 0:
+                    chosen_format['ext'] = cd_ext[1:]
+                else:
+                    chosen_format['ext'] = ''
+                if len(cd_splited_file_name) > 0:
+                    chosen_format['title'] = cd_splited_file_name
+            else:
+                ext = mimetypes.guess_extension(mime)
+                if ext is None or ext == '' or ext == '.bin':
+                    if format_name is None or format_name == '':
+                        chosen_format['ext'] = 'bin'
+                    else:
+                        if format_name == 'mov':
+                            if audio_mode == True:
+                                format_name = 'm4a'
+                            else:
+                                format_name = 'mp4'
+                        if format_name == 'matroska':
+                            format_name = 'mkv'
+                        chosen_format['ext'] = format_name
+                else:
+                    ext = ext[1:]
+                    chosen_format['ext'] = ext
+
+        # in case of video is live we don't know real duration
+        if cut_time_start is not None:
+            if not entry.get('is_live') and duration > 1:
+                if cut_time.time_to_seconds(cut_time_start) > duration:
+                    await send_entry_error(chat_id,
+                                           'ERROR: Cut start time is bigger than media duration: *' + str(
+                                               timedelta(seconds=duration)) + '*',
+                                           publish,
+                                           parse_mode='Markdown')
+                    return ENTRY_STOP
+                elif cut_time_end is not None and (
+                        cut_time.time_to_seconds(cut_time_end) > duration != 0):
+                    await send_entry_error(chat_id,
+                                           'ERROR: Cut end time is bigger than media duration: *' + str(
+                                               timedelta(seconds=duration)) + '*\n'
+                                                                              'You can eliminate end time if you want it to be equal to media duration\n'
+                                                                              'Like: `/c 1:24 youtube.com`',
+                                           publish,
+                                           parse_mode='Markdown')
+                    return ENTRY_STOP
+            if cut_time_end is None:
+                if duration == 0:
+                    duration = 20000
+                duration = abs(duration - cut_time.time_to_seconds(cut_time_start))
+            else:
+                duration = abs(
+                    cut_time.time_to_seconds(cut_time_end) - cut_time.time_to_seconds(cut_time_start))
+
+        if (cut_time_start is not None or (audio_mode == True and (
+                chosen_format.get('ext') not in ['mp3', 'm4a', 'ogg']))) and ffmpeg_av is None:
+            ext = chosen_format.get('ext')
+            file_name = None
+            if cmd != 'z':
+                # cut part is not bigger than whole media
+                file_name = await local_output_name(storage_lease, _file_size, chat_id, msg_id,
+                                                    entry['title'], audio_mode, log)
+            ffmpeg_av = await av_source.FFMpegAV.create(chosen_format,
+                                                        headers=http_headers,
+                                                        cut_time_range=_cut_time,
+                                                        ext=ext,
+                                                        audio_only=True if audio_mode == True else False,
+                                                        format_name=format_name if ext != 'mp4' and format_name != '' else '',
+                                                        file_name=file_name)
+        if cmd == 'm' and chosen_format.get('ext') != 'mp4' and ffmpeg_av is None and (
+                video_codec == 'h264' or video_codec == 'hevc') and \
+                (audio_codec == 'mp3' or audio_codec == 'aac'):
+            file_name = await local_output_name(storage_lease, _file_size, chat_id, msg_id,
+                                                entry.get('title', 'default'), False, log)
+            if file_name is not None:
+                ffmpeg_av = await av_source.FFMpegAV.create(chosen_format,
+                                                            headers=http_headers,
+                                                            file_name=file_name)
+        upload_file = ffmpeg_av if ffmpeg_av is not None else await av_source.URLav.create(
+            chosen_format['url'],
+            http_headers)
+
+        ext = (
+            chosen_format['ext'] if ffmpeg_av is None or ffmpeg_av.format is None else ffmpeg_av.format)
+        file_name_no_ext = entry['title']
+        if not file_name_no_ext[-1].isalnum():
+            file_name_no_ext = file_name_no_ext[:-1] + '_'
+        file_name = file_name_no_ext + '.' + ext
+        if _file_size == 0:
+            log.warning('file size is 0')
+
+        file_size = _file_size if _file_size != 0 and _file_size < TG_MAX_FILE_SIZE else TG_MAX_FILE_SIZE
+
+        ffmpeg_cancel_task = None
+        # progress of local file upload which survives restart
+        checkpoint = None
+        if ffmpeg_av is not None:
+            cancel_time = 20000
+            if cut_time_start is not None:
+                cancel_time += duration + 300
+            ffmpeg_cancel_task = asyncio.get_event_loop().call_later(cancel_time, ffmpeg_av.safe_close)
+        try:
+            if ffmpeg_av and ffmpeg_av.file_name:
+                await ffmpeg_av.stream.wait()
+                ffmpeg_av.check_feeders()
+                # hold only the space which file really takes
+                await storage_lease.settle()
+                file_size = os.path.getsize(ffmpeg_av.file_name)
+                await upload_journal.journal.output_done(ffmpeg_av.file_name, chat_id, msg_id, file_size)
+                checkpoint = await upload_journal.journal.checkpoint(ffmpeg_av.file_name, file_size)
+                local_file = aiofiles.open(ffmpeg_av.file_name, mode='rb')
+                upload_file = await local_file.__aenter__()
+            # uploading piped ffmpeg file is slow anyway
+            # TODO проверка на то что ffmpeg_av имееет file_name
+            file = None
+            if file_size > 20 * 1024 * 1024 and \
+                    (isinstance(upload_file, av_source.URLav) or
+                     isinstance(upload_file, aiofiles.threadpool.binary.AsyncBufferedReader)):
+                # waits a bit for free connections, falls back to the main one if there is none
+                async with connection_scheduler.scheduler.acquire(file_size) as grant:
+                    if grant.count > 0:
+                        file = await fast_telethon.upload_file(client,
+                                                               upload_file,
+                                                               file_size,
+                                                               file_name,
+                                                               grant=grant,
+                                                               checkpoint=checkpoint)
+            if file is None:
+                file = await client.upload_file(upload_file,
+                                                file_name=file_name,
+                                                file_size=file_size,
+                                                http_headers=http_headers)
+            if ffmpeg_av is not None:
+                # piped output may be read up to its size without reaching the end
+                ffmpeg_av.check_feeders()
+        except AuthKeyDuplicatedError as e:
+            await _bot.send_message(chat_id, 'INTERNAL ERROR: try again')
+            log.fatal(e)
+            os.abort()
+        except ConnectionError as e:
+            if 'Cannot send requests while disconnected' in str(e):
+                await client.connect()
+                return ENTRY_DONE
+            raise
+        finally:
+            if ffmpeg_av and ffmpeg_av.file_name:
+                if isinstance(upload_file, aiofiles.threadpool.binary.AsyncBufferedReader):
+                    await local_file.__aexit__(exc_type=None, exc_val=None, exc_tb=None)
+                # removes local file and frees its space
+                await storage_lease.release()
+
+            if ffmpeg_cancel_task is not None and not ffmpeg_cancel_task.cancelled():
+                ffmpeg_cancel_task.cancel()
+
+            if upload_file is not None:
+                if inspect.iscoroutinefunction(upload_file.close):
+                    await upload_file.close()
+                else:
+                    upload_file.close()
+
+        attributes = None
+        if audio_mode == True:
+            if performer is None:
+                performer = entry['artist'] if ('artist' in entry) and \
+                                               (entry['artist'] is not None) else None
+            if title is None:
+                title = entry['alt_title'] if ('alt_title' in entry) and \
+                                              (entry['alt_title'] is not None) else entry['title']
+            attributes = DocumentAttributeAudio(duration, title=title, performer=performer)
+        elif ext == 'mp4':
+            supports_streaming = False if ffmpeg_av is not None and ffmpeg_av.file_name is None else True
+            attributes = DocumentAttributeVideo(duration,
+                                                width,
+                                                height,
+                                                supports_streaming=supports_streaming)
+        else:
+            attributes = DocumentAttributeFilename(file_name)
+        force_document = False
+        if ext != 'mp4' and audio_mode == False:
+            force_document = True
+        log.debug('sending file')
+        video_note = False if audio_mode == True or force_document else True
+        voice_note = True if audio_mode == True else False
+        attributes = ((attributes,) if not force_document else None)
+        caption = media_caption(user, entry, audio_mode)
+        if cache_key and file_cache.send_type(audio_mode == True, ext, force_document) != cache_send_type:
+            # output format differs from entry one, file id can't be found by this key
+            log.debug('file of other send type is not cached')
+            cache_key = None
+        if cache_key:
+            file_cache.cache.expect(cache_key)
+        _thumb = None
+        try:
+            _thumb = await thumb.get_thumbnail(entry.get('thumbnail'), chosen_format)
+        except Exception as e:
+            log.warning('failed get thumbnail: ' + str(e))
+
+        # previous urls of message must be sent first
+        await wait_turn()
+        # file id comes back with token, it's shared with followers of the request
+        flight_token = single_flight.flights.expect_file() if publish else None
+        for i in range(10):
+            try:
+                await client.send_file(bot_entity, file,
+                                       video_note=video_note,
+                                       voice_note=voice_note,
+                                       attributes=attributes,
+                                       caption=file_cache.caption_prefix(chat_id, msg_id, cache_key,
+                                                                         flight_token) + caption,
+                                       force_document=force_document,
+                                       supports_streaming=False if ffmpeg_av is not None else True,
+                                       thumb=_thumb)
+            except AuthKeyDuplicatedError as e:
+                await _bot.send_message(chat_id, 'INTERNAL ERROR: try again')
+                log.fatal(e)
+                os.abort()
+            except Exception as e:
+                log.exception(e)
+                await asyncio.sleep(1)
+                continue
+
+            break
+        else:
+            if flight_token:
+                single_flight.flights.forget_file(flight_token)
+            flight_token = None
+        if flight_token:
+            shared = await single_flight.flights.wait_file(flight_token)
+            if shared is not None:
+                media_type, file_id = shared
+                publish((single_flight.FILE, media_type, file_id, entry['title']))
+    except AuthKeyDuplicatedError as e:
+        await _bot.send_message(chat_id, 'INTERNAL ERROR: try again')
+        log.fatal(e)
+        os.abort()
+    except Exception as e:
+        if len(preferred_formats) - 1 <= ip:
+            # raise exception for notify user about error
+            raise
+        else:
+            log.warning(e)
+            return ENTRY_RETRY
+
+    return ENTRY_DONE
 
 
 api_id = int(os.environ['API_ID'])
@@ -1311,12 +1651,12 @@ client = TelegramClient(StringSession(get_client_session()), api_id, api_hash)
 _bot = Bot(token=os.environ['BOT_TOKEN'])
 bot_entity = None
 
-vid_format = '((best[ext=mp4,height<=1080]+best[ext=mp4,height<=480])[protocol^=http]/best[ext=mp4,height<=1080]+best[ext=mp4,height<=480]/best[ext=mp4]+worst[ext=mp4]/best[ext=mp4]/(bestvideo[ext=mp4,height<=1080]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]))[protocol^=http]/bestvideo[ext=mp4]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4])/best)[protocol!=http_dash_segments]'
-vid_fhd_format = '((best[ext=mp4][height<=1080][height>720])[protocol^=http]/best[ext=mp4][height<=1080][height>720]/  (bestvideo[ext=mp4][height<=1080][height>720]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio))[protocol^=http]/(bestvideo[ext=mp4][height<=1080][height>720])[protocol^=http]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio)/bestvideo[ext=mp4][height<=1080][height>720]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio)/  (best[ext=mp4][height<=720][height>360])[protocol^=http]/best[ext=mp4][height<=720][height>360]/  (bestvideo[ext=mp4][height<=720][height>360]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio))[protocol^=http]/(bestvideo[ext=mp4][height<=720][height>360])[protocol^=http]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio)/bestvideo[ext=mp4][height<=720][height>360]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio) /  (best[ext=mp4][height<=360])[protocol^=http]/best[ext=mp4][height<=360]/  (bestvideo[ext=mp4][height<=360]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio))[protocol^=http]/(bestvideo[ext=mp4][height<=360])[protocol^=http]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio)/bestvideo[ext=mp4][height<=360]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio)/   best[ext=mp4]   /bestvideo[ext=mp4]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio)/best)[protocol!=http_dash_segments][vcodec !^=? av01]'
-vid_hd_format = '((best[ext=mp4][height<=720][height>360])[protocol^=http]/best[ext=mp4][height<=720][height>360]/  (bestvideo[ext=mp4][height<=720][height>360]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio))[protocol^=http]/(bestvideo[ext=mp4][height<=720][height>360])[protocol^=http]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio)/bestvideo[ext=mp4][height<=720][height>360]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio) /  (best[ext=mp4][height<=360])[protocol^=http]/best[ext=mp4][height<=360]/  (bestvideo[ext=mp4][height<=360]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio))[protocol^=http]/(bestvideo[ext=mp4][height<=360])[protocol^=http]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio)/bestvideo[ext=mp4][height<=360]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio)/   best[ext=mp4]   /bestvideo[ext=mp4]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio)/best)[protocol!=http_dash_segments][vcodec !^=? av01]'
-vid_nhd_format = '((best[ext=mp4][height<=360])[protocol^=http]/best[ext=mp4][height<=360]/  (bestvideo[ext=mp4][height<=360]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio))[protocol^=http]/(bestvideo[ext=mp4][height<=360])[protocol^=http]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio)/bestvideo[ext=mp4][height<=360]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio)/   best[ext=mp4]   /bestvideo[ext=mp4]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio)/best)[protocol!=http_dash_segments][vcodec !^=? av01]'
+vid_format = '((best[ext=mp4,height<=1080]+best[ext=mp4,height<=480])[protocol^=http]/best[ext=mp4,height<=1080]+best[ext=mp4,height<=480]/best[ext=mp4]+worst[ext=mp4]/best[ext=mp4]/(bestvideo[ext=mp4,height<=1080]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]))[protocol^=http]/bestvideo[ext=mp4]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4])/best)'
+vid_fhd_format = '((best[ext=mp4][height<=1080][height>720])[protocol^=http]/best[ext=mp4][height<=1080][height>720]/  (bestvideo[ext=mp4][height<=1080][height>720]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio))[protocol^=http]/(bestvideo[ext=mp4][height<=1080][height>720])[protocol^=http]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio)/bestvideo[ext=mp4][height<=1080][height>720]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio)/  (best[ext=mp4][height<=720][height>360])[protocol^=http]/best[ext=mp4][height<=720][height>360]/  (bestvideo[ext=mp4][height<=720][height>360]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio))[protocol^=http]/(bestvideo[ext=mp4][height<=720][height>360])[protocol^=http]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio)/bestvideo[ext=mp4][height<=720][height>360]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio) /  (best[ext=mp4][height<=360])[protocol^=http]/best[ext=mp4][height<=360]/  (bestvideo[ext=mp4][height<=360]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio))[protocol^=http]/(bestvideo[ext=mp4][height<=360])[protocol^=http]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio)/bestvideo[ext=mp4][height<=360]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio)/   best[ext=mp4]   /bestvideo[ext=mp4]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio)/best)[vcodec !^=? av01]'
+vid_hd_format = '((best[ext=mp4][height<=720][height>360])[protocol^=http]/best[ext=mp4][height<=720][height>360]/  (bestvideo[ext=mp4][height<=720][height>360]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio))[protocol^=http]/(bestvideo[ext=mp4][height<=720][height>360])[protocol^=http]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio)/bestvideo[ext=mp4][height<=720][height>360]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio) /  (best[ext=mp4][height<=360])[protocol^=http]/best[ext=mp4][height<=360]/  (bestvideo[ext=mp4][height<=360]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio))[protocol^=http]/(bestvideo[ext=mp4][height<=360])[protocol^=http]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio)/bestvideo[ext=mp4][height<=360]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio)/   best[ext=mp4]   /bestvideo[ext=mp4]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio)/best)[vcodec !^=? av01]'
+vid_nhd_format = '((best[ext=mp4][height<=360])[protocol^=http]/best[ext=mp4][height<=360]/  (bestvideo[ext=mp4][height<=360]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio))[protocol^=http]/(bestvideo[ext=mp4][height<=360])[protocol^=http]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio)/bestvideo[ext=mp4][height<=360]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio)/   best[ext=mp4]   /bestvideo[ext=mp4]+(bestaudio[ext=mp3]/bestaudio[ext=m4a]/bestaudio[ext=mp4]/bestaudio)/best)[vcodec !^=? av01]'
 worst_video_format = vid_nhd_format
-audio_format = '((bestaudio[ext=m4a]/bestaudio[ext=mp3])[protocol^=http]/bestaudio/best[ext=mp4,height<=480]/best[ext=mp4]/best)[protocol!=http_dash_segments]'
+audio_format = '((bestaudio[ext=m4a]/bestaudio[ext=mp3])[protocol^=http]/bestaudio/best[ext=mp4,height<=480]/best[ext=mp4]/best)'
 
 url_extractor = URLExtract()
 
@@ -1325,10 +1665,8 @@ playlist_cmds = ['p', 'pa', 'pw']
 available_cmds = ['start', 'ping', 'donate', 'settings', 'a', 'w', 'c', 's', 't', 'm', 'r', 'z'] + playlist_cmds
 
 TG_MAX_FILE_SIZE = 1500 * 1024 * 1024
-TG_MAX_PARALLEL_CONNECTIONS = 30
-TG_CONNECTIONS_COUNT = 0
-MAX_STORAGE_SIZE = int(os.getenv('STORAGE_SIZE')) * 1024 * 1024
-STORAGE_SIZE = MAX_STORAGE_SIZE
+MESSAGE_URLS_CONCURRENCY = int(os.getenv('MESSAGE_URLS_CONCURRENCY', 3))
+PLAYLIST_CONCURRENCY = int(os.getenv('PLAYLIST_CONCURRENCY', 3))
 
 
 async def init_bot_enitty():
@@ -1340,11 +1678,18 @@ async def init_bot_enitty():
 
 
 async def shutdown():
+    # unfinished jobs and their local files stay for restart
+    storage.manager.keep_files = True
+    upload_journal.journal.close()
+    extractor_pool.pool.shutdown()
+    await http_pool.pool.close()
+    await fast_telethon.sender_pool.close()
     await client.disconnect()
     sys.exit(1)
 
 
 async def tg_client_shutdown(_app=None):
+    await fast_telethon.sender_pool.close()
     await client.disconnect()
 
 
@@ -1353,15 +1698,20 @@ def sig_handler():
 
 
 if __name__ == '__main__':
-    print('Allowed storage size: ', STORAGE_SIZE)
+    print('Allowed storage size: ', storage.manager.capacity)
+    # fork extractor workers before any threads are started
+    extractor_pool.pool.start()
     app = web.Application()
-    app.add_routes([web.post('/bot', on_message)])
+    app.add_routes([web.post('/bot', on_message),
+                    web.get('/stats', on_stats)])
     client.start()
     # asyncio.get_event_loop().create_task(bot._run_until_disconnected())
     asyncio.get_event_loop().create_task(init_bot_enitty())
+    requeue_jobs()
     asyncio.get_event_loop().add_signal_handler(signal.SIGABRT, sig_handler)
     asyncio.get_event_loop().add_signal_handler(signal.SIGTERM, sig_handler)
     asyncio.get_event_loop().add_signal_handler(signal.SIGHUP, sig_handler)
     app.on_shutdown.append(tg_client_shutdown)
+    app.on_shutdown.append(http_pool.pool.close)
     asyncio.get_event_loop().create_task(web.run_app(app))
     client.run_until_disconnected()
@@ -0,0 +1,48 @@
+import asyncio
+
+
+# lets concurrent jobs send results in the order of their indexes
+class OrderedDelivery:
+
+    def __init__(self, start=0):
+        self._next = start
+        self._done = set()
+        self._cond = asyncio.Condition()
+
+    def is_turn(self, index):
+        return self._next >= index
+
+    # wait until all jobs with lower index are finished
+    async def wait_turn(self, index):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._next >= index)
+
+    # job finished (or failed), next one can send its results
+    async def done(self, index):
+        async with self._cond:
+            self._done.add(index)
+            while self._next in self._done:
+                self._done.remove(self._next)
+                self._next += 1
+            self._cond.notify_all()
+
+
+# run coroutine factories with limited concurrency, limit is rechecked before each start.
+# Job which returns True stops starting of the rest ones, then True is returned
+async def run_bounded(jobs, concurrency):
+    pending = list(jobs)
+    running = set()
+    stopped = False
+    try:
+        while pending or running:
+            while pending and len(running) < max(1, concurrency()):
+                running.add(asyncio.ensure_future(pending.pop(0)()))
+            done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for d in done:
+                if d.result() is True:
+                    stopped = True
+                    pending.clear()
+    finally:
+        for r in running:
+            r.cancel()
+    return stopped
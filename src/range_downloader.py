@@ -0,0 +1,146 @@
+import asyncio
+import os
+import time
+import aiohttp
+from aiohttp import ClientTimeout, hdrs
+import http_pool
+import metrics
+
+
+# parallel range requests of one download, 1 turns segmented downloads off
+RANGE_CONNECTIONS = int(os.getenv('RANGE_CONNECTIONS', 4))
+RANGE_SEGMENT_SIZE = int(os.getenv('RANGE_SEGMENT_SIZE', 2 * 1024 * 1024))
+# segments which are downloaded ahead of reader, they bound memory of one download
+RANGE_WINDOW = int(os.getenv('RANGE_WINDOW', 8))
+RANGE_RETRIES = int(os.getenv('RANGE_RETRIES', 3))
+RANGE_RETRY_DELAY = 1
+# stalled segment request is made again
+RANGE_READ_TIMEOUT = 30
+RANGE_CHUNK_SIZE = 256 * 1024
+
+
+class RangeNotSupported(Exception):
+    pass
+
+
+class RangeStats:
+
+    def __init__(self):
+        self.downloads = 0
+        self.fallbacks = 0
+        self.segments = 0
+        self.bytes = 0
+        self.retries = 0
+        # reader waits for the next segment
+        self.stall = metrics.Histogram()
+        self.segment_time = metrics.Histogram()
+
+    def stats(self):
+        return {
+            'downloads': self.downloads,
+            'fallbacks': self.fallbacks,
+            'segments': self.segments,
+            'bytes': self.bytes,
+            'retries': self.retries,
+            'stall': self.stall.stats(),
+            'segment_time': self.segment_time.stats()
+        }
+
+
+stats = RangeStats()
+
+
+# media of known size downloaded by byte ranges at once and read in order,
+# it's a source of buffered_reader.BufferedReader like StreamSource
+class RangeSource:
+
+    def __init__(self, url, size, headers=None, connections=RANGE_CONNECTIONS,
+                 segment_size=RANGE_SEGMENT_SIZE, window=RANGE_WINDOW):
+        self.url = url
+        self.size = size
+        self.headers = headers
+        self.window = max(window, connections)
+        self.segments = [(start, min(start + segment_size, size) - 1) for start in range(0, size, segment_size)]
+        self._semaphore = asyncio.Semaphore(connections)
+        # index -> task of segment which is downloaded or waits to be read
+        self._tasks = {}
+        self._next_fetch = 0
+        self._read_index = 0
+        self._current = memoryview(b'')
+        self._offset = 0
+        self._closed = False
+        stats.downloads += 1
+
+    def _schedule(self):
+        while (not self._closed and self._next_fetch < len(self.segments) and
+               self._next_fetch < self._read_index + self.window):
+            self._tasks[self._next_fetch] = asyncio.ensure_future(self._fetch(self._next_fetch))
+            self._next_fetch += 1
+
+    async def _fetch(self, index):
+        start, end = self.segments[index]
+        length = end - start + 1
+        pieces = []
+        received = 0
+        attempt = 0
+        async with self._semaphore:
+            started = time.monotonic()
+            while True:
+                headers = dict(self.headers) if self.headers else {}
+                # retry asks only for the rest of segment
+                headers[hdrs.RANGE] = 'bytes={}-{}'.format(start + received, end)
+                try:
+                    async with http_pool.pool.session().get(
+                            self.url, headers=headers,
+                            timeout=ClientTimeout(sock_read=RANGE_READ_TIMEOUT)) as resp:
+                        if resp.status != 206:
+                            raise RangeNotSupported('Range request failed: ' + str(resp.status))
+                        async for chunk in resp.content.iter_chunked(RANGE_CHUNK_SIZE):
+                            pieces.append(chunk)
+                            received += len(chunk)
+                    if received >= length:
+                        break
+                    raise aiohttp.ClientPayloadError('segment is cut at {} of {}'.format(received, length))
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    attempt += 1
+                    if attempt > RANGE_RETRIES:
+                        raise
+                    stats.retries += 1
+                    print('segment {} of {} failed: {!r}, retry {}'.format(index, self.url, e, attempt))
+                    await asyncio.sleep(RANGE_RETRY_DELAY * 2 ** (attempt - 1))
+            stats.segment_time.observe(time.monotonic() - started)
+        stats.segments += 1
+        stats.bytes += length
+        data = b''.join(pieces) if len(pieces) != 1 else pieces[0]
+        return data[:length] if len(data) > length else data
+
+    async def readinto(self, view):
+        while self._offset == len(self._current):
+            if self._closed or self._read_index >= len(self.segments):
+                return 0
+            self._schedule()
+            task = self._tasks.pop(self._read_index)
+            started = time.monotonic()
+            data = await task
+            stats.stall.observe(time.monotonic() - started)
+            self._current = memoryview(data)
+            self._offset = 0
+            self._read_index += 1
+            self._schedule()
+        count = min(len(view), len(self._current) - self._offset)
+        view[:count] = self._current[self._offset:self._offset + count]
+        self._offset += count
+        return count
+
+    def close(self):
+        self._closed = True
+        for task in self._tasks.values():
+            if task.done():
+                if not task.cancelled():
+                    # failure of segment which nobody reads is not an error
+                    task.exception()
+            else:
+                task.cancel()
+        self._tasks = {}
+        self._current = memoryview(b'')
+        self._offset = 0
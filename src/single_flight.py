@@ -0,0 +1,166 @@
+import asyncio
+import contextlib
+import hashlib
+import json
+import os
+import uuid
+import info_cache
+
+
+# commands which give the same media to everybody, other ones are processed for each request
+SHARED_CMDS = (None, 'a', 'w', 'c', 'm')
+# how long leader waits for file id of sent media to share it with followers
+SINGLE_FLIGHT_FILE_TIMEOUT = int(os.getenv('SINGLE_FLIGHT_FILE_TIMEOUT', 60))
+
+# kinds of entry results which followers send to their own chats
+FILE = 'file'
+MESSAGE = 'message'
+SKIPPED = 'skipped'
+
+
+def make_key(url, cmd, audio_mode, preferred_formats, cut_range=None, playlist_range=None):
+    raw = json.dumps([info_cache.normalize_url(url), cmd, bool(audio_mode), preferred_formats,
+                      cut_range, playlist_range], default=str)
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+# what leader sent for its request, followers repeat it instead of downloading media again
+class Flight:
+
+    def __init__(self):
+        self.followers = 0
+        self.error = None
+        # True if the rest of message urls were skipped
+        self.stopped = False
+        self._entries = None
+        # entry index -> result tuple, None if entry can't be shared
+        self._results = {}
+        # leader stopped to serve followers before it finished
+        self.released = False
+        self._done = asyncio.Event()
+
+    def set_entries(self, count):
+        self._entries = count
+
+    # the first result of entry is kept
+    def publish(self, index, result):
+        self._results.setdefault(index, result)
+
+    # entry results in order, None if some of them can't be shared
+    def results(self):
+        if self._entries is None or self.released:
+            return None
+        results = [self._results.get(i) for i in range(self._entries)]
+        if any(r is None for r in results):
+            return None
+        return results
+
+    async def wait(self):
+        await self._done.wait()
+
+
+class SingleFlight:
+
+    def __init__(self):
+        # key -> flight of leader
+        self._flights = {}
+        # token from agent caption -> future of (media type, file id)
+        self._files = {}
+        self.leaders = 0
+        self.followers = 0
+        self.shared = 0
+        self.fallbacks = 0
+        self.released = 0
+
+    # yields (flight, True) for the first request with this key, leader fills the flight.
+    # Other ones wait for leader to finish and yield (flight, False).
+    # Request without key isn't shared, it yields (None, True) at once
+    @contextlib.asynccontextmanager
+    async def join(self, key):
+        if key is None:
+            yield None, True
+            return
+        flight = self._flights.get(key)
+        if flight is not None:
+            self.followers += 1
+            flight.followers += 1
+            await flight.wait()
+            yield flight, False
+            return
+
+        flight = Flight()
+        self._flights[key] = flight
+        self.leaders += 1
+        try:
+            yield flight, True
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            flight._done.set()
+
+    # leader is going to wait for something which may wait for its followers,
+    # so they stop waiting and process request themselves, new requests don't join it
+    def release(self, flight):
+        if flight.released or flight._done.is_set():
+            return
+        flight.released = True
+        self.released += 1
+        for key, f in list(self._flights.items()):
+            if f is flight:
+                del self._flights[key]
+        flight._done.set()
+
+    # entry results of finished flight, None if follower must process request itself
+    def results(self, flight):
+        results = flight.results() if flight.error is None else None
+        if results is None and flight.error is None:
+            self.fallbacks += 1
+        else:
+            self.shared += 1
+        return results
+
+    # token for agent caption, file id of sent media comes back with it
+    def expect_file(self):
+        token = uuid.uuid4().hex[:12]
+        self._files[token] = asyncio.get_event_loop().create_future()
+        return token
+
+    # bot may get file before leader starts to wait for it, so future is removed by waiter
+    def file_sent(self, token, media_type, file_id):
+        fut = self._files.get(token)
+        if fut is not None and not fut.done():
+            fut.set_result((media_type, file_id))
+
+    def forget_file(self, token):
+        fut = self._files.pop(token, None)
+        if fut is not None:
+            fut.cancel()
+
+    # (media type, file id) or None if it doesn't come in time
+    async def wait_file(self, token):
+        fut = self._files.get(token)
+        if fut is None:
+            return None
+        try:
+            return await asyncio.wait_for(fut, SINGLE_FLIGHT_FILE_TIMEOUT)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self._files.pop(token, None)
+
+    def stats(self):
+        return {
+            'in_flight': len(self._flights),
+            'leaders': self.leaders,
+            'followers': self.followers,
+            'shared': self.shared,
+            'fallbacks': self.fallbacks,
+            'released': self.released,
+            'pending_files': len(self._files)
+        }
+
+
+flights = SingleFlight()
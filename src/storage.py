@@ -0,0 +1,183 @@
+import asyncio
+import os
+import time
+import metrics
+
+
+# disk space which bot may use for local media files, in MB
+STORAGE_SIZE = int(os.getenv('STORAGE_SIZE')) * 1024 * 1024
+# space which must stay free on disk anyway
+STORAGE_DISK_MARGIN = int(os.getenv('STORAGE_DISK_MARGIN', 100)) * 1024 * 1024
+# how long to wait for space before falling back to pipe output
+STORAGE_WAIT = float(os.getenv('STORAGE_WAIT', 10))
+# free disk space is rechecked at least this often while waiting
+STORAGE_RECHECK_INTERVAL = 1.0
+
+
+def disk_free(path):
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+# space held for one local file, the file is removed with release
+class Reservation:
+
+    def __init__(self, manager, size, path=None):
+        self.manager = manager
+        self.size = size
+        self.path = path
+        self.released = False
+
+    # bytes of the file which are already on disk
+    def written(self):
+        if self.path is None:
+            return 0
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    async def resize(self, size):
+        await self.manager._resize(self, size)
+
+    async def release(self):
+        if self.released:
+            return
+        self.released = True
+        if self.path is not None and not self.manager.keep_files:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print('failed remove ' + self.path + ': ' + str(e))
+        await self.manager._release(self)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.release()
+
+
+class StorageManager:
+
+    def __init__(self, capacity, path, margin):
+        self.capacity = capacity
+        self.path = path
+        self.margin = margin
+        self.reserved = 0
+        self._reservations = set()
+        # created lazily, it must belong to running loop
+        self._cond = None
+        self.granted = 0
+        self.timeouts = 0
+        self.wait_time = metrics.Histogram()
+        # set on shutdown, local files of interrupted jobs are used again after restart
+        self.keep_files = False
+
+    def _condition(self):
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    # space which can be reserved now, files being written are counted at their reserved size
+    @property
+    def free(self):
+        unwritten = sum(max(0, r.size - r.written()) for r in self._reservations)
+        try:
+            on_disk = disk_free(self.path) - self.margin - unwritten
+        except OSError:
+            on_disk = self.capacity
+        return max(0, min(self.capacity - self.reserved, on_disk))
+
+    # returns None if space didn't get free in time
+    async def reserve(self, size, path=None, timeout=STORAGE_WAIT):
+        if size <= 0 or size > self.capacity:
+            return None
+        cond = self._condition()
+        started = time.monotonic()
+        deadline = started + timeout
+        async with cond:
+            while size > self.free:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    self.wait_time.observe(time.monotonic() - started)
+                    return None
+                try:
+                    await asyncio.wait_for(cond.wait(), min(remaining, STORAGE_RECHECK_INTERVAL))
+                except asyncio.TimeoutError:
+                    pass
+            reservation = Reservation(self, size, path)
+            self.reserved += size
+            self._reservations.add(reservation)
+            self.granted += 1
+        self.wait_time.observe(time.monotonic() - started)
+        return reservation
+
+    async def _resize(self, reservation, size):
+        if reservation.released:
+            return
+        cond = self._condition()
+        async with cond:
+            self.reserved += size - reservation.size
+            reservation.size = size
+            cond.notify_all()
+
+    async def _release(self, reservation):
+        cond = self._condition()
+        async with cond:
+            if reservation in self._reservations:
+                self._reservations.remove(reservation)
+                self.reserved -= reservation.size
+            cond.notify_all()
+
+    def lease(self):
+        return StorageLease(self)
+
+    def stats(self):
+        return {
+            'capacity': self.capacity,
+            'reserved': self.reserved,
+            'free': self.free,
+            'reservations': len(self._reservations),
+            'granted': self.granted,
+            'timeouts': self.timeouts,
+            'wait_time': self.wait_time.stats()
+        }
+
+
+# holds reservations made by one job and releases all of them on exit
+class StorageLease:
+
+    def __init__(self, manager):
+        self.manager = manager
+        self._reservations = []
+
+    async def reserve(self, size, path=None):
+        reservation = await self.manager.reserve(size, path)
+        if reservation is not None:
+            self._reservations.append(reservation)
+        return reservation
+
+    # files are complete, hold exactly their size
+    async def settle(self):
+        for r in self._reservations:
+            if r.path is not None:
+                await r.resize(r.written())
+
+    async def release(self):
+        for r in self._reservations:
+            await r.release()
+        self._reservations = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.release()
+
+
+# ffmpeg writes local files to working directory
+manager = StorageManager(STORAGE_SIZE, '.', STORAGE_DISK_MARGIN)
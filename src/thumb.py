@@ -1,10 +1,10 @@
 
-from aiohttp import ClientSession, TCPConnector
 import io
 from PIL import Image
 from math import floor
 import av_source
 import av_utils
+import http_pool
 from datetime import timedelta
 
 async def get_thumbnail(thumb_url, entry):
@@ -12,11 +12,10 @@ async def get_thumbnail(thumb_url, entry):
     if thumb_url is None or thumb_url == 'none':
         img_data = await get_image_from_video(entry['url'], entry['http_headers'])
     else:
-        async with ClientSession(connector=TCPConnector(verify_ssl=False)) as session:
-            async with session.get(thumb_url) as resp:
-                if resp.status != 200:
-                    return None
-                img_data = await resp.read()
+        async with http_pool.pool.session().get(thumb_url) as resp:
+            if resp.status != 200:
+                return None
+            img_data = await resp.read()
 
     if img_data:
         thumb = io.BytesIO(img_data)
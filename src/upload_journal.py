@@ -0,0 +1,291 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+UPLOAD_JOURNAL_PATH = os.getenv('UPLOAD_JOURNAL_PATH', 'upload_journal.db')
+# telegram keeps uploaded parts for a limited time, older uploads start from zero
+UPLOAD_JOURNAL_TTL = int(os.getenv('UPLOAD_JOURNAL_TTL', 6 * 3600))
+# job which didn't finish after so many restarts is dropped, it likely kills the bot
+UPLOAD_JOURNAL_MAX_ATTEMPTS = int(os.getenv('UPLOAD_JOURNAL_MAX_ATTEMPTS', 3))
+# completed parts are written to journal after this many parts or seconds
+CHECKPOINT_PARTS = 16
+CHECKPOINT_INTERVAL = 5
+
+
+def _parts_to_bitmap(parts):
+    bitmap = bytearray((max(parts) // 8 + 1) if parts else 0)
+    for p in parts:
+        bitmap[p // 8] |= 1 << (p % 8)
+    return bytes(bitmap)
+
+
+def _bitmap_to_parts(bitmap):
+    return {i * 8 + b for i, byte in enumerate(bitmap) for b in range(8) if byte & (1 << b)}
+
+
+# progress of one local file upload: telegram file id, part size and parts which telegram confirmed
+class UploadCheckpoint:
+
+    def __init__(self, journal, path, size, file_id=None, part_size=None, parts=None):
+        self.journal = journal
+        self.path = path
+        self.size = size
+        self.file_id = file_id
+        self.part_size = part_size
+        self.parts = parts or set()
+        self._unsaved = 0
+        self._saved_at = time.monotonic()
+
+    # upload continues with the same file id and part size
+    @property
+    def resumed(self):
+        return self.file_id is not None
+
+    def start(self, file_id, part_size):
+        self.file_id = file_id
+        self.part_size = part_size
+        self.parts = set()
+        self.save()
+
+    def done(self, part):
+        self.parts.add(part)
+        self._unsaved += 1
+        if self._unsaved >= CHECKPOINT_PARTS or time.monotonic() - self._saved_at >= CHECKPOINT_INTERVAL:
+            self.save()
+
+    def save(self):
+        self._unsaved = 0
+        self._saved_at = time.monotonic()
+        self.journal._schedule_save(self)
+
+
+# journal record of one message which downloads media, it's written when the first url starts downloading
+class MessageJob:
+
+    def __init__(self, journal, chat_id, msg_id, message, started, delivered):
+        self.journal = journal
+        self.chat_id = chat_id
+        self.msg_id = msg_id
+        self.message = message
+        self.started = started
+        # (url index, entry index) of entries which were sent before restart
+        self._delivered = delivered
+
+    async def start(self):
+        if self.started:
+            return
+        self.started = True
+        await self.journal.add_job(self.chat_id, self.msg_id, self.message)
+
+    def delivered(self, url_index, entry_index):
+        return (url_index, entry_index) in self._delivered
+
+    # entry isn't sent again if the job is requeued
+    async def entry_sent(self, url_index, entry_index):
+        self._delivered.add((url_index, entry_index))
+        if self.started:
+            await self.journal.entry_sent(self.chat_id, self.msg_id, url_index, entry_index)
+
+    async def finish(self):
+        if self.started:
+            await self.journal.finish_job(self.chat_id, self.msg_id)
+
+
+class UploadJournal:
+
+    def __init__(self, path, ttl, max_attempts):
+        self.ttl = ttl
+        self.max_attempts = max_attempts
+        self.closed = False
+        self.resumed = 0
+        self.requeued = 0
+        self._lock = threading.Lock()
+        # path -> version of checkpoint which is written, saves may finish out of order
+        self._versions = {}
+        self._version = 0
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._db.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                             'chat_id INTEGER NOT NULL, '
+                             'msg_id INTEGER NOT NULL, '
+                             'message TEXT NOT NULL, '
+                             'attempts INTEGER NOT NULL, '
+                             'created REAL NOT NULL, '
+                             'PRIMARY KEY (chat_id, msg_id))')
+            self._db.execute('CREATE TABLE IF NOT EXISTS delivered ('
+                             'chat_id INTEGER NOT NULL, '
+                             'msg_id INTEGER NOT NULL, '
+                             'url_index INTEGER NOT NULL, '
+                             'entry_index INTEGER NOT NULL, '
+                             'PRIMARY KEY (chat_id, msg_id, url_index, entry_index))')
+            self._db.execute('CREATE TABLE IF NOT EXISTS uploads ('
+                             'path TEXT PRIMARY KEY, '
+                             'chat_id INTEGER NOT NULL, '
+                             'msg_id INTEGER NOT NULL, '
+                             'size INTEGER NOT NULL, '
+                             'output_done INTEGER NOT NULL, '
+                             'file_id INTEGER, '
+                             'part_size INTEGER, '
+                             'parts BLOB, '
+                             'created REAL NOT NULL)')
+            self._db.commit()
+
+    def _execute(self, sql, args=()):
+        with self._lock:
+            if self.closed:
+                return
+            self._db.execute(sql, args)
+            self._db.commit()
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_event_loop().run_in_executor(None, fn, *args)
+
+    # job of message, requeued one keeps its record and entries which were sent
+    async def job(self, chat_id, msg_id, message):
+        started, delivered = await self._run(self._job, chat_id, msg_id)
+        return MessageJob(self, chat_id, msg_id, message, started, delivered)
+
+    def _job(self, chat_id, msg_id):
+        with self._lock:
+            if self.closed:
+                return False, set()
+            started = self._db.execute('SELECT 1 FROM jobs WHERE chat_id = ? AND msg_id = ?',
+                                       (chat_id, msg_id)).fetchone() is not None
+            rows = self._db.execute('SELECT url_index, entry_index FROM delivered WHERE chat_id = ? AND msg_id = ?',
+                                    (chat_id, msg_id)).fetchall()
+        return started, set(rows)
+
+    # message is processed again after restart until the job finishes
+    async def add_job(self, chat_id, msg_id, message):
+        await self._run(self._execute,
+                        'INSERT OR IGNORE INTO jobs (chat_id, msg_id, message, attempts, created) '
+                        'VALUES (?, ?, ?, 0, ?)', (chat_id, msg_id, json.dumps(message), time.time()))
+
+    async def finish_job(self, chat_id, msg_id):
+        await self._run(self._finish_job, chat_id, msg_id)
+
+    def _finish_job(self, chat_id, msg_id):
+        self._execute('DELETE FROM jobs WHERE chat_id = ? AND msg_id = ?', (chat_id, msg_id))
+        self._execute('DELETE FROM uploads WHERE chat_id = ? AND msg_id = ?', (chat_id, msg_id))
+        self._execute('DELETE FROM delivered WHERE chat_id = ? AND msg_id = ?', (chat_id, msg_id))
+
+    async def entry_sent(self, chat_id, msg_id, url_index, entry_index):
+        await self._run(self._execute,
+                        'INSERT OR IGNORE INTO delivered (chat_id, msg_id, url_index, entry_index) '
+                        'VALUES (?, ?, ?, ?)', (chat_id, msg_id, url_index, entry_index))
+
+    # messages of jobs which were interrupted by restart, outputs of dropped jobs are removed
+    def pending_jobs(self):
+        with self._lock:
+            rows = self._db.execute('SELECT chat_id, msg_id, message, attempts, created FROM jobs').fetchall()
+        messages = []
+        for chat_id, msg_id, message, attempts, created in rows:
+            if attempts >= self.max_attempts or time.time() - created > self.ttl:
+                self._drop_job(chat_id, msg_id)
+                continue
+            self._execute('UPDATE jobs SET attempts = attempts + 1 WHERE chat_id = ? AND msg_id = ?',
+                          (chat_id, msg_id))
+            messages.append(json.loads(message))
+        self.requeued += len(messages)
+        return messages
+
+    def _drop_job(self, chat_id, msg_id):
+        with self._lock:
+            paths = self._db.execute('SELECT path FROM uploads WHERE chat_id = ? AND msg_id = ?',
+                                     (chat_id, msg_id)).fetchall()
+        for path, in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self._finish_job(chat_id, msg_id)
+
+    # local file which ffmpeg is going to write, it's removed with dropped job even if it isn't complete
+    async def output_started(self, path, chat_id, msg_id, size):
+        await self._run(self._execute,
+                        'INSERT OR IGNORE INTO uploads (path, chat_id, msg_id, size, output_done, created) '
+                        'VALUES (?, ?, ?, ?, 0, ?)', (path, chat_id, msg_id, size, time.time()))
+
+    # ffmpeg has written the whole local file, it isn't made again after restart
+    async def output_done(self, path, chat_id, msg_id, size):
+        await self._run(self._output_done, path, chat_id, msg_id, size)
+
+    def _output_done(self, path, chat_id, msg_id, size):
+        # checkpoint of the same file which is resumed stays
+        self._execute('INSERT OR IGNORE INTO uploads (path, chat_id, msg_id, size, output_done, created) '
+                      'VALUES (?, ?, ?, ?, 1, ?)', (path, chat_id, msg_id, size, time.time()))
+        self._execute('UPDATE uploads SET size = ?, output_done = 1, file_id = NULL, part_size = NULL, '
+                      'parts = NULL, created = ? WHERE path = ? AND (size != ? OR output_done = 0)',
+                      (size, time.time(), path, size))
+
+    # local file which is left complete by previous run
+    async def output_ready(self, path):
+        return await self._run(self._output_ready, path)
+
+    def _output_ready(self, path):
+        with self._lock:
+            row = self._db.execute('SELECT size, created FROM uploads WHERE path = ? AND output_done = 1',
+                                   (path,)).fetchone()
+        if row is None:
+            return False
+        size, created = row
+        try:
+            return time.time() - created <= self.ttl and os.path.getsize(path) == size
+        except OSError:
+            return False
+
+    async def checkpoint(self, path, size):
+        checkpoint = await self._run(self._checkpoint, path, size)
+        if checkpoint.resumed:
+            self.resumed += 1
+        return checkpoint
+
+    def _checkpoint(self, path, size):
+        with self._lock:
+            row = self._db.execute('SELECT size, file_id, part_size, parts, created FROM uploads WHERE path = ?',
+                                   (path,)).fetchone()
+        if row is not None and row[0] == size and row[1] is not None and time.time() - row[4] <= self.ttl:
+            return UploadCheckpoint(self, path, size, row[1], row[2], _bitmap_to_parts(row[3] or b''))
+        return UploadCheckpoint(self, path, size)
+
+    def _schedule_save(self, checkpoint):
+        self._version += 1
+        args = (checkpoint.path, self._version, checkpoint.file_id, checkpoint.part_size,
+                _parts_to_bitmap(checkpoint.parts))
+        asyncio.get_event_loop().run_in_executor(None, self._save, *args)
+
+    def _save(self, path, version, file_id, part_size, parts):
+        with self._lock:
+            if self.closed or self._versions.get(path, 0) > version:
+                return
+            self._versions[path] = version
+            self._db.execute('UPDATE uploads SET file_id = ?, part_size = ?, parts = ? WHERE path = ?',
+                             (file_id, part_size, parts, path))
+            self._db.commit()
+
+    # called on shutdown, jobs and files which are left are resumed after restart
+    def close(self):
+        with self._lock:
+            self.closed = True
+            self._db.close()
+
+    def stats(self):
+        with self._lock:
+            if self.closed:
+                jobs = uploads = 0
+            else:
+                jobs = self._db.execute('SELECT COUNT(*) FROM jobs').fetchone()[0]
+                uploads = self._db.execute('SELECT COUNT(*) FROM uploads').fetchone()[0]
+        return {
+            'jobs': jobs,
+            'uploads': uploads,
+            'requeued': self.requeued,
+            'resumed': self.resumed
+        }
+
+
+journal = UploadJournal(UPLOAD_JOURNAL_PATH, UPLOAD_JOURNAL_TTL, UPLOAD_JOURNAL_MAX_ATTEMPTS)
@@ -0,0 +1,138 @@
+import os
+import random
+import time
+
+
+# how often upload throughput is measured and configuration is changed
+TG_UPLOAD_TUNE_INTERVAL = float(os.getenv('TG_UPLOAD_TUNE_INTERVAL', 2))
+# requests which one connection may have in flight at once
+TG_UPLOAD_MAX_DEPTH = int(os.getenv('TG_UPLOAD_MAX_DEPTH', 4))
+# share of uploads which try part size other than the best known one
+TG_UPLOAD_EXPLORE = float(os.getenv('TG_UPLOAD_EXPLORE', 0.1))
+# throughput change which is taken as better or worse, not as noise
+TG_UPLOAD_GAIN = 0.05
+TG_UPLOAD_LOSS = 0.2
+# consumers idle longer than this share of time means source is the bottleneck
+TG_UPLOAD_SOURCE_BOUND = 0.5
+# part sizes which telegram accepts, in KB
+PART_SIZES_KB = (64, 128, 256, 512)
+# telegram limit of parts in one file
+MAX_PARTS = 3000
+# weight of new measurement in history
+HISTORY_ALPHA = 0.3
+
+
+# throughput of configurations which were used for uploads to each DC
+class DcHistory:
+
+    def __init__(self):
+        # dc id -> {(part kb, connections, depth): bytes per second}
+        self._rates = {}
+
+    def record(self, dc_id, config, rate):
+        rates = self._rates.setdefault(dc_id, {})
+        old = rates.get(config)
+        rates[config] = rate if old is None else old + HISTORY_ALPHA * (rate - old)
+
+    # the best known configuration which fits limits, None if there is no history
+    def best(self, dc_id, max_connections, part_sizes):
+        rates = [(rate, config) for config, rate in self._rates.get(dc_id, {}).items()
+                 if config[1] <= max_connections and config[0] in part_sizes]
+        if not rates:
+            return None
+        return max(rates)[1]
+
+    def stats(self):
+        return {str(dc_id): {'{}KB x{} x{}'.format(*config): round(rate) for config, rate in rates.items()}
+                for dc_id, rates in self._rates.items()}
+
+
+# part sizes which keep file within telegram parts limit
+def part_sizes(file_size):
+    sizes = [kb for kb in PART_SIZES_KB if kb * 1024 * MAX_PARTS >= file_size]
+    return sizes or [PART_SIZES_KB[-1]]
+
+
+# AIMD of connections count and requests depth of one upload, part size is picked once at start
+class UploadTuner:
+
+    def __init__(self, history, dc_id, file_size, default_part_kb, max_connections, connections):
+        self.history = history
+        self.dc_id = dc_id
+        self.max_connections = max_connections
+        sizes = part_sizes(file_size)
+        best = history.best(dc_id, max_connections, sizes)
+        if best is None:
+            self.part_kb = default_part_kb if default_part_kb in sizes else sizes[0]
+            self.connections = max(1, min(connections, max_connections))
+            self.depth = 1
+        else:
+            self.part_kb, self.connections, self.depth = best
+            if len(sizes) > 1 and random.random() < TG_UPLOAD_EXPLORE:
+                self.part_kb = random.choice([kb for kb in sizes if kb != self.part_kb])
+        self.started = time.monotonic()
+        self._last = self.started
+        self._last_bytes = 0
+        self._last_stall = 0.0
+        self._last_rate = None
+        self.increases = 0
+        self.decreases = 0
+
+    @property
+    def config(self):
+        return self.part_kb, self.connections, self.depth
+
+    # returns True if connections or depth were changed
+    def sample(self, sent_bytes, source_stall, consumers):
+        now = time.monotonic()
+        elapsed = now - self._last
+        if elapsed < TG_UPLOAD_TUNE_INTERVAL:
+            return False
+        rate = (sent_bytes - self._last_bytes) / elapsed
+        idle = (source_stall - self._last_stall) / (elapsed * max(1, consumers))
+        previous = self._last_rate
+        self._last, self._last_bytes, self._last_stall = now, sent_bytes, source_stall
+        self._last_rate = rate
+        # the first interval includes connection setup
+        if previous is not None:
+            self.history.record(self.dc_id, self.config, rate)
+
+        if previous is not None and rate < previous * (1 - TG_UPLOAD_LOSS):
+            return self._decrease()
+        # more senders don't help when they wait for data
+        if idle > TG_UPLOAD_SOURCE_BOUND:
+            return False
+        if previous is None or rate > previous * (1 + TG_UPLOAD_GAIN):
+            return self._increase()
+        return False
+
+    def _increase(self):
+        if self.connections < self.max_connections:
+            self.connections += 1
+        elif self.depth < TG_UPLOAD_MAX_DEPTH:
+            self.depth += 1
+        else:
+            return False
+        self.increases += 1
+        return True
+
+    def _decrease(self):
+        if self.connections == 1 and self.depth == 1:
+            return False
+        self.connections = max(1, self.connections // 2)
+        self.depth = max(1, self.depth - 1)
+        self.decreases += 1
+        return True
+
+    # connections which scheduler really gave are the limit
+    def granted(self, count):
+        self.connections = max(1, min(self.connections, count))
+
+    def finish(self, sent_bytes):
+        elapsed = time.monotonic() - self.started
+        # short uploads measure connection setup rather than throughput
+        if elapsed >= TG_UPLOAD_TUNE_INTERVAL:
+            self.history.record(self.dc_id, self.config, sent_bytes / elapsed)
+
+
+history = DcHistory()
@@ -0,0 +1,93 @@
+import json
+import os
+import threading
+import youtube_dl
+
+
+YDL_POOL_MAX_IDLE = int(os.getenv('YDL_POOL_MAX_IDLE', 8))
+
+# params which YoutubeDL reads on every extract_info call,
+# instances which differ only by them can be shared
+LIVE_PARAMS = {'format', 'playliststart', 'playlistend', 'playlist_items', 'noplaylist',
+               'force_generic_extractor', 'ignoreerrors'}
+
+
+def params_signature(params):
+    frozen = {k: v for k, v in params.items() if k not in LIVE_PARAMS}
+    return json.dumps(frozen, sort_keys=True, default=str)
+
+
+class YdlPool:
+
+    def __init__(self, max_idle):
+        self.max_idle = max_idle
+        # signature -> idle YoutubeDL instances
+        self._idle = {}
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+        self.in_use = 0
+
+    # returned instance uses passed params dict as is, changes of it are visible to the instance
+    def checkout(self, params):
+        signature = params_signature(params)
+        with self._lock:
+            idle = self._idle.get(signature)
+            ydl = idle.pop() if idle else None
+            self.in_use += 1
+            if ydl is not None:
+                self.reused += 1
+            else:
+                self.created += 1
+        if ydl is None:
+            ydl = youtube_dl.YoutubeDL(params=params)
+        ydl.params = params
+        return ydl, signature
+
+    def checkin(self, ydl, signature):
+        with self._lock:
+            self.in_use -= 1
+            idle = self._idle.setdefault(signature, [])
+            if len(idle) < self.max_idle:
+                idle.append(ydl)
+
+    def lease(self):
+        return YdlLease(self)
+
+    def stats(self):
+        with self._lock:
+            idle = sum(len(i) for i in self._idle.values())
+            signatures = len(self._idle)
+        total = self.created + self.reused
+        return {
+            'created': self.created,
+            'reused': self.reused,
+            'reuse_ratio': self.reused / total if total else 0.0,
+            'in_use': self.in_use,
+            'idle': idle,
+            'signatures': signatures
+        }
+
+
+# holds instances checked out by one job and returns all of them on exit
+class YdlLease:
+
+    def __init__(self, ydl_pool):
+        self.pool = ydl_pool
+        self._leased = []
+
+    def get(self, params):
+        ydl, signature = self.pool.checkout(params)
+        self._leased.append((ydl, signature))
+        return ydl
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        for ydl, signature in self._leased:
+            self.pool.checkin(ydl, signature)
+        self._leased = []
+
+
+pool = YdlPool(YDL_POOL_MAX_IDLE)
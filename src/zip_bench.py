@@ -0,0 +1,90 @@
+import asyncio
+import sys
+import time
+import zip_file
+
+
+# compares zip volume reads with the former bytes concatenation one, both must cut the same volumes
+
+
+class LegacyZipTorrentContentFile(zip_file.ZipTorrentContentFile):
+
+    # former read which concatenates bytes, kept for benchmark
+    async def read(self, n=-1):
+        resp = bytes()
+        if len(self.buf) != 0:
+            resp = self.buf
+            self.buf = bytes()
+        if n == -1:
+            n = self.size
+        if n + self.processed_size > zip_file.TG_MAX_FILE_SIZE:
+            n = zip_file.TG_MAX_FILE_SIZE - self.processed_size
+        elif n + self.processed_size > self.size:
+            n = self.size - self.processed_size
+
+        async for data in self.zipiter:
+            if data is None:
+                break
+            resp += data
+            if not (len(resp) < n and self.processed_size < zip_file.TG_MAX_FILE_SIZE):
+                break
+        if len(resp) > n:
+            self.buf = resp[n:]
+            resp = resp[0:n]
+
+        self.processed_size += len(resp)
+
+        if self.processed_size >= zip_file.TG_MAX_FILE_SIZE:
+            self.processed_size = 0
+            self.must_next_file = True
+
+        return resp
+
+
+async def _benchmark_source(size, chunk_size):
+    chunk = bytes(chunk_size)
+    sent = 0
+    while sent < size:
+        data = chunk[:min(chunk_size, size - sent)]
+        sent += len(data)
+        yield data
+
+
+async def _benchmark_volumes(cls, size, chunk_size, part_size):
+    zfile = cls(_benchmark_source(size, chunk_size), 'benchmark.bin', size)
+    volumes = []
+    for _ in range(zfile.zip_parts):
+        volume_size = 0
+        while True:
+            data = await zfile.read(part_size)
+            if len(data) == 0:
+                break
+            volume_size += len(data)
+            if zfile.must_next_file:
+                zfile.must_next_file = False
+                break
+        volumes.append(volume_size)
+        zfile.zip_num += 1
+    zfile.close()
+    return volumes
+
+
+async def _benchmark(size, volume_size, chunk_size, part_size):
+    zip_file.TG_MAX_FILE_SIZE = volume_size
+    mb = size / 1024 / 1024
+    results = {}
+    for title, cls in [('bytes concatenation', LegacyZipTorrentContentFile),
+                       ('chunk deque', zip_file.ZipTorrentContentFile)]:
+        started = time.perf_counter()
+        volumes = await _benchmark_volumes(cls, size, chunk_size, part_size)
+        elapsed = time.perf_counter() - started
+        results[title] = volumes
+        print('{}: {:.1f} MB/s, volumes {}'.format(title, mb / elapsed, volumes))
+    assert len(set(map(tuple, results.values()))) == 1, 'volume boundaries differ'
+
+
+# python zip_bench.py [size MB] [volume MB] [source chunk KB] [part KB]
+if __name__ == '__main__':
+    _args = [int(a) for a in sys.argv[1:]] + [1024, 300, 512, 512][len(sys.argv) - 1:]
+    asyncio.get_event_loop().run_until_complete(_benchmark(_args[0] * 1024 * 1024, _args[1] * 1024 * 1024,
+                                                           _args[2] * 1024, _args[3] * 1024))
@@ -1,4 +1,5 @@
 
+import collections
 import typing
 import zipstream
 import math as m
@@ -72,6 +73,10 @@ class Reader(typing.BinaryIO):
 
 class ZipTorrentContentFile(Reader):
     def __init__(self, file_iter, name, size):
+        # chunks of zip stream which are read ahead, the first one is consumed from _chunk_offset
+        self._chunks = collections.deque()
+        self._chunk_offset = 0
+        self._buffered = 0
         self.buf = bytes()
         self.processed_size = 0
         # self.progress_text = None
@@ -184,11 +189,34 @@ class ZipTorrentContentFile(Reader):
         else:
             return self._name + '.zip'
 
+    async def _next_chunk(self):
+        try:
+            return await self.zipiter.__anext__()
+        except StopAsyncIteration:
+            return None
+
+    # first n buffered bytes, whole chunk is returned as is when it fits exactly
+    def _take(self, n):
+        parts = []
+        need = n
+        while need > 0:
+            chunk = self._chunks[0]
+            available = len(chunk) - self._chunk_offset
+            if available <= need:
+                parts.append(chunk if self._chunk_offset == 0 else memoryview(chunk)[self._chunk_offset:])
+                self._chunks.popleft()
+                self._chunk_offset = 0
+                need -= available
+            else:
+                parts.append(memoryview(chunk)[self._chunk_offset:self._chunk_offset + need])
+                self._chunk_offset += need
+                need = 0
+        self._buffered -= n
+        if len(parts) == 1 and isinstance(parts[0], bytes):
+            return parts[0]
+        return b''.join(parts)
+
     async def read(self, n=-1):
-        resp = bytes()
-        if len(self.buf) != 0:
-            resp = self.buf
-            self.buf = bytes()
         if n == -1:
             n = self.size
         if n + self.processed_size > TG_MAX_FILE_SIZE:
@@ -196,43 +224,19 @@ class ZipTorrentContentFile(Reader):
         elif n + self.processed_size > self.size:
             n = self.size - self.processed_size
 
-        async for data in self.zipiter:
+        while self._buffered < n:
+            data = await self._next_chunk()
             if data is None:
                 break
-            resp += data
-            if not (len(resp) < n and self.processed_size < TG_MAX_FILE_SIZE):
-                break
-
-                #if time.time() - self.last_progress_update > 2:
-                #    await self.event.edit(self.progress_text.format(str(m.floor((self.downloaded_bytes_count*100) / self.size))))
-                #    self.last_progress_update = time.time()
-                #resp += await self.zipstream.__aiter__().__next__()
-                #if len(resp) == 0 and self.should_close == False:
-                #    print("\nSHOULD CLOSE CALL\n")
-                #    self.zipiter = iter(self.zipstream)
-                #    self.should_close = True
-                #    continue
-        if len(resp) > n:
-            self.buf = resp[n:]
-            resp = resp[0:n]
-
-        if len(resp) != 0 and n == 0:
-            # send last piece
-            self.processed_size += len(resp)
-            return resp
+            if len(data) != 0:
+                self._chunks.append(data)
+                self._buffered += len(data)
 
+        resp = self._take(min(n, self._buffered))
         self.processed_size += len(resp)
 
         if self.processed_size >= TG_MAX_FILE_SIZE:
-            #if self.is_finished == False and self.real_size - TG_MAX_FILE_SIZE <= 0:
-            #    self.real_size += 1024
-            #    TG_MAX_FILE_SIZE = TG_MAX_FILE_SIZE if self.should_split else self.real_size
-            #    self.big = self.real_size > TG_MAX_FILE_SIZE
-            #    self.size = TG_MAX_FILE_SIZE if self.big else self.real_size
-            #else:
             self.processed_size = 0
             self.must_next_file = True
-            #self.real_size -= TG_MAX_FILE_SIZE
-            # self._size = TG_MAX_FILE_SIZE if self.real_size > TG_MAX_FILE_SIZE else self.real_size
 
         return resp